@@ -1,17 +1,75 @@
 import os
-import csv
-from fastapi import FastAPI, HTTPException
+import json
+import logging
+from datetime import datetime
+from contextlib import asynccontextmanager
+from typing import List, Optional
+from fastapi import FastAPI, HTTPException, Request, Query as QueryParam
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from rag import get_answer
-from db import save_conversation, save_feedback
+from rerank import reranker
+from rag import get_answer_shared, get_answer_stream, get_answers_batch, close_async_clients, coalescing_stats
+from search import retriever
+from cache import response_cache
+from faq import faq_answers, faq_catalog
+from db import db_pool, tz, conversation_exists
+from evaluation import evaluation_queue
+from writer import db_writer
+from rollup import rollup_job
+from partitions import partition_job
+from migrations import migrate
+from context import packing_stats
+from metrics import (
+    registry, MetricsMiddleware, answers, tokens, openai_cost, context_tokens,
+    queue_depth, db_connections_in_use,
+)
 import uuid
 
+# Per-request traces, off unless the log level is DEBUG
+logger = logging.getLogger(__name__)
+
+# Largest number of questions accepted by /questions/batch
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+
 # Add these debug print statements at the beginning of the file
 print("Current directory:", os.getcwd())
 print("Files in current directory:", os.listdir())
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await run_in_threadpool(retriever.check)
+    try:
+        # Non-destructive, so upgrades apply on the next start
+        await run_in_threadpool(migrate)
+    except Exception as e:
+        print(f"Error migrating the database: {str(e)}")
+    db_writer.start()
+    response_cache.start(retriever.index_version)
+    faq_answers.start(retriever.index_version)
+    await evaluation_queue.start()
+    await rollup_job.start()
+    await partition_job.start()
+    yield
+    await partition_job.stop()
+    await rollup_job.stop()
+    # Evaluations drain into the writer, so stop the queue before the writer
+    await evaluation_queue.stop()
+    await run_in_threadpool(db_writer.stop)
+    await run_in_threadpool(response_cache.stop)
+    await run_in_threadpool(faq_answers.stop)
+    await close_async_clients()
+    db_pool.closeall()
+
+app = FastAPI(lifespan=lifespan)
+
+# Per-route request counts, latencies and in-flight requests for /metrics
+app.add_middleware(MetricsMiddleware, paths=lambda: {route.path for route in app.routes})
+queue_depth.set_function(db_writer.depth, queue="writer")
+queue_depth.set_function(evaluation_queue.depth, queue="evaluation")
+db_connections_in_use.set_function(lambda: db_pool.in_use)
 
 # Add CORS middleware
 # app.add_middleware(
@@ -33,65 +91,181 @@ class Query(BaseModel):
     question: str
     selected_model: str
 
+class BatchQuery(BaseModel):
+    questions: List[str]
+    selected_model: str
+
 class Feedback(BaseModel):
     conversation_id: str
     feedback: int
 
     
 @app.get("/faq")
-async def get_faq_questions():
-    print("Entering get_faq_questions function")
+async def get_faq_questions(
+    request: Request,
+    offset: int = QueryParam(0, ge=0),
+    limit: int = QueryParam(0, ge=0, description="page size, 0 returns every question"),
+    doc_id: Optional[str] = None,
+):
     try:
-        faq_questions = []
-        csv_path = '/backend/app/data/ground-truth-retrieval.csv'  # Updated path to match Docker volume
-        print(f"Attempting to open CSV file at: {csv_path}")
-        
-        if not os.path.exists(csv_path):
-            print(f"CSV file not found at {csv_path}")
-            raise FileNotFoundError(f"CSV file not found at {csv_path}")
-        
-        with open(csv_path, 'r') as file:
-            print("CSV file opened successfully")
-            csv_reader = csv.DictReader(file)
-            for row in csv_reader:
-                faq_questions.append({
-                    "text": row['question'],
-                    "document_id": row['doc_id'],
-                    "chunk_id": row['chunk_id']
-                })
-            print(f"Loaded {len(faq_questions)} questions from CSV")
-        
-        if not faq_questions:
-            print("No questions were loaded from the CSV")
-            raise ValueError("No questions were loaded from the CSV")
-        
-        print("Returning FAQ questions")
-        return JSONResponse(content={"faq_questions": faq_questions})
+        # Parsed once and re-read only when the CSV changes on disk
+        body, etag = faq_catalog.page(offset, limit, doc_id)
     except Exception as e:
         print(f"Error in get_faq_questions: {str(e)}")
-        print(f"Current working directory: {os.getcwd()}")
-        print(f"Contents of current directory: {os.listdir()}")
-        print(f"Contents of /backend/app/data directory: {os.listdir('/backend/app/data')}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
     
+def record_answer_metrics(model, result):
+    if result.get("precomputed"):
+        source = "precomputed"
+    elif result.get("coalesced"):
+        source = "coalesced"
+    elif result.get("cache_hit"):
+        source = "cache"
+    else:
+        source = "generated"
+    answers.inc(source=source)
+    # Stored answers are billed at zero, background evaluations are counted
+    # by the evaluation queue
+    for kind in ("prompt", "completion", "eval_prompt", "eval_completion"):
+        tokens.inc(result[f"{kind}_tokens"], model=model, kind=kind)
+    openai_cost.inc(result["openai_cost"], model=model)
+    context_tokens.inc(result["context_tokens"], model=model, kind="sent")
+    context_tokens.inc(result["context_tokens_saved"], model=model, kind="saved")
+
+async def record_conversation(conversation_id, question, model, result):
+    # Queues the conversation for the writer and, if sampled, for background
+    # relevance evaluation; updates result's relevance fields in place
+    if result.get("cache_hit"):
+        # Stored answers were already paid for, and evaluated when the
+        # precompute job or the original request asked for it
+        evaluate = False
+        if result["relevance"] == "PENDING":
+            result["relevance"] = "NOT_EVALUATED"
+            if result.get("precomputed"):
+                result["relevance_explanation"] = "Precomputed FAQ answer"
+            elif result.get("coalesced"):
+                result["relevance_explanation"] = "Shared with an identical question in flight"
+            else:
+                result["relevance_explanation"] = "Served from cache"
+    else:
+        evaluate = evaluation_queue.reserve()
+        if not evaluate:
+            result["relevance"] = "NOT_EVALUATED"
+            result["relevance_explanation"] = "Not sampled for evaluation"
+    record_answer_metrics(model, result)
+    # The timestamp locates the row's partition for the relevance update
+    timestamp = datetime.now(tz)
+    # Buffered and written in batches by the write-behind writer
+    try:
+        await db_writer.save_conversation(conversation_id, question, result, timestamp)
+    except Exception:
+        if evaluate:
+            evaluation_queue.release()
+        raise
+    if evaluate:
+        evaluation_queue.submit(conversation_id, question, result["answer"], model, timestamp)
+
 @app.post("/question")
 async def rag_query(query: Query):
     try:
         
-        print(f"Received question: {query.question}")
+        logger.debug("Received question: %s", query.question)
         conversation_id = str(uuid.uuid4())
-        print("Getting answer...")
-        result = get_answer(query.question, query.selected_model)
-        print(f"Sending response: {result}")
-        print("Answer received, saving conversation...")
-        save_conversation(conversation_id, query.question, result)
-        print("Conversation saved, returning result...")
+        # FAQ clicks are usually answered from the precomputed store
+        result = faq_answers.get(query.question, query.selected_model)
+        if result is None:
+            # Relevance is evaluated in the background, off the response path,
+            # and identical questions in flight share one answer
+            result = await get_answer_shared(query.question, query.selected_model)
+        logger.debug("Answered conversation %s", conversation_id)
+        await record_conversation(conversation_id, query.question, query.selected_model, result)
         return {"conversation_id": conversation_id, **result}
     except Exception as e:
         print(f"Error occurred: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/questions/batch")
+async def rag_query_batch(batch: BatchQuery):
+    if not batch.questions or len(batch.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Send between 1 and {BATCH_MAX_QUESTIONS} questions")
+
+    results = [faq_answers.get(question, batch.selected_model) for question in batch.questions]
+    pending = [i for i, result in enumerate(results) if result is None]
+    if pending:
+        answers = await get_answers_batch([batch.questions[i] for i in pending], batch.selected_model)
+        for i, answer in zip(pending, answers):
+            results[i] = answer
+
+    # Results in input order, failures reported per item
+    items = []
+    for question, result in zip(batch.questions, results):
+        if isinstance(result, Exception):
+            items.append({"question": question, "error": str(result)})
+            continue
+        conversation_id = str(uuid.uuid4())
+        try:
+            await record_conversation(conversation_id, question, batch.selected_model, result)
+        except Exception as e:
+            items.append({"question": question, "error": f"Failed to save conversation: {e}"})
+            continue
+        items.append({
+            "conversation_id": conversation_id,
+            **{key: value for key, value in result.items() if key not in ("prompt", "context")},
+        })
+    return {"results": items}
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def precomputed_events(result):
+    # Same event sequence as get_answer_stream, with the answer in one piece
+    yield "search_results", result["search_results"]
+    yield "token", result["answer"]
+    yield "done", result
+
+async def stream_answer(conversation_id, query):
+    try:
+        precomputed = faq_answers.get(query.question, query.selected_model)
+        if precomputed is not None:
+            events = precomputed_events(precomputed)
+        else:
+            events = get_answer_stream(query.question, query.selected_model)
+
+        async for event, data in events:
+            if event == "search_results":
+                yield sse_event("search_results", {"conversation_id": conversation_id, "search_results": data})
+            elif event == "token":
+                yield sse_event("token", {"text": data})
+            else:
+                # Only a completed answer is stored; a client that disconnects
+                # mid-stream cancels the generator before this point
+                await record_conversation(conversation_id, query.question, query.selected_model, data)
+                final = {
+                    key: value for key, value in data.items()
+                    if key not in ("prompt", "context", "search_results")
+                }
+                yield sse_event("done", {"conversation_id": conversation_id, **final})
+    except Exception as e:
+        print(f"Error while streaming conversation {conversation_id}: {str(e)}")
+        yield sse_event("error", {"conversation_id": conversation_id, "detail": str(e)})
+
+@app.post("/question/stream")
+async def rag_query_stream(query: Query):
+    # Server-Sent Events: search_results first, then token events as the
+    # answer is generated, then done with usage and cost
+    conversation_id = str(uuid.uuid4())
+    return StreamingResponse(
+        stream_answer(conversation_id, query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
     
     
 @app.post("/feedback")
@@ -103,7 +277,17 @@ async def submit_feedback(feedback: Feedback):
                 content={"error": "Invalid input. Feedback must be 1 or -1."}
             )
 
-        save_feedback(feedback.conversation_id, feedback.feedback)
+        # Feedback is written later, so an id the database will never know
+        # is refused now rather than acknowledged and dropped
+        if not db_writer.is_pending(feedback.conversation_id) and not await run_in_threadpool(
+            conversation_exists, feedback.conversation_id
+        ):
+            return JSONResponse(
+                status_code=404,
+                content={"error": f"Conversation {feedback.conversation_id} not found."}
+            )
+
+        await db_writer.save_feedback(feedback.conversation_id, feedback.feedback)
         
         result = {
             "message": f"Feedback received for conversation {feedback.conversation_id}: {feedback.feedback}"
@@ -112,6 +296,26 @@ async def submit_feedback(feedback: Feedback):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus text exposition format
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "evaluation": evaluation_queue.snapshot(),
+        "writer": db_writer.snapshot(),
+        "cache": response_cache.snapshot(),
+        "faq_answers": faq_answers.snapshot(),
+        "coalescing": coalescing_stats,
+        "context_packing": packing_stats,
+        "rerank": reranker.snapshot(),
+        "db_pool": db_pool.snapshot(),
+        "rollups": rollup_job.snapshot(),
+        "partitions": partition_job.snapshot(),
+    }
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=5000)
\ No newline at end of file
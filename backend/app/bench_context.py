@@ -0,0 +1,156 @@
+import json
+import time
+import asyncio
+import argparse
+from search import RETRIEVER_BACKEND, RETRIEVERS, create_retriever
+from context import format_hits, pack_context, packing_stats
+from tokens import count_tokens
+from bench_retrieval import GROUND_TRUTH_PATH, load_ground_truth, parse_list, percentile
+
+RELEVANCE_LABELS = ("RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "UNKNOWN")
+
+
+def normalize(text):
+    return " ".join(text.split()).lower()
+
+
+def retrieve(retriever, ground_truth, size):
+    # One search per question, shared by every budget
+    return [retriever.search(row['question'], size) for row in ground_truth]
+
+
+def evaluate_packing(ground_truth, hits, budget):
+    # Token savings of pack_context against format_hits, and whether the
+    # ground truth chunk, when retrieved, still reaches the LLM in full
+    raw_tokens = []
+    packed_tokens = []
+    pack_ms = []
+    retrieved = kept = 0
+    before = dict(packing_stats)
+    for row, results in zip(ground_truth, hits):
+        raw_tokens.append(count_tokens(format_hits(results)))
+        start_time = time.perf_counter()
+        context, _, packing = pack_context(results, budget)
+        pack_ms.append((time.perf_counter() - start_time) * 1000)
+        packed_tokens.append(packing["context_tokens"])
+
+        expected = [doc for doc in results if doc['chunk_id'] == row['chunk_id']]
+        if expected:
+            retrieved += 1
+            kept += normalize(expected[0]['text']) in normalize(context)
+
+    total_raw = sum(raw_tokens)
+    total_packed = sum(packed_tokens)
+    return {
+        "raw_tokens_avg": total_raw / len(raw_tokens),
+        "packed_tokens_avg": total_packed / len(packed_tokens),
+        "saved_fraction": 1 - total_packed / total_raw if total_raw else 0.0,
+        "ground_truth_retrieved": retrieved,
+        "ground_truth_kept": kept / retrieved if retrieved else 0.0,
+        "merged_chunks": packing_stats["merged_chunks"] - before["merged_chunks"],
+        "duplicate_chunks": packing_stats["duplicate_chunks"] - before["duplicate_chunks"],
+        "pack_p50_ms": percentile(pack_ms, 0.5),
+        "pack_p95_ms": percentile(pack_ms, 0.95),
+    }
+
+
+async def evaluate_answers(ground_truth, hits, budget, model, concurrency):
+    # Answers every question from the unpacked and the packed context and
+    # has the LLM judge both, as the app's evaluation queue does
+    from rag import (
+        build_prompt, PROMPT_TEMPLATE, llm_async, evaluate_relevance_async, close_async_clients,
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(question, prompt):
+        async with semaphore:
+            text, usage = await llm_async(prompt, model=model)
+            if usage is None:
+                return "UNKNOWN", 0
+            evaluation, _ = await evaluate_relevance_async(question, text)
+            if evaluation is None:
+                return "UNKNOWN", usage.prompt_tokens
+            return evaluation.get("Relevance", "UNKNOWN"), usage.prompt_tokens
+
+    try:
+        runs = {}
+        for variant in ("raw", "packed"):
+            prompts = []
+            for row, results in zip(ground_truth, hits):
+                if variant == "raw":
+                    prompt, _ = build_prompt(row['question'], results)
+                else:
+                    context, _, _ = pack_context(results, budget)
+                    prompt = PROMPT_TEMPLATE.format(question=row['question'], context=context).strip()
+                prompts.append(answer(row['question'], prompt))
+            print(f"Answering {len(prompts)} questions from the {variant} context...")
+            outcomes = await asyncio.gather(*prompts)
+            labels = [label for label, _ in outcomes]
+            runs[variant] = {
+                **{label.lower(): labels.count(label) / len(labels) for label in RELEVANCE_LABELS},
+                "prompt_tokens_avg": sum(tokens for _, tokens in outcomes) / len(outcomes),
+            }
+        return runs
+    finally:
+        await close_async_clients()
+
+
+def print_results(packing, answers):
+    print(f"\n{'budget':>7} {'raw':>7} {'packed':>7} {'saved':>7} {'gt_kept':>8} {'merged':>7} {'dupes':>6} {'p50 ms':>7} {'p95 ms':>7}")
+    for budget, result in packing.items():
+        print(
+            f"{budget:>7} {result['raw_tokens_avg']:>7.0f} {result['packed_tokens_avg']:>7.0f} "
+            f"{result['saved_fraction']:>7.1%} {result['ground_truth_kept']:>8.1%} "
+            f"{result['merged_chunks']:>7} {result['duplicate_chunks']:>6} "
+            f"{result['pack_p50_ms']:>7.2f} {result['pack_p95_ms']:>7.2f}"
+        )
+    if answers:
+        print(f"\n{'context':>8} {'relevant':>9} {'partly':>7} {'non':>7} {'unknown':>8} {'prompt':>7}")
+        for variant, result in answers.items():
+            print(
+                f"{variant:>8} {result['relevant']:>9.1%} {result['partly_relevant']:>7.1%} "
+                f"{result['non_relevant']:>7.1%} {result['unknown']:>8.1%} {result['prompt_tokens_avg']:>7.0f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Context packing token savings and answer relevance benchmark")
+    parser.add_argument("--csv", default=GROUND_TRUTH_PATH, help="question,doc_id,chunk_id ground truth")
+    parser.add_argument("--backend", choices=list(RETRIEVERS), default=RETRIEVER_BACKEND)
+    parser.add_argument("--size", type=int, default=5, help="search results per question")
+    parser.add_argument("--budgets", type=parse_list, default=[0, 2000, 1000], help="context token budgets, 0 is unlimited")
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N questions")
+    parser.add_argument("--evaluate", action="store_true", help="also answer and judge relevance with the LLM (costs tokens)")
+    parser.add_argument("--model", default="gpt-4o-mini", help="answer model for --evaluate")
+    parser.add_argument("--evaluate-budget", type=int, default=0, help="context token budget for --evaluate")
+    parser.add_argument("--concurrency", type=int, default=8, help="LLM calls at once for --evaluate")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    retriever = create_retriever(args.backend)
+    ground_truth = load_ground_truth(args.csv, args.limit)
+    print(f"Packing the top {args.size} results of {len(ground_truth)} questions from {args.backend}")
+    hits = retrieve(retriever, ground_truth, args.size)
+
+    packing = {str(budget): evaluate_packing(ground_truth, hits, budget) for budget in args.budgets}
+    answers = None
+    if args.evaluate:
+        answers = asyncio.run(evaluate_answers(ground_truth, hits, args.evaluate_budget, args.model, args.concurrency))
+    print_results(packing, answers)
+
+    if args.output:
+        report = {
+            "backend": args.backend,
+            "questions": len(ground_truth),
+            "size": args.size,
+            "generated_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            "packing": packing,
+            "answers": answers,
+        }
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+from ingest import load_documents, process_documents, clean_html_content, iter_ingest
+
+DATA_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), "data")
+
+
+# The regex cascade clean_html_content replaced, kept as the golden reference
+def legacy_clean_html_content(html):
+    cleaned_text = re.sub(r'^.*?Powered by GitBook', '', html, flags=re.DOTALL)
+    cleaned_text = re.sub(r'^.*?Terms of Service', '', html, flags=re.DOTALL)
+    cleaned_text = re.sub(r'^.*?Disclaimer', '', html, flags=re.DOTALL)
+    cleaned_text = re.sub(r'Previous.*?Last updated.*?$', '', cleaned_text, flags=re.DOTALL)
+    cleaned_text = re.sub(r'\*\*', '', cleaned_text)
+    cleaned_text = re.sub(r'[^\x00-\x7F]+', '', cleaned_text)
+    cleaned_text = re.sub(r'@\w+', '', cleaned_text)
+    cleaned_text = re.sub(r'<[^>]+>', '', cleaned_text)
+    cleaned_text = re.sub(r'\\n', '', cleaned_text)
+    cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
+    return cleaned_text
+
+
+def check_golden_output(documents):
+    mismatches = 0
+    for doc in documents:
+        for field in ('html', 'title'):
+            if clean_html_content(doc[field]) != legacy_clean_html_content(doc[field]):
+                mismatches += 1
+                if mismatches <= 5:
+                    print(f"Mismatch in {doc['source']} ({field}): {doc[field][:80]!r}")
+    if mismatches:
+        raise SystemExit(f"{mismatches} fields cleaned differently from the reference implementation")
+    print(f"Golden output: {len(documents) * 2} fields match the reference implementation")
+
+
+def time_cleaner(cleaner, texts, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        for text in texts:
+            cleaner(text)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_clean_benchmark(documents, repeat):
+    check_golden_output(documents)
+
+    texts = [doc['html'] for doc in documents]
+    megabytes = sum(len(text.encode('utf-8')) for text in texts) / 1e6
+    print(f"\nCleaning {len(texts)} documents ({megabytes:.2f} MB), best of {repeat}")
+    print(f"{'cleaner':>10} {'seconds':>10} {'MB/s':>10}")
+    for name, cleaner in (("legacy", legacy_clean_html_content), ("current", clean_html_content)):
+        elapsed = time_cleaner(cleaner, texts, repeat)
+        print(f"{name:>10} {elapsed:>10.4f} {megabytes / elapsed:>10.2f}")
+
+
+def synthetic_corpus(documents, scale):
+    # Repeat the corpus with distinct titles so every copy gets its own doc_id
+    corpus = []
+    for copy in range(scale):
+        for doc in documents:
+            corpus.append({**doc, 'title': f"{doc['title']} #{copy}"})
+    return corpus
+
+
+def time_processing(documents, workers, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = process_documents(documents, workers=workers)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run_benchmark(name, documents, worker_counts, repeat):
+    print(f"\n{name}: {len(documents)} documents")
+    baseline_time, baseline = time_processing(documents, 1, repeat)
+    rows = [(1, baseline_time, len(baseline))]
+
+    for workers in worker_counts:
+        if workers <= 1:
+            continue
+        elapsed, result = time_processing(documents, workers, repeat)
+        if result != baseline:
+            raise SystemExit(f"Output with {workers} workers differs from the serial output")
+        rows.append((workers, elapsed, len(result)))
+
+    print(f"{'workers':>8} {'seconds':>10} {'docs/sec':>12} {'chunks':>8} {'speedup':>8}")
+    for workers, elapsed, chunks in rows:
+        print(
+            f"{workers:>8} {elapsed:>10.3f} {len(documents) / elapsed:>12.1f} "
+            f"{chunks:>8} {baseline_time / elapsed:>7.2f}x"
+        )
+
+
+def write_synthetic_export(directory_path, megabytes):
+    # Discord-style export written incrementally, so generating it stays cheap
+    os.makedirs(os.path.join(directory_path, 'json'), exist_ok=True)
+    sentence = "Movement brings the Move language to Ethereum with fast finality and shared sequencing. "
+    with open(os.path.join(directory_path, 'json', 'synthetic.json'), 'w', encoding='utf-8') as file:
+        file.write('{"guild": {"name": "bench"}, "messages": [')
+        written = 0
+        i = 0
+        while written < megabytes * 1e6:
+            item = json.dumps({
+                "id": str(i),
+                "content": f"Message {i}. " + sentence * (1 + i % 40),
+                "author": {"name": f"user{i % 50}"},
+            })
+            file.write((',' if i else '') + item)
+            written += len(item) + 1
+            i += 1
+        file.write(']}')
+
+
+def measure_stream(directory_path, workers):
+    # Run in a child process so each corpus size gets its own peak RSS
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "stream-child", "--data", directory_path, "--workers", str(workers)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_stream_child(directory_path, workers):
+    start_time = time.perf_counter()
+    first_chunk = None
+    chunks = 0
+    for _ in iter_ingest(directory_path, workers=workers):
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start_time
+        chunks += 1
+    print(json.dumps({
+        "chunks": chunks,
+        "seconds": time.perf_counter() - start_time,
+        "first_chunk": first_chunk,
+        # ru_maxrss is in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def run_stream_benchmark(sizes, workers):
+    print(f"{'corpus MB':>10} {'chunks':>10} {'seconds':>10} {'first chunk':>12} {'peak RSS MB':>12}")
+    for megabytes in sizes:
+        with tempfile.TemporaryDirectory() as directory_path:
+            write_synthetic_export(directory_path, megabytes)
+            result = measure_stream(directory_path, workers)
+        print(
+            f"{megabytes:>10} {result['chunks']:>10} {result['seconds']:>10.2f} "
+            f"{result['first_chunk']:>11.3f}s {result['peak_rss_mb']:>12.1f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark document cleaning and processing")
+    parser.add_argument("mode", nargs="?", choices=["process", "clean", "stream", "stream-child"], default="process",
+                        help="process: serial vs process-pool processing; clean: cleaner golden check and MB/s; "
+                             "stream: peak RSS of the streaming pipeline as the corpus grows")
+    parser.add_argument("--sizes", default="10,50,200", help="comma-separated synthetic corpus sizes in MB for stream mode")
+    parser.add_argument("--data", default=DATA_DIRECTORY, help="directory containing json/")
+    parser.add_argument("--workers", default=f"1,2,4,{os.cpu_count()}", help="comma-separated worker counts")
+    parser.add_argument("--scale", type=int, default=100, help="size multiplier for the synthetic corpus")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per configuration, best time is reported")
+    args = parser.parse_args()
+
+    worker_counts = sorted({int(w) for w in args.workers.split(",")})
+
+    if args.mode == "stream-child":
+        run_stream_child(args.data, worker_counts[-1])
+        return
+    if args.mode == "stream":
+        run_stream_benchmark([int(size) for size in args.sizes.split(",")], worker_counts[0])
+        return
+
+    documents = load_documents(args.data)
+
+    if args.mode == "clean":
+        run_clean_benchmark(documents, max(args.repeat, 5))
+        return
+
+    run_benchmark("Bundled corpus", documents, worker_counts, args.repeat)
+    run_benchmark(f"Synthetic corpus ({args.scale}x)", synthetic_corpus(documents, args.scale), worker_counts, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
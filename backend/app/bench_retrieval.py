@@ -0,0 +1,229 @@
+import os
+import csv
+import json
+import time
+import asyncio
+import argparse
+from search import RETRIEVER_BACKEND, RETRIEVERS, create_retriever
+from inprocess import INPROCESS_INDEX_PATH
+from rerank import RERANK_MODEL, RERANK_CANDIDATES, RERANK_BUDGET_MS, Reranker, RerankingRetriever
+from paths import DATA_DIRECTORY
+
+GROUND_TRUTH_PATH = os.path.join(DATA_DIRECTORY, "ground-truth-retrieval.csv")
+RETRIEVAL_MODES = ("bm25", "knn", "hybrid")
+
+
+def load_ground_truth(path, limit=0):
+    with open(path, 'r', encoding='utf-8') as file:
+        rows = list(csv.DictReader(file))
+    return rows[:limit] if limit else rows
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def first_rank(results, field, expected):
+    for rank, doc in enumerate(results, start=1):
+        if doc[field] == expected:
+            return rank
+    return None
+
+
+def evaluate_quality(retriever, ground_truth, sizes):
+    # One search per question at the largest size; the metrics at smaller
+    # sizes are read off the same ranking
+    ranks = []
+    for row in ground_truth:
+        results = retriever.search(row['question'], max(sizes))
+        ranks.append((first_rank(results, 'doc_id', row['doc_id']), first_rank(results, 'chunk_id', row['chunk_id'])))
+
+    total = len(ranks)
+    quality = {}
+    for size in sizes:
+        doc_ranks = [doc_rank for doc_rank, _ in ranks if doc_rank and doc_rank <= size]
+        chunk_ranks = [chunk_rank for _, chunk_rank in ranks if chunk_rank and chunk_rank <= size]
+        quality[str(size)] = {
+            "hit_rate": len(doc_ranks) / total,
+            "mrr": sum(1 / rank for rank in doc_ranks) / total,
+            "chunk_hit_rate": len(chunk_ranks) / total,
+            "chunk_mrr": sum(1 / rank for rank in chunk_ranks) / total,
+        }
+    return quality
+
+
+async def measure_latency(retriever, questions, size, concurrency):
+    # concurrency workers take questions off a shared list until it is
+    # empty, the way concurrent /question requests reach the retriever
+    pending = list(reversed(questions))
+    latencies = []
+
+    async def worker():
+        while pending:
+            question = pending.pop()
+            start_time = time.perf_counter()
+            await retriever.search_async(question, size)
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start_time
+    return {
+        "queries": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "queries_per_sec": len(latencies) / elapsed,
+    }
+
+
+async def evaluate_latency(retriever, questions, size, concurrency_levels, warmup):
+    # The async client belongs to this event loop, so it is closed here
+    try:
+        # Warm up connections, the query embedder and fuzzy expansions
+        for question in questions[:warmup]:
+            await retriever.search_async(question, size)
+        return {
+            str(concurrency): await measure_latency(retriever, questions, size, concurrency)
+            for concurrency in concurrency_levels
+        }
+    finally:
+        await retriever.close()
+
+
+def run_benchmark(retriever, modes, ground_truth, args):
+    questions = [row['question'] for row in ground_truth]
+    results = {}
+    for mode in modes:
+        retriever.mode = mode
+        if mode != "bm25" and retriever.get_query_embedder() is None:
+            print(f"Skipping {mode}: the index has no embeddings (rebuild with prep.py --embeddings)")
+            continue
+        runs = [(mode, retriever)]
+        if args.rerank:
+            # Without a score cache, so every search pays for its scoring
+            reranker = Reranker(args.rerank_model, args.rerank_budget_ms, cache_size=0)
+            runs.append((f"{mode}+rerank", RerankingRetriever(retriever, reranker, args.rerank_candidates)))
+        for name, run_retriever in runs:
+            print(f"Running {name}...")
+            results[name] = {
+                "quality": evaluate_quality(run_retriever, ground_truth, args.sizes),
+                "latency": asyncio.run(evaluate_latency(run_retriever, questions, args.latency_size, args.concurrency, args.warmup)),
+            }
+            if run_retriever is not retriever:
+                results[name]["rerank"] = run_retriever.reranker.snapshot()
+    return results
+
+
+def print_results(results):
+    print(f"\n{'mode':>14} {'size':>5} {'hit_rate':>9} {'mrr':>7} {'chunk_hit':>10} {'chunk_mrr':>10}")
+    for mode, result in results.items():
+        for size, quality in result["quality"].items():
+            print(
+                f"{mode:>14} {size:>5} {quality['hit_rate']:>9.3f} {quality['mrr']:>7.3f} "
+                f"{quality['chunk_hit_rate']:>10.3f} {quality['chunk_mrr']:>10.3f}"
+            )
+
+    print(f"\n{'mode':>14} {'conc':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'q/s':>9}")
+    for mode, result in results.items():
+        for concurrency, latency in result["latency"].items():
+            print(
+                f"{mode:>14} {concurrency:>5} {latency['p50_ms']:>8.2f} {latency['p95_ms']:>8.2f} "
+                f"{latency['p99_ms']:>8.2f} {latency['queries_per_sec']:>9.1f}"
+            )
+
+    for mode, result in results.items():
+        if "rerank" in result:
+            rerank = result["rerank"]
+            print(
+                f"\n{mode}: {rerank['scorer']} scorer, {rerank['reranked']} of {rerank['questions']} searches reranked, "
+                f"{rerank['over_budget']} over the {rerank['budget_ms']:g} ms budget"
+            )
+
+
+def compare_results(results, baseline, max_quality_drop, max_latency_increase):
+    # Only modes, sizes and concurrency levels present in both runs count
+    regressions = []
+    for mode, result in results.items():
+        previous = baseline["results"].get(mode)
+        if previous is None:
+            continue
+        for size, quality in result["quality"].items():
+            for metric in ("hit_rate", "mrr"):
+                before = previous["quality"].get(size, {}).get(metric)
+                if before is not None and before - quality[metric] > max_quality_drop:
+                    regressions.append(f"{mode} {metric}@{size}: {before:.3f} -> {quality[metric]:.3f}")
+        for concurrency, latency in result["latency"].items():
+            before = previous["latency"].get(concurrency, {}).get("p95_ms")
+            if before is not None and latency["p95_ms"] > before * (1 + max_latency_increase):
+                regressions.append(f"{mode} p95 at concurrency {concurrency}: {before:.2f} ms -> {latency['p95_ms']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval quality and latency benchmark")
+    parser.add_argument("--csv", default=GROUND_TRUTH_PATH, help="question,doc_id,chunk_id ground truth")
+    parser.add_argument("--backend", choices=list(RETRIEVERS), default=RETRIEVER_BACKEND)
+    parser.add_argument("--build", action="store_true", help="build the in-process index from data/ before running")
+    parser.add_argument("--modes", default=",".join(RETRIEVAL_MODES), help="comma separated retrieval modes")
+    parser.add_argument("--sizes", type=parse_list, default=[1, 3, 5, 10], help="result sizes for hit rate and MRR")
+    parser.add_argument("--latency-size", type=int, default=5, help="result size used for the latency runs")
+    parser.add_argument("--concurrency", type=parse_list, default=[1, 4, 16], help="concurrent searches for the latency runs")
+    parser.add_argument("--warmup", type=int, default=50, help="searches run before timing")
+    parser.add_argument("--limit", type=int, default=0, help="only use the first N questions")
+    parser.add_argument("--rerank", action="store_true", help="also run every mode with reranking")
+    parser.add_argument("--rerank-model", default=RERANK_MODEL, help="CrossEncoder name or path, empty for the lexical scorer")
+    parser.add_argument("--rerank-candidates", type=int, default=RERANK_CANDIDATES, help="hits fetched per question for reranking")
+    parser.add_argument("--rerank-budget-ms", type=float, default=RERANK_BUDGET_MS, help="rerank latency budget, 0 is unlimited")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of an earlier run; exit 1 on regressions")
+    parser.add_argument("--max-quality-drop", type=float, default=0.01, help="allowed absolute drop in hit rate or MRR")
+    parser.add_argument("--max-latency-increase", type=float, default=0.5, help="allowed relative increase in p95 latency")
+    args = parser.parse_args()
+
+    if args.build:
+        # Imported here because ingestion needs the dev dependencies
+        from ingest import iter_ingest
+        from inprocess import build_index
+        build_index(iter_ingest(DATA_DIRECTORY), INPROCESS_INDEX_PATH)
+
+    retriever = create_retriever(args.backend)
+    ground_truth = load_ground_truth(args.csv, args.limit)
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    index_version = retriever.index_version()
+    print(f"Evaluating {len(ground_truth)} questions against {args.backend} index {index_version}")
+
+    results = run_benchmark(retriever, modes, ground_truth, args)
+    print_results(results)
+
+    report = {
+        "backend": args.backend,
+        "index": index_version,
+        "questions": len(ground_truth),
+        "generated_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        regressions = compare_results(results, baseline, args.max_quality_drop, args.max_latency_increase)
+        if regressions:
+            print(f"\n{len(regressions)} regressions against {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            raise SystemExit(1)
+        print(f"\nNo regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
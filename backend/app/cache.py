@@ -0,0 +1,399 @@
+import os
+import re
+import copy
+import math
+import json
+import time
+import queue
+import asyncio
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# 0 entries disables the cache
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+# Optional sqlite file so cached answers survive restarts
+CACHE_PATH = os.getenv("CACHE_PATH", "")
+# Jaccard similarity above which a different question counts as a hit,
+# 0 disables near-duplicate lookup
+CACHE_SIMILARITY = float(os.getenv("CACHE_SIMILARITY", "0"))
+# "tokens" compares word sets, "chars" compares character trigrams
+CACHE_SIMILARITY_MODE = os.getenv("CACHE_SIMILARITY_MODE", "tokens")
+# Seconds between checks of the search index version; a new version, e.g.
+# after prep.py swaps the alias, clears the cache
+CACHE_INDEX_CHECK_INTERVAL = float(os.getenv("CACHE_INDEX_CHECK_INTERVAL", "10"))
+
+NORMALIZE_PATTERN = re.compile(r"[^a-z0-9]+")
+
+
+def normalize_question(question):
+    return NORMALIZE_PATTERN.sub(" ", question.lower()).strip()
+
+
+def question_features(normalized, mode=CACHE_SIMILARITY_MODE):
+    if mode == "chars":
+        padded = f" {normalized} "
+        return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(normalized.split())
+
+
+def make_key(question, model, source=None, size=3):
+    return (model, source or "", size, normalize_question(question))
+
+
+def as_cache_hit(question, cached):
+    # Nothing was spent on a stored answer, so it is billed at zero and the
+    # avoided spend is reported alongside
+    result = copy.deepcopy(cached)
+    saved_tokens = cached["total_tokens"] + cached["eval_total_tokens"]
+    result.update({
+        "query": question,
+        "response_time": 0.0,
+        "retrieval_time": 0.0,
+        "prompt_time": 0.0,
+        "evaluation_time": None,
+        "context_tokens": 0,
+        "context_tokens_saved": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0,
+        "eval_prompt_tokens": 0,
+        "eval_completion_tokens": 0,
+        "eval_total_tokens": 0,
+        "openai_cost": 0,
+        "cache_hit": True,
+        "saved_tokens": saved_tokens,
+        "saved_cost": cached["openai_cost"],
+    })
+    return result
+
+
+class ResponseCache:
+    # Answers keyed on normalized question text plus model, source filter and
+    # result size. Entries live in an OrderedDict kept in LRU order, expire
+    # after ttl seconds and are evicted beyond max_entries. Once started, a
+    # background thread owns the optional sqlite file: it writes entries,
+    # reloads them on start and checks the search index version, clearing
+    # the cache when the index behind the answers changes. Disk reads on the
+    # request path go through asyncio.to_thread, so sqlite never runs on the
+    # event loop.
+
+    def __init__(
+        self,
+        max_entries=CACHE_MAX_ENTRIES,
+        ttl=CACHE_TTL,
+        path=CACHE_PATH,
+        similarity=CACHE_SIMILARITY,
+        similarity_mode=CACHE_SIMILARITY_MODE,
+        index_check_interval=CACHE_INDEX_CHECK_INTERVAL,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.similarity = similarity
+        self.similarity_mode = similarity_mode
+        self.index_check_interval = index_check_interval
+        self.entries = OrderedDict()
+        # (model, source, size, feature) -> keys of the entries with that
+        # feature, so near-duplicate lookup only scores entries sharing one
+        self.postings = {}
+        self.lock = threading.Lock()
+        self.db = None
+        self.disk_lock = threading.Lock()
+        self.writes = queue.Queue()
+        self.thread = None
+        self.index_source = None
+        self.index_version = None
+        self.stats = {
+            "hits": 0,
+            "near_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expired": 0,
+            "index_changes": 0,
+            "saved_tokens": 0,
+            "saved_cost": 0.0,
+        }
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def start(self, index_source=None):
+        # index_source returns the version of the index answers come from
+        if not self.enabled or self.thread is not None:
+            return
+        self.index_source = index_source
+        self.thread = threading.Thread(target=self._run, name="response-cache", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        # Writes still queued are flushed first
+        if self.thread is None:
+            return
+        self.writes.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        if self.path:
+            try:
+                self._open_disk()
+            except Exception as e:
+                print(f"Error opening the response cache at {self.path}: {e}")
+        self._switch_index(self._current_index())
+        next_check = time.monotonic() + self.index_check_interval
+        while True:
+            timeout = None
+            if self.index_source is not None:
+                timeout = max(next_check - time.monotonic(), 0)
+            try:
+                item = self.writes.get(timeout=timeout)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if item:
+                try:
+                    self._write(item)
+                except Exception as e:
+                    print(f"Error writing the response cache: {e}")
+            if self.index_source is not None and time.monotonic() >= next_check:
+                version = self._current_index()
+                if version != self.index_version:
+                    self._switch_index(version)
+                next_check = time.monotonic() + self.index_check_interval
+        if self.db is not None:
+            with self.disk_lock:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+    def _current_index(self):
+        if self.index_source is None:
+            return None
+        try:
+            return self.index_source()
+        except Exception as e:
+            print(f"Error reading the index version for the response cache: {e}")
+            return self.index_version
+
+    def _open_disk(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(responses)")]
+        if columns and "index_version" not in columns:
+            # Written before entries carried their index; nothing to reuse
+            db.execute("DROP TABLE responses")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, index_version TEXT, stored_at REAL NOT NULL, result TEXT NOT NULL)"
+        )
+        db.execute("DELETE FROM responses WHERE stored_at < ?", (time.time() - self.ttl,))
+        db.commit()
+        with self.disk_lock:
+            self.db = db
+
+    def _switch_index(self, version):
+        # Answers from another index are never served: memory is emptied and
+        # the disk keeps only entries of this index, which warm the memory
+        # tier so near-duplicate lookup works straight after a restart
+        with self.lock:
+            if self.index_version is not None and version != self.index_version:
+                self.stats["index_changes"] += 1
+                print(f"Search index is now {version}, response cache cleared")
+            self.index_version = version
+            self._clear_memory()
+        if self.db is None:
+            return
+        with self.disk_lock:
+            self.db.execute("DELETE FROM responses WHERE index_version IS NOT ?", (version,))
+            self.db.commit()
+            rows = self.db.execute(
+                "SELECT key, stored_at, result FROM responses ORDER BY stored_at DESC LIMIT ?",
+                (self.max_entries,),
+            ).fetchall()
+        with self.lock:
+            if self.index_version == version:
+                for key, stored_at, result in reversed(rows):
+                    self._remember(json.loads(key), stored_at, json.loads(result))
+        print(f"Loaded {len(rows)} cached responses from {self.path}")
+
+    def _write(self, item):
+        if self.db is None:
+            return
+        with self.disk_lock:
+            if item[0] == "put":
+                _, key, version, stored_at, result = item
+                self.db.execute(
+                    "INSERT OR REPLACE INTO responses (key, index_version, stored_at, result) VALUES (?, ?, ?, ?)",
+                    (json.dumps(key), version, stored_at, json.dumps(result)),
+                )
+            else:
+                self.db.execute("DELETE FROM responses")
+            # One commit for a burst of writes
+            if self.writes.empty():
+                self.db.commit()
+
+    def _read_disk(self, key, version):
+        with self.disk_lock:
+            if self.db is None:
+                return None
+            return self.db.execute(
+                "SELECT stored_at, result FROM responses WHERE key = ? AND index_version IS ?",
+                (json.dumps(key), version),
+            ).fetchone()
+
+    def _remember(self, key, stored_at, result):
+        key = tuple(key)
+        features = question_features(key[3], self.similarity_mode) if self.similarity > 0 else None
+        if key not in self.entries and features:
+            for feature in features:
+                self.postings.setdefault(key[:3] + (feature,), set()).add(key)
+        self.entries[key] = (stored_at, result, features)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self._forget(next(iter(self.entries)))
+            self.stats["evictions"] += 1
+
+    def _forget(self, key):
+        _, _, features = self.entries.pop(key)
+        for feature in features or ():
+            posting_key = key[:3] + (feature,)
+            keys = self.postings[posting_key]
+            keys.discard(key)
+            if not keys:
+                del self.postings[posting_key]
+
+    def _clear_memory(self):
+        self.entries.clear()
+        self.postings.clear()
+
+    def _lookup_memory(self, key, now):
+        entry = self.entries.get(key)
+        if entry is not None:
+            if now - entry[0] <= self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self._forget(key)
+            self.stats["expired"] += 1
+        return None
+
+    def _accept_disk(self, key, version, row, now):
+        if row is None or now - row[0] > self.ttl or version != self.index_version:
+            return None
+        result = json.loads(row[1])
+        self._remember(key, row[0], result)
+        self.stats["disk_hits"] += 1
+        return result
+
+    def _lookup_similar(self, key, now):
+        if self.similarity <= 0:
+            return None
+        features = question_features(key[3], self.similarity_mode)
+        if not features:
+            return None
+        # An entry reaching the threshold shares at least similarity * |features|
+        # features, so it has one of the rarest |features| - that + 1 of them:
+        # only entries of the same model, source and size found that way are
+        # scored
+        postings = [self.postings.get(key[:3] + (feature,), ()) for feature in features]
+        needed = math.ceil(self.similarity * len(features) - 1e-9)
+        candidates = set().union(*sorted(postings, key=len)[:len(features) - needed + 1])
+        best_key, best_score, best_stored_at = None, self.similarity, None
+        for other_key in candidates:
+            stored_at, _, other_features = self.entries[other_key]
+            if now - stored_at > self.ttl:
+                continue
+            common = len(features & other_features)
+            score = common / (len(features) + len(other_features) - common)
+            # Ties go to the most recently stored answer
+            if score > best_score or (score == best_score and (best_stored_at is None or stored_at > best_stored_at)):
+                best_key, best_score, best_stored_at = other_key, score, stored_at
+        if best_key is None:
+            return None
+        self.entries.move_to_end(best_key)
+        self.stats["near_hits"] += 1
+        return self.entries[best_key][1]
+
+    def _finish(self, question, key, now, cached):
+        with self.lock:
+            if cached is None:
+                cached = self._lookup_similar(key, now)
+            if cached is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["saved_tokens"] += cached["total_tokens"] + cached["eval_total_tokens"]
+            self.stats["saved_cost"] += cached["openai_cost"]
+        return as_cache_hit(question, cached)
+
+    def get(self, question, model, source=None, size=3):
+        # For threads; the event loop uses get_async
+        if not self.enabled:
+            return None
+        key = make_key(question, model, source, size)
+        now = time.time()
+        with self.lock:
+            cached = self._lookup_memory(key, now)
+            version = self.index_version
+        if cached is None and self.db is not None:
+            row = self._read_disk(key, version)
+            with self.lock:
+                cached = self._accept_disk(key, version, row, now)
+        return self._finish(question, key, now, cached)
+
+    async def get_async(self, question, model, source=None, size=3):
+        if not self.enabled:
+            return None
+        key = make_key(question, model, source, size)
+        now = time.time()
+        with self.lock:
+            cached = self._lookup_memory(key, now)
+            version = self.index_version
+        if cached is None and self.db is not None:
+            row = await asyncio.to_thread(self._read_disk, key, version)
+            with self.lock:
+                cached = self._accept_disk(key, version, row, now)
+        if cached is None and self.similarity > 0:
+            # Scoring near-duplicates is CPU work, done off the event loop
+            return await asyncio.to_thread(self._finish, question, key, now, cached)
+        return self._finish(question, key, now, cached)
+
+    def put(self, question, model, source, size, result):
+        if not self.enabled or not result.get("answer"):
+            return
+        key = make_key(question, model, source, size)
+        now = time.time()
+        # Callers go on to modify the result they return, so keep a copy
+        result = copy.deepcopy(result)
+        with self.lock:
+            self._remember(key, now, result)
+            version = self.index_version
+        if self.path and self.thread is not None:
+            self.writes.put(("put", key, version, now, result))
+
+    def clear(self):
+        with self.lock:
+            self._clear_memory()
+        if self.path and self.thread is not None:
+            self.writes.put(("clear",))
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["near_hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            return {
+                "enabled": self.enabled,
+                "index": self.index_version,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "pending_writes": self.writes.qsize(),
+                **self.stats,
+                "hit_rate": (lookups - self.stats["misses"]) / lookups if lookups else 0.0,
+            }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,188 @@
+import os
+import re
+from tokens import count_tokens
+
+# Packs retrieved chunks into the LLM context: neighbouring chunks of a
+# document are merged without their overlap, repeated text is dropped and
+# the result is fitted to the model's token budget. Off by default, which
+# sends every hit in full under the original per-chunk headers, until
+# bench_context.py --evaluate shows answer relevance holds with it on.
+CONTEXT_PACKING = os.getenv("CONTEXT_PACKING", "0") == "1"
+# Upper bound on retrieved context tokens sent to the LLM, 0 disables it
+MAX_CONTEXT_TOKENS = int(os.getenv("MAX_CONTEXT_TOKENS", "0"))
+# Per-model budgets that override MAX_CONTEXT_TOKENS, e.g.
+# "gpt-4o-mini=3000,gpt-4o=6000"
+CONTEXT_TOKEN_BUDGETS = os.getenv("CONTEXT_TOKEN_BUDGETS", "")
+# A document that does not fit is cut to what is left of the budget, unless
+# less than this remains
+CONTEXT_MIN_SECTION_TOKENS = int(os.getenv("CONTEXT_MIN_SECTION_TOKENS", "50"))
+
+# Longest overlap looked for between neighbouring chunks: chunk_text repeats
+# 20 words, chunk_text_tokens up to CHUNK_OVERLAP_TOKENS worth of sentences
+MAX_OVERLAP_WORDS = 100
+WORD_PATTERN = re.compile(r"\S+")
+
+packing_stats = {
+    "requests": 0,
+    "raw_tokens": 0,
+    "packed_tokens": 0,
+    "merged_chunks": 0,
+    "duplicate_chunks": 0,
+    "truncated_documents": 0,
+    "dropped_documents": 0,
+}
+
+
+def parse_budgets(value):
+    budgets = {}
+    for item in value.split(","):
+        if item.strip():
+            model, _, tokens = item.partition("=")
+            budgets[model.strip()] = int(tokens)
+    return budgets
+
+MODEL_BUDGETS = parse_budgets(CONTEXT_TOKEN_BUDGETS)
+
+def context_budget(model):
+    return MODEL_BUDGETS.get(model, MAX_CONTEXT_TOKENS)
+
+
+def format_hits(search_results):
+    # The unpacked layout: every hit in full under its own headers
+    return "\n\n".join([
+        f"Document ID: {doc['doc_id']}\n"
+        f"Chunk ID: {doc['chunk_id']}\n"
+        f"Title: {doc['title']}\n"
+        f"URL: {doc['url']}\n"
+        f"Content: {doc['text']}"
+        for doc in search_results
+    ])
+
+def chunk_index(doc):
+    # chunk_id is "<doc_id>_<position in the document>"
+    _, _, index = doc["chunk_id"].rpartition("_")
+    return int(index) if index.isdigit() else None
+
+def overlap_size(previous, following, max_words=MAX_OVERLAP_WORDS):
+    # Longest run of words that ends previous and starts following
+    for size in range(min(len(previous), len(following), max_words), 0, -1):
+        if previous[-size] == following[0] and previous[-size:] == following[:size]:
+            return size
+    return 0
+
+def drop_words(text, count):
+    # text without its first count words, keeping the rest's whitespace
+    if count == 0:
+        return text
+    for position, match in enumerate(WORD_PATTERN.finditer(text)):
+        if position == count:
+            return text[match.start():]
+    return ""
+
+def merge_chunks(chunks):
+    # chunks of one document, in document order. Returns its passages:
+    # neighbouring chunks are joined into one with the repeated words
+    # removed, chunks with a gap between them stay separate.
+    passages = []
+    previous_index = previous_words = None
+    merged = 0
+    for doc in chunks:
+        index = chunk_index(doc)
+        words = doc["text"].split()
+        if passages and index is not None and previous_index is not None and index == previous_index + 1:
+            overlap = overlap_size(previous_words, words)
+            # Word chunks overlap within a paragraph, token chunks only
+            # overlap when they cut through one
+            separator = " " if overlap else "\n\n"
+            passages[-1] += separator + drop_words(doc["text"], overlap)
+            merged += 1
+        else:
+            passages.append(doc["text"])
+        previous_index, previous_words = index, words
+    return passages, merged
+
+def truncate(text, max_tokens):
+    # Longest prefix of whole words within max_tokens
+    ends = [match.end() for match in WORD_PATTERN.finditer(text)]
+    low, high = 0, len(ends)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:ends[middle - 1]]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return text[:ends[low - 1]] if low else ""
+
+
+def pack_context(search_results, max_tokens=MAX_CONTEXT_TOKENS):
+    # Returns the context, the hits it draws on and a report of what
+    # packing saved against format_hits. Documents are ordered by their best
+    # ranked hit and introduced once by title and URL.
+    raw_tokens = count_tokens(format_hits(search_results))
+
+    documents = {}
+    seen = []
+    duplicates = 0
+    for doc in search_results:
+        normalized = " ".join(doc["text"].split()).lower()
+        # Exact repeats and chunks contained in a better ranked one, e.g. the
+        # same page ingested from two sources
+        if any(normalized in other for other in seen):
+            duplicates += 1
+            continue
+        seen.append(normalized)
+        documents.setdefault((doc["doc_id"], doc.get("source")), []).append(doc)
+
+    sections = []
+    merged = 0
+    for chunks in documents.values():
+        ordered = sorted(chunks, key=lambda doc: chunk_index(doc) or 0)
+        passages, merged_chunks = merge_chunks(ordered)
+        merged += merged_chunks
+        sections.append((chunks, passages))
+
+    parts = []
+    used_hits = []
+    used = 0
+    truncated = dropped = 0
+    for chunks, passages in sections:
+        header = f"[{len(parts) + 1}] {chunks[0]['title']}"
+        if chunks[0]['url']:
+            header += f" ({chunks[0]['url']})"
+        body = "\n\n".join(passages)
+        section = f"{header}\n{body}"
+        # Without a budget the context is only counted once, at the end
+        tokens = count_tokens(section) if max_tokens > 0 else 0
+        if max_tokens > 0 and used + tokens > max_tokens:
+            remaining = max_tokens - used - count_tokens(header) - 1
+            # The best ranked document is always sent, cut if need be, unless
+            # not even its header fits
+            if remaining <= 0 or (parts and remaining < CONTEXT_MIN_SECTION_TOKENS):
+                dropped += 1
+                continue
+            cut = truncate(body, remaining)
+            # Not even the first word fits, and a bare header says nothing
+            if not cut:
+                dropped += 1
+                continue
+            section = f"{header}\n{cut}"
+            tokens = count_tokens(section)
+            truncated += 1
+        parts.append(section)
+        used_hits.extend(chunks)
+        used += tokens
+
+    context = "\n\n".join(parts)
+    context_tokens = count_tokens(context)
+    packing = {
+        "context_tokens": context_tokens,
+        "context_tokens_saved": max(raw_tokens - context_tokens, 0),
+    }
+    packing_stats["requests"] += 1
+    packing_stats["raw_tokens"] += raw_tokens
+    packing_stats["packed_tokens"] += context_tokens
+    packing_stats["merged_chunks"] += merged
+    packing_stats["duplicate_chunks"] += duplicates
+    packing_stats["truncated_documents"] += truncated
+    packing_stats["dropped_documents"] += dropped
+    return context, used_hits, packing
@@ -1,8 +1,13 @@
 import os
+import time
+import threading
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, execute_values
+from psycopg2.pool import PoolError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 from datetime import datetime
 from zoneinfo import ZoneInfo
+from metrics import db_errors
 
 
 RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
@@ -10,83 +15,214 @@ RUN_TIMEZONE_CHECK = os.getenv('RUN_TIMEZONE_CHECK', '1') == '1'
 TZ_INFO = os.getenv("TZ", "Europe/Berlin")
 tz = ZoneInfo(TZ_INFO)
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# Seconds a caller waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+# Connections idle for longer than this are checked with SELECT 1 before reuse
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("DB_POOL_HEALTHCHECK_INTERVAL", "30"))
+# Load testing without PostgreSQL: batches are dropped after sleeping
+# DB_FAKE_LATENCY seconds, standing in for the blocking write
+DB_DISABLED = os.getenv("DB_DISABLED", "0") == "1"
+DB_FAKE_LATENCY = float(os.getenv("DB_FAKE_LATENCY", "0"))
 
 
+def get_connection_params():
+    return {
+        "host": os.getenv("POSTGRES_HOST", "postgres"),
+        "database": os.getenv("POSTGRES_DB", "parthenon"),
+        "user": os.getenv("POSTGRES_USER", "your_username"),
+        "password": os.getenv("POSTGRES_PASSWORD", "your_password"),
+    }
 
-def get_db_connection():
-    host=os.getenv("POSTGRES_HOST", "postgres")
-    database = os.getenv("POSTGRES_DB", "parthenon")
-    user = os.getenv("POSTGRES_USER", "your_username")
-    password = os.getenv("POSTGRES_PASSWORD", "your_password")
 
-    # Print database connection parameters
-    print(f"Database Host: {host}")
-    print(f"Database Name: {database}")
-    print(f"Database User: {user}")
+class ConnectionPool:
+    # Process-wide connection pool. Callers wait (up to timeout) for one of
+    # maxconn slots, minconn connections are opened up front and every
+    # connection that comes back healthy is kept idle for reuse, so bursts do
+    # not reopen connections. Idle connections are health-checked before
+    # reuse, and broken connections are discarded and replaced.
 
-    try:
-        connection = psycopg2.connect(
-            host=host,
-            database=database,
-            user=user,
-            password=password,
-        )
-        print(f"Successfully connected to the database at {host}")
-        return connection
-    except Exception as e:
-        print(f"Error connecting to the database: {e}")
-        raise
+    def __init__(
+        self,
+        minconn=DB_POOL_MIN,
+        maxconn=DB_POOL_MAX,
+        timeout=DB_POOL_TIMEOUT,
+        healthcheck_interval=DB_POOL_HEALTHCHECK_INTERVAL,
+    ):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._params = None
+        self._idle = []
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._returned_at = {}
+        self.in_use = 0
+        self.stats = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "reconnects": 0,
+        }
 
+    def _open(self):
+        # Opened lazily so importing db.py never needs a reachable database
+        with self._open_lock:
+            if self._params is None:
+                params = get_connection_params()
+                connections = [psycopg2.connect(**params) for _ in range(self.minconn)]
+                with self._lock:
+                    self._idle.extend(connections)
+                self._params = params
+                print(f"Connected to the database at {params['host']} (pool {self.minconn}-{self.maxconn})")
+            return self._params
 
-def init_db():
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            print("Dropping tables if they exist...")
-            cur.execute("DROP TABLE IF EXISTS feedback")
-            cur.execute("DROP TABLE IF EXISTS conversations")
-
-            print("Creating tables...")
-            cur.execute("""
-                CREATE TABLE conversations (
-                    id TEXT PRIMARY KEY,
-                    question TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    model_used TEXT NOT NULL,
-                    response_time FLOAT NOT NULL,
-                    relevance TEXT NOT NULL,
-                    relevance_explanation TEXT NOT NULL,
-                    prompt_tokens INTEGER NOT NULL,
-                    completion_tokens INTEGER NOT NULL,
-                    total_tokens INTEGER NOT NULL,
-                    eval_prompt_tokens INTEGER NOT NULL,
-                    eval_completion_tokens INTEGER NOT NULL,
-                    eval_total_tokens INTEGER NOT NULL,
-                    openai_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE feedback (
-                    id SERIAL PRIMARY KEY,
-                    conversation_id TEXT REFERENCES conversations(id),
-                    feedback INTEGER NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
-            """)
-            print("Tables created successfully.")
-        conn.commit()
-    except Exception as e:
-        print(f"Error initializing database: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+    def _take(self, params):
+        # The most recently returned connection, or a new one. Holding a slot
+        # keeps the open connections within maxconn.
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return psycopg2.connect(**params)
+
+    def _discard(self, conn):
+        self._returned_at.pop(id(conn), None)
+        if not conn.closed:
+            conn.close()
+        with self._lock:
+            self.stats["reconnects"] += 1
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        returned_at = self._returned_at.get(id(conn))
+        # Freshly opened connections skip the check
+        if returned_at is None or time.monotonic() - returned_at < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        start_time = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.stats["timeouts"] += 1
+            raise PoolError(f"No database connection available after {self.timeout}s")
+        waited = time.perf_counter() - start_time
+
+        try:
+            params = self._open()
+            conn = self._take(params)
+            # After a database restart every idle connection may be dead, so
+            # keep discarding until a healthy or freshly opened one turns up
+            for _ in range(self.maxconn):
+                if self._is_healthy(conn):
+                    break
+                self._discard(conn)
+                conn = self._take(params)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self.in_use += 1
+            self.stats["acquired"] += 1
+            if waited > 0.001:
+                self.stats["waited"] += 1
+            self.stats["wait_time_total"] += waited
+            self.stats["wait_time_max"] = max(self.stats["wait_time_max"], waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        try:
+            if not close and not conn.closed and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+            # A closed or broken connection is dropped; a fresh one is opened
+            # on the next getconn
+            close = close or conn.closed or conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN
+            # or one that outlived closeall
+            close = close or self._params is None
+            if close:
+                self._discard(conn)
+            else:
+                self._returned_at[id(conn)] = time.monotonic()
+                with self._lock:
+                    self._idle.append(conn)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+            self._slots.release()
+
+    def snapshot(self):
+        with self._lock:
+            acquired = self.stats["acquired"]
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "in_use": self.in_use,
+                "idle": len(self._idle),
+                **self.stats,
+                "wait_time_avg": self.stats["wait_time_total"] / acquired if acquired else 0.0,
+            }
+
+    def closeall(self):
+        # Connections still in use are kept when they come back
+        with self._open_lock, self._lock:
+            for conn in self._idle:
+                if not conn.closed:
+                    conn.close()
+            self._idle.clear()
+            self._returned_at.clear()
+            self._params = None
+
+
+db_pool = ConnectionPool()
+
+
+def conversation_row(conversation_id, question, answer_data, timestamp):
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data["relevance"],
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        answer_data["openai_cost"],
+        timestamp,
+        # Stage timings in seconds; answers stored before they were
+        # recorded have none. persistence_time is added by the writer.
+        answer_data.get("retrieval_time"),
+        answer_data.get("prompt_time"),
+        answer_data.get("evaluation_time"),
+        answer_data.get("context_tokens"),
+        answer_data.get("context_tokens_saved"),
+    )
 
 def save_conversation(conversation_id, question, answer_data, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
+    conn = db_pool.getconn()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -94,39 +230,25 @@ def save_conversation(conversation_id, question, answer_data, timestamp=None):
                 INSERT INTO conversations 
                 (id, question, answer, model_used, response_time, relevance, 
                 relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp,
+                retrieval_time, prompt_time, evaluation_time, context_tokens, context_tokens_saved)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             """,
-                (
-                    conversation_id,
-                    question,
-                    answer_data["answer"],
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"],
-                    answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    answer_data["eval_prompt_tokens"],
-                    answer_data["eval_completion_tokens"],
-                    answer_data["eval_total_tokens"],
-                    answer_data["openai_cost"],
-                    timestamp,
-                ),
+                conversation_row(conversation_id, question, answer_data, timestamp),
             )
         conn.commit()
         print(f"Conversation {conversation_id} saved successfully.")
     except Exception as e:
         print(f"Error saving conversation {conversation_id}: {e}")
+        db_errors.inc(operation="save_conversation")
     finally:
-        conn.close()
+        db_pool.putconn(conn)
 
 def save_feedback(conversation_id, feedback, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
+    conn = db_pool.getconn()
     try:
         with conn.cursor() as cur:
             cur.execute(
@@ -137,6 +259,106 @@ def save_feedback(conversation_id, feedback, timestamp=None):
         print(f"Feedback for conversation {conversation_id} saved successfully.")
     except Exception as e:
         print(f"Error saving feedback for conversation {conversation_id}: {e}")
+        db_errors.inc(operation="save_feedback")
+    finally:
+        db_pool.putconn(conn)
+
+
+def conversation_exists(conversation_id):
+    if DB_DISABLED:
+        return True
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM conversations WHERE id = %s LIMIT 1", (conversation_id,))
+            return cur.fetchone() is not None
     finally:
-        conn.close()
+        db_pool.putconn(conn)
+
 
+def write_batch(conversations=(), evaluations=(), feedback=()):
+    # Multi-row write used by the write-behind writer, in one transaction.
+    # Conversations go first so relevance updates and feedback in the same
+    # batch always find their row. Feedback for unknown conversations is
+    # skipped, as the partitioned conversations table cannot be the target
+    # of a foreign key on id alone. Relevance updates carry the
+    # conversation's timestamp so they only touch its partition. Returns
+    # the conversation ids of the skipped feedback.
+    if DB_DISABLED:
+        time.sleep(DB_FAKE_LATENCY)
+        return []
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            if conversations:
+                execute_values(
+                    cur,
+                    """
+                    INSERT INTO conversations
+                    (id, question, answer, model_used, response_time, relevance,
+                    relevance_explanation, prompt_tokens, completion_tokens, total_tokens,
+                    eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, openai_cost, timestamp,
+                    retrieval_time, prompt_time, evaluation_time, context_tokens, context_tokens_saved,
+                    persistence_time)
+                    VALUES %s
+                """,
+                    conversations,
+                    page_size=len(conversations),
+                )
+            if evaluations:
+                execute_values(
+                    cur,
+                    """
+                    UPDATE conversations AS c
+                    SET relevance = v.relevance, relevance_explanation = v.relevance_explanation,
+                        eval_prompt_tokens = v.eval_prompt_tokens,
+                        eval_completion_tokens = v.eval_completion_tokens,
+                        eval_total_tokens = v.eval_total_tokens,
+                        openai_cost = c.openai_cost + v.eval_cost,
+                        evaluation_time = v.evaluation_time
+                    FROM (VALUES %s) AS v (id, timestamp, relevance, relevance_explanation, eval_prompt_tokens,
+                        eval_completion_tokens, eval_total_tokens, eval_cost, evaluation_time)
+                    WHERE c.id = v.id AND c.timestamp = v.timestamp
+                """,
+                    [
+                        (
+                            evaluation["conversation_id"],
+                            evaluation["timestamp"],
+                            evaluation["relevance"],
+                            evaluation["relevance_explanation"],
+                            evaluation["eval_prompt_tokens"],
+                            evaluation["eval_completion_tokens"],
+                            evaluation["eval_total_tokens"],
+                            evaluation["eval_cost"],
+                            evaluation["evaluation_time"],
+                        )
+                        for evaluation in evaluations
+                    ],
+                    template="(%s, %s::timestamptz, %s, %s, %s::integer, %s::integer, %s::integer, %s::float, %s::float)",
+                    page_size=len(evaluations),
+                )
+            skipped = []
+            if feedback:
+                inserted = execute_values(
+                    cur,
+                    """
+                    INSERT INTO feedback (conversation_id, feedback, timestamp)
+                    SELECT v.conversation_id, v.feedback, v.timestamp
+                    FROM (VALUES %s) AS v (conversation_id, feedback, timestamp)
+                    WHERE EXISTS (SELECT 1 FROM conversations c WHERE c.id = v.conversation_id)
+                    RETURNING conversation_id
+                """,
+                    feedback,
+                    template="(%s, %s::integer, %s::timestamptz)",
+                    page_size=len(feedback),
+                    fetch=True,
+                )
+                found = {conversation_id for (conversation_id,) in inserted}
+                skipped = [row[0] for row in feedback if row[0] not in found]
+        conn.commit()
+        return skipped
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
@@ -0,0 +1,127 @@
+import os
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.decomposition import TruncatedSVD
+from paths import DATA_DIRECTORY
+
+# sentence-transformers model name or local path (e.g. all-MiniLM-L12-v2).
+# When unset, or the package is not installed, an LSA model (TF-IDF + SVD)
+# is fitted on the corpus at index time, which needs no network or GPU.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "")
+EMBEDDING_DIMS = int(os.getenv("EMBEDDING_DIMS", "384"))
+EMBEDDING_MAX_FEATURES = int(os.getenv("EMBEDDING_MAX_FEATURES", "10000"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_DIRECTORY = os.getenv("EMBEDDING_DIRECTORY", DATA_DIRECTORY)
+VECTOR_FIELD = "text_vector"
+
+
+def embedding_text(doc):
+    return f"{doc['title']} {doc['text']}"
+
+
+def normalize_rows(vectors):
+    # Cosine similarity in Elasticsearch rejects zero vectors, so rows without
+    # any signal stay all-zero here and callers skip them
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class LsaEmbedder:
+    # Latent semantic analysis: sublinear TF-IDF over the corpus vocabulary
+    # projected onto its top singular vectors. Saved as a plain .npz so it
+    # loads without pickles and across scikit-learn versions.
+
+    def __init__(self, vocabulary, idf, components, path=None):
+        self.vectorizer = TfidfVectorizer(sublinear_tf=True, stop_words='english', vocabulary=list(vocabulary))
+        self.vectorizer.idf_ = idf
+        self.components = np.asarray(components, dtype=np.float32)
+        self.dims = self.components.shape[0]
+        self.path = path
+
+    @property
+    def spec(self):
+        return f"lsa:{os.path.basename(self.path)}"
+
+    @classmethod
+    def fit(cls, texts, dims=EMBEDDING_DIMS, max_features=EMBEDDING_MAX_FEATURES):
+        vectorizer = TfidfVectorizer(sublinear_tf=True, stop_words='english', max_features=max_features)
+        matrix = vectorizer.fit_transform(texts)
+        # TruncatedSVD needs fewer components than documents and terms
+        dims = min(dims, matrix.shape[0] - 1, matrix.shape[1] - 1)
+        svd = TruncatedSVD(dims, random_state=0).fit(matrix)
+        return cls(vectorizer.get_feature_names_out(), vectorizer.idf_, svd.components_)
+
+    def save(self, path):
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, vocabulary=np.array(self.vectorizer.vocabulary, dtype=str), idf=self.vectorizer.idf_, components=self.components)
+        os.replace(tmp_path, path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data["vocabulary"].tolist(), data["idf"], data["components"], path)
+
+    def encode(self, texts):
+        return normalize_rows(self.vectorizer.transform(texts) @ self.components.T)
+
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name):
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.dims = self.model.get_sentence_embedding_dimension()
+
+    @property
+    def spec(self):
+        return f"st:{self.model_name}"
+
+    def encode(self, texts):
+        return normalize_rows(self.model.encode(list(texts), batch_size=EMBEDDING_BATCH_SIZE))
+
+
+def create_embedder(texts, index_name):
+    # Used by prep.py for a full rebuild. The LSA model is fitted on this
+    # corpus and saved next to the data, named after the index it belongs to.
+    if EMBEDDING_MODEL:
+        try:
+            return SentenceTransformerEmbedder(EMBEDDING_MODEL)
+        except ImportError:
+            print("sentence-transformers is not installed, fitting an LSA model instead")
+    embedder = LsaEmbedder.fit(texts)
+    embedder.save(os.path.join(EMBEDDING_DIRECTORY, f"embeddings-{index_name}.npz"))
+    print(f"Fitted LSA embeddings ({embedder.dims} dims) saved to {embedder.path}")
+    return embedder
+
+
+def load_embedder(spec):
+    # spec is what create_embedder's embedder reported and prep.py stored in
+    # the index mapping, so queries always use the model the vectors came from
+    kind, _, name = spec.partition(":")
+    if kind == "st":
+        return SentenceTransformerEmbedder(name)
+    if kind == "lsa":
+        return LsaEmbedder.load(os.path.join(EMBEDDING_DIRECTORY, name))
+    raise ValueError(f"Unknown embedding model {spec}")
+
+
+def embed_documents(documents, embedder, batch_size=EMBEDDING_BATCH_SIZE):
+    # Adds the vector field to each document as the stream passes through
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield from _embed_batch(batch, embedder)
+            batch = []
+    if batch:
+        yield from _embed_batch(batch, embedder)
+
+
+def _embed_batch(batch, embedder):
+    vectors = embedder.encode([embedding_text(doc) for doc in batch])
+    for doc, vector in zip(batch, vectors):
+        if vector.any():
+            doc[VECTOR_FIELD] = vector.tolist()
+        yield doc
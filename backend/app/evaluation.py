@@ -0,0 +1,212 @@
+import os
+import random
+import asyncio
+from openai.types import CompletionUsage
+from rag import evaluate_relevance_async, calculate_openai_cost, EVAL_MODEL
+from writer import db_writer
+from metrics import StageTimer, tokens, openai_cost
+
+# Fraction of answers that get an LLM relevance evaluation
+EVAL_SAMPLE_RATE = float(os.getenv("EVAL_SAMPLE_RATE", "1.0"))
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "2"))
+EVAL_BATCH_SIZE = int(os.getenv("EVAL_BATCH_SIZE", "10"))
+EVAL_BATCH_WAIT = float(os.getenv("EVAL_BATCH_WAIT", "1.0"))
+EVAL_MAX_CONCURRENCY = int(os.getenv("EVAL_MAX_CONCURRENCY", "4"))
+EVAL_MAX_RETRIES = int(os.getenv("EVAL_MAX_RETRIES", "3"))
+EVAL_RETRY_BACKOFF = float(os.getenv("EVAL_RETRY_BACKOFF", "1.0"))
+EVAL_QUEUE_SIZE = int(os.getenv("EVAL_QUEUE_SIZE", "1000"))
+
+
+class EvaluationQueue:
+    # Relevance evaluation off the request path: /question stores the answer
+    # as PENDING, and workers evaluate it later and update the row. Workers
+    # pull up to batch_size items at a time, evaluate them concurrently under
+    # a shared concurrency cap and hand the results to the write-behind
+    # writer, which orders them after the conversation inserts they update.
+
+    def __init__(
+        self,
+        sample_rate=EVAL_SAMPLE_RATE,
+        workers=EVAL_WORKERS,
+        batch_size=EVAL_BATCH_SIZE,
+        batch_wait=EVAL_BATCH_WAIT,
+        max_concurrency=EVAL_MAX_CONCURRENCY,
+        max_retries=EVAL_MAX_RETRIES,
+        maxsize=EVAL_QUEUE_SIZE,
+    ):
+        self.sample_rate = sample_rate
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.maxsize = maxsize
+        self.queue = None
+        self.semaphore = None
+        self.tasks = []
+        self.reserved = 0
+        self.stats = {
+            "enqueued": 0,
+            "not_sampled": 0,
+            "dropped": 0,
+            "completed": 0,
+            "failed": 0,
+            "retried": 0,
+        }
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        print(f"Started {self.workers} evaluation workers (sample rate {self.sample_rate})")
+
+    async def stop(self, timeout=30):
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            print(f"Evaluation queue not drained after {timeout}s, {self.queue.qsize()} items dropped")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def reserve(self):
+        # Decide before the conversation is saved whether it will be
+        # evaluated, so a row is never left PENDING without a queue slot
+        if random.random() >= self.sample_rate:
+            self.stats["not_sampled"] += 1
+            return False
+        if self.queue is None or self.queue.qsize() + self.reserved >= self.maxsize:
+            self.stats["dropped"] += 1
+            return False
+        self.reserved += 1
+        return True
+
+    def release(self):
+        self.reserved -= 1
+
+    def submit(self, conversation_id, question, answer, model, timestamp):
+        self.reserved -= 1
+        self.queue.put_nowait({
+            "conversation_id": conversation_id,
+            "timestamp": timestamp,
+            "question": question,
+            "answer": answer,
+            "model": model,
+        })
+        self.stats["enqueued"] += 1
+
+    def depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def snapshot(self):
+        return {
+            "depth": self.depth(),
+            "reserved": self.reserved,
+            "sample_rate": self.sample_rate,
+            **self.stats,
+        }
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _failed(self, item, reason, evaluation_time=None):
+        # The row leaves PENDING even when its evaluation went wrong
+        self.stats["failed"] += 1
+        print(f"Evaluation failed for conversation {item['conversation_id']}: {reason}")
+        return {
+            "conversation_id": item["conversation_id"],
+            "timestamp": item["timestamp"],
+            "relevance": "EVAL_FAILED",
+            "relevance_explanation": str(reason),
+            "eval_prompt_tokens": 0,
+            "eval_completion_tokens": 0,
+            "eval_total_tokens": 0,
+            "eval_cost": 0,
+            "evaluation_time": evaluation_time,
+        }
+
+    async def _evaluate(self, item):
+        evaluation = None
+        evaluation_time = None
+        # Every attempt that reached the model is paid for
+        spent = None
+        for attempt in range(self.max_retries + 1):
+            async with self.semaphore:
+                with StageTimer("evaluation") as evaluating:
+                    evaluation, usage = await evaluate_relevance_async(item["question"], item["answer"], EVAL_MODEL)
+            evaluation_time = evaluating.elapsed
+            # llm_async reports failures as a missing usage, parse_evaluation
+            # unusable replies as a missing evaluation
+            if usage is not None:
+                spent = usage if spent is None else CompletionUsage(
+                    prompt_tokens=spent.prompt_tokens + usage.prompt_tokens,
+                    completion_tokens=spent.completion_tokens + usage.completion_tokens,
+                    total_tokens=spent.total_tokens + usage.total_tokens,
+                )
+            if usage is not None and evaluation is not None:
+                break
+            if attempt < self.max_retries:
+                self.stats["retried"] += 1
+                await asyncio.sleep(EVAL_RETRY_BACKOFF * 2 ** attempt)
+
+        if spent is None:
+            return self._failed(item, "Evaluation failed", evaluation_time)
+
+        # Charged at the rate of the model that evaluated
+        usage = spent
+        eval_cost = calculate_openai_cost(EVAL_MODEL, usage)
+        tokens.inc(usage.prompt_tokens, model=EVAL_MODEL, kind="eval_prompt")
+        tokens.inc(usage.completion_tokens, model=EVAL_MODEL, kind="eval_completion")
+        openai_cost.inc(eval_cost, model=EVAL_MODEL)
+
+        if evaluation is None:
+            result = self._failed(item, "Failed to parse evaluation", evaluation_time)
+        else:
+            self.stats["completed"] += 1
+            result = {
+                "conversation_id": item["conversation_id"],
+                "timestamp": item["timestamp"],
+                "relevance": str(evaluation.get("Relevance", "UNKNOWN")),
+                "relevance_explanation": str(evaluation.get("Explanation", "")),
+            }
+        result.update({
+            "eval_prompt_tokens": usage.prompt_tokens,
+            "eval_completion_tokens": usage.completion_tokens,
+            "eval_total_tokens": usage.total_tokens,
+            "eval_cost": eval_cost,
+            "evaluation_time": evaluation_time,
+        })
+        return result
+
+    async def _worker(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                # One item going wrong does not hold back the rest of the batch
+                results = await asyncio.gather(*(self._evaluate(item) for item in batch), return_exceptions=True)
+                results = [
+                    self._failed(item, result) if isinstance(result, Exception) else result
+                    for item, result in zip(batch, results)
+                ]
+                await db_writer.save_evaluations(results)
+            except Exception as e:
+                print(f"Error processing evaluation batch: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+
+evaluation_queue = EvaluationQueue()
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from tokens import count_tokens
+
+# OpenAI-compatible stand-in for load tests and offline development. Point
+# the backend at it with OPENAI_BASE_URL=http://localhost:8001/v1
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))
+FAKE_LLM_COMPLETION_TOKENS = int(os.getenv("FAKE_LLM_COMPLETION_TOKENS", "150"))
+# Each call's latency varies uniformly by up to this fraction either way
+FAKE_LLM_LATENCY_JITTER = float(os.getenv("FAKE_LLM_LATENCY_JITTER", "0"))
+# Share of calls answered with a 500, to exercise retries and error paths
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+app = FastAPI()
+
+
+def fake_content(prompt):
+    if "expert evaluator for a RAG system" in prompt:
+        return json.dumps({"Relevance": "RELEVANT", "Explanation": "Fake evaluation"})
+    return " ".join(["lorem"] * FAKE_LLM_COMPLETION_TOKENS)
+
+
+def call_latency():
+    return FAKE_LLM_LATENCY * (1 + random.uniform(-FAKE_LLM_LATENCY_JITTER, FAKE_LLM_LATENCY_JITTER))
+
+
+def completion_chunk(completion_id, model, delta=None, finish_reason=None, usage=None):
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}],
+    }
+    if usage:
+        chunk["usage"] = usage
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+async def stream_completion(body, prompt, content):
+    # FAKE_LLM_LATENCY is spread evenly over the streamed words
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    model = body.get("model", "gpt-4o-mini")
+    words = content.split(" ")
+    delay = call_latency() / len(words)
+
+    yield completion_chunk(completion_id, model, {"role": "assistant", "content": ""})
+    for i, word in enumerate(words):
+        await asyncio.sleep(delay)
+        yield completion_chunk(completion_id, model, {"content": word if i == 0 else " " + word})
+    yield completion_chunk(completion_id, model, finish_reason="stop")
+
+    if (body.get("stream_options") or {}).get("include_usage"):
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(content)
+        yield completion_chunk(completion_id, model, usage={
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        })
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    prompt = body["messages"][-1]["content"]
+    content = fake_content(prompt)
+
+    if random.random() < FAKE_LLM_ERROR_RATE:
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": "Fake LLM error", "type": "server_error", "code": None}},
+        )
+
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(body, prompt, content), media_type="text/event-stream")
+
+    await asyncio.sleep(call_latency())
+
+    prompt_tokens = count_tokens(prompt)
+    completion_tokens = count_tokens(content)
+    return {
+        "id": f"chatcmpl-{uuid.uuid4().hex}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4o-mini"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("FAKE_LLM_PORT", "8001")))
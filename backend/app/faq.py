@@ -0,0 +1,299 @@
+import os
+import csv
+import json
+import hashlib
+import time
+import asyncio
+import argparse
+import threading
+from collections import OrderedDict
+from cache import make_key, as_cache_hit
+from paths import DATA_DIRECTORY
+
+FAQ_CSV_PATH = os.getenv("FAQ_CSV_PATH", os.path.join(DATA_DIRECTORY, "ground-truth-retrieval.csv"))
+FAQ_ANSWERS_PATH = os.getenv("FAQ_ANSWERS_PATH", os.path.join(DATA_DIRECTORY, "faq-answers.json"))
+FAQ_CONCURRENCY = int(os.getenv("FAQ_CONCURRENCY", "8"))
+# Serialized /faq pages kept per catalog version
+FAQ_RESPONSE_CACHE_SIZE = int(os.getenv("FAQ_RESPONSE_CACHE_SIZE", "256"))
+# Seconds between checks of the answers file and the live index
+FAQ_RELOAD_INTERVAL = float(os.getenv("FAQ_RELOAD_INTERVAL", "10"))
+
+
+def load_faq_questions(csv_path=FAQ_CSV_PATH):
+    with open(csv_path, 'r', encoding='utf-8') as file:
+        return [row['question'] for row in csv.DictReader(file)]
+
+
+class FaqCatalog:
+    # /faq questions, parsed once and re-read only when the CSV's mtime
+    # changes. Rows are kept as tuples with a doc_id -> rows index, and each
+    # distinct page is serialized once and served as bytes with an ETag.
+
+    def __init__(self, csv_path=FAQ_CSV_PATH, cache_size=FAQ_RESPONSE_CACHE_SIZE):
+        self.csv_path = csv_path
+        self.cache_size = cache_size
+        self.mtime = None
+        self.rows = []
+        self.rows_by_doc = {}
+        self.version = ""
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        mtime = os.stat(self.csv_path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.csv_path, 'rb') as file:
+                content = file.read()
+            rows = [
+                (row['question'], row['doc_id'], row['chunk_id'])
+                for row in csv.DictReader(content.decode('utf-8').splitlines())
+            ]
+            if not rows:
+                raise ValueError(f"No questions were loaded from {self.csv_path}")
+            rows_by_doc = {}
+            for row in rows:
+                rows_by_doc.setdefault(row[1], []).append(row)
+            self.rows, self.rows_by_doc = rows, rows_by_doc
+            self.version = hashlib.md5(content).hexdigest()
+            self.responses.clear()
+            self.mtime = mtime
+            print(f"Loaded {len(rows)} FAQ questions from {self.csv_path}")
+
+    def page(self, offset=0, limit=0, doc_id=None):
+        # Returns (body, etag) for the requested slice, limit 0 meaning all
+        self._refresh()
+        key = (self.version, offset, limit, doc_id)
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is not None:
+                self.responses.move_to_end(key)
+                return cached
+
+            rows = self.rows_by_doc.get(doc_id, []) if doc_id else self.rows
+            selected = rows[offset:offset + limit] if limit else rows[offset:]
+            body = json.dumps({
+                "faq_questions": [
+                    {"text": text, "document_id": document_id, "chunk_id": chunk_id}
+                    for text, document_id, chunk_id in selected
+                ],
+                "total": len(rows),
+                "offset": offset,
+                "limit": limit,
+            }).encode('utf-8')
+            etag = '"' + hashlib.md5(f"{self.version}:{offset}:{limit}:{doc_id}".encode('utf-8')).hexdigest() + '"'
+
+            self.responses[key] = (body, etag)
+            while len(self.responses) > self.cache_size:
+                self.responses.popitem(last=False)
+            return body, etag
+
+
+faq_catalog = FaqCatalog()
+
+
+def faq_answer_key(question, model, source=None, size=3):
+    return json.dumps(make_key(question, model, source, size))
+
+
+def save_faq_answers(path, store):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(store, file)
+    os.replace(tmp_path, path)
+
+
+def invalidate_faq_answers(path=FAQ_ANSWERS_PATH):
+    # Answers were generated against the previous index contents
+    try:
+        os.remove(path)
+        print(f"Invalidated precomputed FAQ answers at {path}")
+    except FileNotFoundError:
+        pass
+
+
+class FaqAnswerStore:
+    # Precomputed answers written by `python faq.py`. A background thread
+    # re-reads the file whenever its mtime changes and checks it against the
+    # live index, so requests only look at the in-memory dict. The store is
+    # treated as empty once prep.py removes the file or the index moves on,
+    # so a rebuilt index never serves answers generated against the old one.
+
+    def __init__(self, path=FAQ_ANSWERS_PATH, reload_interval=FAQ_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.mtime = None
+        self.loaded = {}
+        self.answers = {}
+        self.index = None
+        self.live_index = None
+        self.index_source = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.stats = {"hits": 0, "misses": 0, "reloads": 0, "stale": 0}
+
+    def start(self, index_source=None):
+        # index_source returns the version of the index being served
+        if self.thread is not None:
+            return
+        self.index_source = index_source
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="faq-answers", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self._refresh()
+            except Exception as e:
+                print(f"Error reloading precomputed FAQ answers from {self.path}: {e}")
+            if self.stopping.wait(self.reload_interval):
+                break
+
+    def _current_index(self):
+        if self.index_source is None:
+            return self.index
+        try:
+            return self.index_source()
+        except Exception as e:
+            print(f"Error reading the index version for FAQ answers: {e}")
+            return self.live_index
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        reloaded = mtime != self.mtime
+        if reloaded:
+            if mtime is None:
+                self.loaded, self.index = {}, None
+            else:
+                with open(self.path, 'r', encoding='utf-8') as file:
+                    store = json.load(file)
+                self.loaded, self.index = store["answers"], store.get("index")
+                print(f"Loaded {len(self.loaded)} precomputed FAQ answers for index {self.index}")
+            self.mtime = mtime
+            self.stats["reloads"] += 1
+        live_index = self._current_index()
+        stale = bool(self.loaded) and live_index != self.index
+        if stale and (reloaded or self.answers):
+            print(f"Ignoring precomputed FAQ answers for index {self.index}, serving {live_index}")
+            self.stats["stale"] += 1
+        self.answers = {} if stale else self.loaded
+        self.live_index = live_index
+
+    def get(self, question, model, source=None, size=3):
+        stored = self.answers.get(faq_answer_key(question, model, source, size))
+        if stored is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        result = as_cache_hit(question, stored)
+        result["precomputed"] = True
+        return result
+
+    def snapshot(self):
+        return {
+            "answers": len(self.answers),
+            "loaded": len(self.loaded),
+            "index": self.index,
+            "live_index": self.live_index,
+            **self.stats,
+        }
+
+
+faq_answers = FaqAnswerStore()
+
+
+async def precompute_answers(questions, model, concurrency, evaluate):
+    # Imported here so prep.py can use invalidate_faq_answers without
+    # creating the search and LLM clients
+    from rag import get_answer_async
+
+    semaphore = asyncio.Semaphore(concurrency)
+    answers = {}
+    failures = []
+
+    async def answer(question):
+        async with semaphore:
+            try:
+                result = await get_answer_async(question, model, evaluate=evaluate, use_cache=False)
+            except Exception as e:
+                failures.append((question, str(e)))
+                return
+        if not result.get("answer"):
+            failures.append((question, "empty answer"))
+            return
+        answers[faq_answer_key(question, model)] = result
+        done = len(answers) + len(failures)
+        if done % 100 == 0:
+            print(f"{done}/{len(questions)} questions answered")
+
+    await asyncio.gather(*(answer(question) for question in questions))
+    return answers, failures
+
+
+def live_index_name():
+    from search import retriever
+    return retriever.index_version()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute answers for the FAQ question set")
+    parser.add_argument("--csv", default=FAQ_CSV_PATH, help="CSV with a question column")
+    parser.add_argument("--output", default=FAQ_ANSWERS_PATH)
+    parser.add_argument("--model", default="gpt-4o-mini")
+    parser.add_argument("--concurrency", type=int, default=FAQ_CONCURRENCY, help="questions answered in parallel")
+    parser.add_argument("--evaluate", action="store_true", help="also store an LLM relevance evaluation for each answer")
+    parser.add_argument("--limit", type=int, default=0, help="only answer the first N questions")
+    args = parser.parse_args()
+
+    # Duplicate questions in the CSV are answered once
+    questions = list(dict.fromkeys(load_faq_questions(args.csv)))
+    if args.limit:
+        questions = questions[:args.limit]
+    print(f"Precomputing answers for {len(questions)} questions with {args.model} (concurrency {args.concurrency})")
+
+    index_name = live_index_name()
+    start_time = time.perf_counter()
+    answers, failures = asyncio.run(precompute_answers(questions, args.model, args.concurrency, args.evaluate))
+    elapsed = time.perf_counter() - start_time
+
+    if live_index_name() != index_name:
+        raise SystemExit(f"The index changed from {index_name} while answering, answers not saved")
+    save_faq_answers(args.output, {
+        "index": index_name,
+        "model": args.model,
+        "generated_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "answers": answers,
+    })
+
+    total_cost = sum(result["openai_cost"] for result in answers.values())
+    total_tokens = sum(result["total_tokens"] + result["eval_total_tokens"] for result in answers.values())
+    print(json.dumps({
+        "questions": len(questions),
+        "answered": len(answers),
+        "failed": len(failures),
+        "elapsed": elapsed,
+        "questions_per_sec": len(questions) / elapsed if elapsed > 0 else 0.0,
+        "total_tokens": total_tokens,
+        "total_cost": total_cost,
+        "output": args.output,
+    }, indent=2))
+    for question, error in failures[:5]:
+        print(f"Failed: {question!r}: {error}")
+
+
+if __name__ == "__main__":
+    main()
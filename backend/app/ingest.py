@@ -4,13 +4,40 @@ import os
 import re
 import hashlib
 from bs4 import BeautifulSoup
+from collections import deque
+from itertools import islice
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from tqdm.auto import tqdm
+from tokens import count_tokens
+
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "1"))
+INGEST_CHUNKSIZE = int(os.getenv("INGEST_CHUNKSIZE", "64"))
+
+# "words" keeps the original 500-word windows; "tokens" packs sentences and
+# paragraphs up to CHUNK_TOKENS
+CHUNKERS = ('words', 'tokens')
+CHUNKER = os.getenv("CHUNKER", "words")
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "400"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+
+# Files larger than this are parsed incrementally instead of with json.load
+JSON_STREAM_THRESHOLD = int(os.getenv("JSON_STREAM_THRESHOLD", str(16 * 1024 * 1024)))
+JSON_READ_SIZE = 1 << 20
+JSON_DECODER = json.JSONDecoder()
+WHITESPACE_PATTERN = re.compile(r'\s*')
 
 def generate_document_id(doc):
     combined = f"{doc['title']}-{doc['url']}-{doc['html'][:50]}"
     hash_object = hashlib.md5(combined.encode())
     return hash_object.hexdigest()[:8]
 
+def chunk_key(chunk):
+    # chunk_id alone is not unique (different messages can share a doc_id),
+    # so the index _id also covers the source file and the chunk text.
+    combined = f"{chunk['source']}\x00{chunk['chunk_id']}\x00{chunk['text']}"
+    return hashlib.md5(combined.encode()).hexdigest()
+
 def chunk_text(text, chunk_size=500, overlap_size=20):
     words = text.split()
     chunks = []
@@ -25,89 +52,439 @@ def chunk_text(text, chunk_size=500, overlap_size=20):
             break
     return chunks
 
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+')
+PARAGRAPH_PATTERN = re.compile(r'\n\s*\n')
 
-def clean_html_content(html):
-    cleaned_text = re.sub(r'^.*?Powered by GitBook', '', html, flags=re.DOTALL)
-    cleaned_text = re.sub(r'^.*?Terms of Service', '', html, flags=re.DOTALL)
-    cleaned_text = re.sub(r'^.*?Disclaimer', '', html, flags=re.DOTALL)
-    cleaned_text = re.sub(r'Previous.*?Last updated.*?$', '', cleaned_text, flags=re.DOTALL)
-    cleaned_text = re.sub(r'\*\*', '', cleaned_text)    
-    cleaned_text = re.sub(r'[^\x00-\x7F]+', '', cleaned_text)
-    cleaned_text = re.sub(r'@\w+', '', cleaned_text)
-    cleaned_text = re.sub(r'<[^>]+>', '', cleaned_text)
-    cleaned_text = re.sub(r'\\n', '', cleaned_text)
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
-    
-    return cleaned_text
-
-
-def process_documents(documents):
-    processed_docs = []
-    irrelevant_titles = ['Terms of Use', 'Contact us', 'Disclaimer', 'Terms of Service']
-    
-    for doc in tqdm(documents, desc="Processing documents"):
-
-        if any(title.lower() in doc['title'].lower() for title in irrelevant_titles):
+def _split_long_sentence(sentence, max_tokens):
+    pieces = []
+    words = []
+    tokens = 0
+    for word in sentence.split():
+        word_tokens = count_tokens(word)
+        if words and tokens + word_tokens > max_tokens:
+            pieces.append(' '.join(words))
+            words = []
+            tokens = 0
+        words.append(word)
+        tokens += word_tokens
+    if words:
+        pieces.append(' '.join(words))
+    return pieces
+
+def _join_units(units):
+    paragraphs = []
+    last_paragraph = None
+    for text, _, paragraph in units:
+        if paragraph != last_paragraph:
+            paragraphs.append([])
+            last_paragraph = paragraph
+        paragraphs[-1].append(text)
+    return '\n\n'.join(' '.join(sentences) for sentences in paragraphs)
+
+def chunk_text_tokens(text, max_tokens=CHUNK_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    # Units are (sentence, tokens, paragraph index); sentences longer than
+    # the budget are split on word boundaries
+    units = []
+    paragraph_tokens = []
+    for paragraph in PARAGRAPH_PATTERN.split(text):
+        sentences = [sentence for sentence in SENTENCE_PATTERN.split(paragraph.strip()) if sentence]
+        if not sentences:
             continue
-        
-
-        text = clean_html_content(doc['html'])
-        title = clean_html_content(doc['title'])
-        doc_id = generate_document_id(doc)
-        
-        chunks = chunk_text(text)
-        
-        for i, chunk in enumerate(chunks):
-            chunk_id = f"{doc_id}_{i}"
-            processed_docs.append({
-                'doc_id': doc_id,
-                'chunk_id': chunk_id,
-                'text': chunk,
-                'title': title,
-                'url': doc['url'],
-                'source': doc['source']
-            })
-    
-    return processed_docs
+        index = len(paragraph_tokens)
+        paragraph_tokens.append(0)
+        for sentence in sentences:
+            tokens = count_tokens(sentence)
+            pieces = [sentence] if tokens <= max_tokens else _split_long_sentence(sentence, max_tokens)
+            for piece in pieces:
+                piece_tokens = tokens if len(pieces) == 1 else count_tokens(piece)
+                units.append((piece, piece_tokens, index))
+                paragraph_tokens[index] += piece_tokens
 
-def load_documents(directory_path):
-    documents = []
-    json_files = glob.glob(os.path.join(directory_path, 'json', '*.json'))
+    chunks = []
+    current = []
+    current_tokens = 0
+    fresh = 0
+    for unit in units:
+        _, tokens, paragraph = unit
+        new_paragraph = bool(current) and paragraph != current[-1][2]
+        # Start a new chunk when the sentence does not fit, or at a paragraph
+        # boundary when the whole next paragraph would not fit but could fill
+        # a chunk on its own
+        overflow = current_tokens + tokens > max_tokens
+        split_paragraph = (
+            new_paragraph
+            and current_tokens + paragraph_tokens[paragraph] > max_tokens
+            and paragraph_tokens[paragraph] <= max_tokens
+        )
+        if fresh and (overflow or split_paragraph):
+            chunks.append(_join_units(current))
+            carry = []
+            carry_tokens = 0
+            # Overlap only when cutting through a paragraph
+            if not new_paragraph:
+                for previous in reversed(current):
+                    if carry_tokens + previous[1] > overlap_tokens:
+                        break
+                    carry.insert(0, previous)
+                    carry_tokens += previous[1]
+                if carry_tokens + tokens > max_tokens:
+                    carry = []
+                    carry_tokens = 0
+            current = carry
+            current_tokens = carry_tokens
+            fresh = 0
+        current.append(unit)
+        current_tokens += tokens
+        fresh += 1
+
+    if fresh:
+        chunks.append(_join_units(current))
+    return chunks
+
+
+MENTION_PATTERN = re.compile(r'@\w+')
+TAG_PATTERN = re.compile(r'<[^>]+>')
+
+def _strip_boilerplate(text):
+    # Drop everything up to the first "Disclaimer" (GitBook page chrome)
+    start = text.find('Disclaimer')
+    if start != -1:
+        text = text[start + len('Disclaimer'):]
+
+    # Drop the "Previous ... Last updated" page footer
+    footer = text.find('Previous')
+    if footer != -1 and text.find('Last updated', footer + len('Previous')) != -1:
+        text = text[:footer]
+
+    return text
+
+def clean_html_content(html, keep_paragraphs=False):
+    cleaned_text = _strip_boilerplate(html)
+    cleaned_text = cleaned_text.replace('**', '')
+    cleaned_text = cleaned_text.encode('ascii', 'ignore').decode('ascii')
+    cleaned_text = MENTION_PATTERN.sub('', cleaned_text)
+    cleaned_text = TAG_PATTERN.sub('', cleaned_text)
+    cleaned_text = cleaned_text.replace('\\n', '')
+    if keep_paragraphs:
+        paragraphs = (' '.join(paragraph.split()) for paragraph in PARAGRAPH_PATTERN.split(cleaned_text))
+        return '\n\n'.join(paragraph for paragraph in paragraphs if paragraph)
+    return ' '.join(cleaned_text.split())
+
+
+IRRELEVANT_TITLES = ['Terms of Use', 'Contact us', 'Disclaimer', 'Terms of Service']
+
+def process_document(doc, chunker='words'):
+    if any(title.lower() in doc['title'].lower() for title in IRRELEVANT_TITLES):
+        return []
+
+    title = clean_html_content(doc['title'])
+    doc_id = generate_document_id(doc)
+
+    if chunker == 'tokens':
+        chunks = chunk_text_tokens(clean_html_content(doc['html'], keep_paragraphs=True))
+    else:
+        chunks = chunk_text(clean_html_content(doc['html']))
+
+    return [
+        {
+            'doc_id': doc_id,
+            'chunk_id': f"{doc_id}_{i}",
+            'text': chunk,
+            'title': title,
+            'url': doc['url'],
+            'source': doc['source'],
+            'token_count': count_tokens(chunk)
+        }
+        for i, chunk in enumerate(chunks)
+    ]
+
+def iter_processed(documents, workers=INGEST_WORKERS, chunksize=INGEST_CHUNKSIZE, chunker=CHUNKER):
+    process = partial(process_document, chunker=chunker)
+    if workers <= 1:
+        for doc in documents:
+            yield from process(doc)
+        return
+
+    # Feed the pool one window of documents at a time, keeping the next window
+    # queued so workers stay busy while the current one is consumed. map()
+    # yields results in input order, so chunk order and chunk_ids are the same
+    # as in the serial path.
+    window = workers * chunksize * 4
+    documents = iter(documents)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(islice(documents, window))
+            if batch:
+                pending.append(executor.map(process, batch, chunksize=chunksize))
+            if pending and (len(pending) > 1 or not batch):
+                for chunks in pending.popleft():
+                    yield from chunks
+            if not batch and not pending:
+                break
+
+def process_documents(documents, workers=INGEST_WORKERS, chunksize=INGEST_CHUNKSIZE, chunker=CHUNKER):
+    desc = "Processing documents" if workers <= 1 else f"Processing documents ({workers} workers)"
+    return list(iter_processed(tqdm(documents, desc=desc), workers, chunksize, chunker))
+
+def _list_document(doc, source):
+    return {
+        'html': doc.get('html', ''),
+        'title': doc.get('title', ''),
+        'url': doc.get('url', ''),
+        'source': source
+    }
+
+def _message_document(message, source):
+    return {
+        'html': message.get('content', ''),
+        'title': f"Message from {message.get('author', {}).get('name', 'Unknown')}",
+        'url': '',
+        'source': source
+    }
+
+class JsonStream:
+    # Minimal incremental reader for the two export layouts we ingest: a
+    # top-level array of pages, or a Discord export object whose "messages"
+    # array is walked item by item. Only one item is held in memory at a time.
+
+    def __init__(self, file, read_size=JSON_READ_SIZE):
+        self.file = file
+        self.read_size = read_size
+        self.buffer = ''
+        self.pos = 0
+        # Characters of the file read before the buffer
+        self.offset = 0
+        self.eof = False
+
+    def _fill(self):
+        data = self.file.read(self.read_size)
+        if not data:
+            self.eof = True
+            return False
+        self.offset += self.pos
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = WHITESPACE_PATTERN.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
 
-    for file_path in tqdm(json_files, desc="Loading JSON files"):
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} in JSON stream, found {self.peek()!r}")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = JSON_DECODER.raw_decode(self.buffer, self.pos)
+                # A number at the very end of the buffer may still continue
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError as e:
+                if self.eof:
+                    # Positioned in the file rather than the buffer
+                    e.pos += self.offset
+                    raise
+            self._fill()
+
+    def items(self):
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Expected ',' or ']' in JSON array, found {char!r}")
+
+    def documents(self, source):
+        char = self.peek()
+        if char == '[':
+            for doc in self.items():
+                yield _list_document(doc, source)
+            return
+        if char != '{':
+            raise ValueError("Unsupported JSON structure")
+
+        self.pos += 1
+        found_messages = False
+        while self.peek() != '}':
+            key = self.value()
+            self.expect(':')
+            if key == 'messages' and self.peek() == '[':
+                found_messages = True
+                for message in self.items():
+                    if message.get('content', ''):
+                        yield _message_document(message, source)
+            else:
+                self.value()
+            if self.peek() == ',':
+                self.pos += 1
+        if not found_messages:
+            raise ValueError("Unsupported JSON structure")
+
+def _iter_file_documents(file_path, encoding):
+    source = f"json/{os.path.basename(file_path)}"
+    with open(file_path, 'r', encoding=encoding) as file:
+        if os.path.getsize(file_path) > JSON_STREAM_THRESHOLD:
+            yield from JsonStream(file).documents(source)
+            return
+        data = json.load(file)
+
+    if isinstance(data, list):
+        for doc in data:
+            yield _list_document(doc, source)
+    elif isinstance(data, dict) and 'messages' in data:
+        for message in data['messages']:
+            if message.get('content', ''):
+                yield _message_document(message, source)
+    else:
+        raise ValueError("Unsupported JSON structure")
+
+def iter_file(file_path):
+    produced = 0
+    try:
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                data = json.load(file)
+            for doc in _iter_file_documents(file_path, 'utf-8'):
+                yield doc
+                produced += 1
         except UnicodeDecodeError:
-            with open(file_path, 'r', encoding='cp1252') as file:
-                data = json.load(file)
-        
-        if isinstance(data, list):
-            for doc in data:
-                documents.append({
-                    'html': doc.get('html', ''),
-                    'title': doc.get('title', ''),
-                    'url': doc.get('url', ''),
-                    'source': f"json/{os.path.basename(file_path)}"
-                })
-        elif isinstance(data, dict) and 'messages' in data:
-            for message in data['messages']:
-                content = message.get('content', '')
-                if content:
-                    documents.append({
-                        'html': content,
-                        'title': f"Message from {message.get('author', {}).get('name', 'Unknown')}",
-                        'url': '',
-                        'source': f"json/{os.path.basename(file_path)}"
-                    })
-        else:
-            print(f"Unsupported JSON structure in file: {file_path}")
-
-    return documents
-
-def ingest_documents(directory_path):
+            # Large files are streamed, so skip what was already yielded
+            for i, doc in enumerate(_iter_file_documents(file_path, 'cp1252')):
+                if i >= produced:
+                    yield doc
+    except json.JSONDecodeError as e:
+        # Malformed files still stop the ingest, saying where they broke
+        raise ValueError(f"Invalid JSON in file: {file_path} at character {e.pos} ({e.msg})") from e
+    except ValueError as e:
+        print(f"Unsupported JSON structure in file: {file_path} ({e})")
+
+def load_file(file_path):
+    return list(iter_file(file_path))
+
+def list_json_files(directory_path):
+    return sorted(glob.glob(os.path.join(directory_path, 'json', '*.json')))
+
+def iter_documents(directory_path):
+    for file_path in tqdm(list_json_files(directory_path), desc="Loading JSON files"):
+        yield from iter_file(file_path)
+
+def load_documents(directory_path):
+    return list(iter_documents(directory_path))
+
+def iter_ingest(directory_path, workers=INGEST_WORKERS, chunker=CHUNKER):
+    # Lazily load, clean and chunk the corpus; chunks are yielded as soon as
+    # they are ready so indexing can start before ingestion finishes
+    counts = {'documents': 0, 'chunks': 0}
+
+    def counted_documents():
+        for doc in iter_documents(directory_path):
+            counts['documents'] += 1
+            yield doc
+
+    for chunk in iter_processed(counted_documents(), workers=workers, chunker=chunker):
+        counts['chunks'] += 1
+        yield chunk
+
+    print(f"Total documents ingested: {counts['documents']}")
+    print(f"Total documents ingested and processed: {counts['chunks']}")
+
+def ingest_documents(directory_path, workers=INGEST_WORKERS, chunker=CHUNKER):
     documents = load_documents(directory_path)
     print(f"Total documents ingested: {len(documents)}")
-    processed_documents = process_documents(documents)
+    processed_documents = process_documents(documents, workers=workers, chunker=chunker)
     print(f"Total documents ingested and processed: {len(processed_documents)}")
-    return processed_documents
\ No newline at end of file
+    return processed_documents
+
+def collect_chunk_keys(chunks, keys_by_source):
+    for chunk in chunks:
+        keys_by_source.setdefault(chunk['source'], set()).add(chunk_key(chunk))
+        yield chunk
+
+def file_hash(file_path):
+    hash_object = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            hash_object.update(block)
+    return hash_object.hexdigest()
+
+def _file_entry(file_path, keys):
+    stat = os.stat(file_path)
+    return {
+        'hash': file_hash(file_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'chunks': sorted(keys),
+    }
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, manifest_path)
+
+def build_manifest(directory_path, keys_by_source, index_name, chunker=CHUNKER):
+    files = {}
+    for file_path in list_json_files(directory_path):
+        source = f"json/{os.path.basename(file_path)}"
+        files[source] = _file_entry(file_path, keys_by_source.get(source, ()))
+
+    return {'index': index_name, 'chunker': chunker, 'files': files}
+
+def plan_incremental(directory_path, manifest, workers=INGEST_WORKERS, chunker=CHUNKER):
+    # Compare the data directory against the manifest of the last run and
+    # return the chunks to upsert, the chunk keys to delete and the new
+    # manifest. Only files whose content changed are parsed and chunked.
+    previous_files = manifest['files']
+    files = {}
+    upserts = []
+    deletes = set()
+
+    for file_path in list_json_files(directory_path):
+        source = f"json/{os.path.basename(file_path)}"
+        previous = previous_files.get(source)
+        if previous:
+            stat = os.stat(file_path)
+            if stat.st_size == previous['size'] and stat.st_mtime == previous['mtime']:
+                files[source] = previous
+                continue
+            if file_hash(file_path) == previous['hash']:
+                files[source] = {**previous, 'mtime': stat.st_mtime}
+                continue
+
+        chunks = process_documents(load_file(file_path), workers=workers, chunker=chunker)
+        old_keys = set(previous['chunks']) if previous else set()
+        new_keys = set()
+        for chunk in chunks:
+            key = chunk_key(chunk)
+            if key not in old_keys and key not in new_keys:
+                upserts.append(chunk)
+            new_keys.add(key)
+
+        deletes |= old_keys - new_keys
+        files[source] = _file_entry(file_path, new_keys)
+
+    for source, previous in previous_files.items():
+        if source not in files:
+            deletes |= set(previous['chunks'])
+
+    return upserts, sorted(deletes), {'index': manifest['index'], 'chunker': chunker, 'files': files}
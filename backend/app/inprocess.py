@@ -0,0 +1,330 @@
+import os
+import re
+import json
+import time
+import threading
+import numpy as np
+from paths import DATA_DIRECTORY
+from embeddings import VECTOR_FIELD
+
+INPROCESS_INDEX_PATH = os.getenv("INPROCESS_INDEX_PATH", os.path.join(DATA_DIRECTORY, "search-index.bin"))
+# Elasticsearch's BM25 defaults
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Vocabulary terms a misspelled query term may expand to
+FUZZY_MAX_EXPANSIONS = int(os.getenv("FUZZY_MAX_EXPANSIONS", "50"))
+# Expansions remembered per unknown term
+FUZZY_CACHE_SIZE = 10000
+HISTOGRAM_BUCKETS = 64
+
+# Same fields, boosts and phrase clause as build_search_query
+FIELD_BOOSTS = {"title": 1.0, "text": 3.0}
+PHRASE_FIELD = "text"
+PHRASE_BOOST = 2.0
+
+MAGIC = b"PRTNIDX1"
+ALIGNMENT = 8
+# Close to the standard analyzer: lowercased runs of letters, digits and _
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def analyze(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def fuzzy_distance(length):
+    # fuzziness AUTO
+    if length < 3:
+        return 0
+    return 1 if length <= 5 else 2
+
+
+def character_histogram(term):
+    # Characters hashed into a fixed number of buckets; collisions only make
+    # the distance bound in InProcessIndex.expand looser, never wrong
+    histogram = np.zeros(HISTOGRAM_BUCKETS, dtype=np.int16)
+    for character in term:
+        histogram[ord(character) % HISTOGRAM_BUCKETS] += 1
+    return histogram
+
+
+def edit_distance(a, b, limit):
+    # Levenshtein with adjacent transpositions, like Lucene's fuzzy queries;
+    # returns limit + 1 as soon as the distance is known to exceed limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if previous2 is not None and i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def build_index(documents, path=INPROCESS_INDEX_PATH, name=None):
+    # documents are the chunks ingest_documents/iter_ingest produce. Writes
+    # one file: a JSON header followed by the raw arrays it describes.
+    vocabulary = {}
+    sources = {}
+    postings = {field: {} for field in FIELD_BOOSTS}
+    lengths = {field: [] for field in FIELD_BOOSTS}
+    doc_sources = []
+    stored = []
+
+    for doc_number, doc in enumerate(documents):
+        stored.append(json.dumps({key: value for key, value in doc.items() if key != VECTOR_FIELD}).encode('utf-8'))
+        doc_sources.append(sources.setdefault(doc.get('source', ''), len(sources)))
+        for field in FIELD_BOOSTS:
+            tokens = analyze(doc.get(field) or '')
+            lengths[field].append(len(tokens))
+            positions = {}
+            for position, token in enumerate(tokens):
+                positions.setdefault(vocabulary.setdefault(token, len(vocabulary)), []).append(position)
+            for term_id, term_positions in positions.items():
+                postings[field].setdefault(term_id, []).append((doc_number, term_positions))
+
+    arrays = {}
+    header_fields = {}
+    for field in FIELD_BOOSTS:
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        docs, frequencies, position_offsets, positions = [], [], [0], []
+        for term_id in range(len(vocabulary)):
+            for doc_number, term_positions in postings[field].get(term_id, ()):
+                docs.append(doc_number)
+                frequencies.append(len(term_positions))
+                if field == PHRASE_FIELD:
+                    positions.extend(term_positions)
+                    position_offsets.append(len(positions))
+            offsets[term_id + 1] = len(docs)
+        field_lengths = np.asarray(lengths[field], dtype=np.float32)
+        arrays[f"{field}.offsets"] = offsets
+        arrays[f"{field}.docs"] = np.asarray(docs, dtype=np.int32)
+        arrays[f"{field}.frequencies"] = np.asarray(frequencies, dtype=np.float32)
+        arrays[f"{field}.lengths"] = field_lengths
+        if field == PHRASE_FIELD:
+            arrays[f"{field}.position_offsets"] = np.asarray(position_offsets, dtype=np.int64)
+            arrays[f"{field}.positions"] = np.asarray(positions, dtype=np.int32)
+        with_field = int(np.count_nonzero(field_lengths))
+        header_fields[field] = {
+            "doc_count": with_field,
+            "average_length": float(field_lengths.sum() / with_field) if with_field else 0.0,
+        }
+
+    arrays["doc_sources"] = np.asarray(doc_sources, dtype=np.int32)
+    arrays["doc_offsets"] = np.cumsum([0] + [len(blob) for blob in stored], dtype=np.int64)
+    arrays["doc_blob"] = np.frombuffer(b"".join(stored), dtype=np.uint8)
+
+    layout = {}
+    position = 0
+    for key, array in arrays.items():
+        layout[key] = [array.dtype.str, position, int(array.size)]
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        "name": name or time.strftime('%Y%m%d%H%M%S', time.gmtime()),
+        "documents": len(stored),
+        "vocabulary": sorted(vocabulary, key=vocabulary.get),
+        "sources": sorted(sources, key=sources.get),
+        "fields": header_fields,
+        "arrays": layout,
+    }).encode('utf-8')
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC)
+        file.write(len(header).to_bytes(8, 'little'))
+        file.write(header)
+        for array in arrays.values():
+            data = array.tobytes()
+            file.write(data)
+            file.write(b"\0" * (-len(data) % ALIGNMENT))
+    os.replace(tmp_path, path)
+    print(f"Built in-process index {path}: {len(stored)} documents, {len(vocabulary)} terms")
+    return path
+
+
+class InProcessIndex:
+    # BM25 over an index file written by build_index. The arrays are views of
+    # a read-only memory map, so the OS page cache holds them and processes
+    # serving the same file share that memory.
+
+    def __init__(self, path=INPROCESS_INDEX_PATH):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not an in-process search index")
+        header_length = int.from_bytes(bytes(self.data[len(MAGIC):len(MAGIC) + 8]), 'little')
+        start = len(MAGIC) + 8
+        header = json.loads(bytes(self.data[start:start + header_length]))
+        start += header_length
+
+        self.name = header["name"]
+        self.documents = header["documents"]
+        self.fields = header["fields"]
+        self.vocabulary = {term: term_id for term_id, term in enumerate(header["vocabulary"])}
+        self.source_ids = {source: source_id for source_id, source in enumerate(header["sources"])}
+        self.arrays = {
+            key: np.frombuffer(self.data, dtype=np.dtype(dtype), count=count, offset=start + offset)
+            for key, (dtype, offset, count) in header["arrays"].items()
+        }
+        self.terms = header["vocabulary"]
+        # BM25 length normalization per document, fixed for the file's lifetime
+        self.norms = {
+            field: BM25_K1 * (1 - BM25_B + BM25_B * self.arrays[f"{field}.lengths"] / max(stats["average_length"], 1e-9))
+            for field, stats in self.fields.items()
+        }
+        # Built on the first unknown query term, see expand()
+        self.term_histograms = None
+        self.term_lengths = None
+        self.expansions = {}
+        self.lock = threading.Lock()
+
+    def document(self, doc_number):
+        offsets = self.arrays["doc_offsets"]
+        return json.loads(self.arrays["doc_blob"][offsets[doc_number]:offsets[doc_number + 1]].tobytes())
+
+    def document_frequency(self, field, term_id):
+        offsets = self.arrays[f"{field}.offsets"]
+        return int(offsets[term_id + 1] - offsets[term_id])
+
+    def expand(self, token):
+        # Known terms match exactly; an unknown one (usually a typo) expands to
+        # vocabulary terms within the fuzziness AUTO edit distance, weighted
+        # down by how far they are, as Lucene does
+        term_id = self.vocabulary.get(token)
+        if term_id is not None:
+            return [(term_id, 1.0)]
+        with self.lock:
+            cached = self.expansions.get(token)
+        if cached is not None:
+            return cached
+
+        limit = fuzzy_distance(len(token))
+        candidates = []
+        if limit:
+            # Half the L1 distance between character histograms is a lower
+            # bound on the edit distance, so only the few terms that pass it
+            # get the exact comparison
+            histograms, lengths = self.character_histograms()
+            bounds = np.abs(histograms - character_histogram(token)).sum(axis=1) / 2
+            nearby = np.flatnonzero((np.abs(lengths - len(token)) <= limit) & (bounds <= limit))
+            for term_id in nearby:
+                term = self.terms[term_id]
+                distance = edit_distance(token, term, limit)
+                if distance <= limit:
+                    frequency = self.document_frequency(PHRASE_FIELD, term_id) + self.document_frequency("title", term_id)
+                    candidates.append((distance, -frequency, term, int(term_id)))
+        candidates.sort()
+        expanded = [
+            (term_id, 1.0 - distance / min(len(token), len(term)))
+            for distance, _, term, term_id in candidates[:FUZZY_MAX_EXPANSIONS]
+        ]
+        with self.lock:
+            if len(self.expansions) >= FUZZY_CACHE_SIZE:
+                self.expansions.clear()
+            self.expansions[token] = expanded
+        return expanded
+
+    def character_histograms(self):
+        with self.lock:
+            if self.term_histograms is None:
+                self.term_histograms = np.stack([character_histogram(term) for term in self.terms]) if self.terms else np.zeros((0, HISTOGRAM_BUCKETS), dtype=np.int16)
+                self.term_lengths = np.array([len(term) for term in self.terms], dtype=np.int32)
+        return self.term_histograms, self.term_lengths
+
+    def idf(self, field, document_frequencies):
+        doc_count = self.fields[field]["doc_count"]
+        return np.log(1 + (doc_count - document_frequencies + 0.5) / (document_frequencies + 0.5))
+
+    def field_scores(self, field, term_ids, weights):
+        # BM25 of every query term at once: the terms' postings are gathered
+        # into flat arrays and summed per document with one bincount
+        offsets = self.arrays[f"{field}.offsets"]
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        starts = offsets[term_ids]
+        counts = offsets[term_ids + 1] - starts
+        total = int(counts.sum())
+        if not total:
+            return np.zeros(self.documents)
+        postings = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        docs = self.arrays[f"{field}.docs"][postings]
+        frequencies = self.arrays[f"{field}.frequencies"][postings]
+        term_weights = np.repeat(np.asarray(weights) * self.idf(field, counts), counts)
+        contributions = term_weights * frequencies / (frequencies + self.norms[field][docs])
+        return np.bincount(docs, contributions, minlength=self.documents)
+
+    def phrase_scores(self, tokens, scores):
+        # match_phrase on text: exact terms in consecutive positions, scored as
+        # BM25 of the phrase frequency with the summed idf of its terms
+        term_ids = [self.vocabulary.get(token) for token in tokens]
+        if not term_ids or None in term_ids:
+            return
+        if len(term_ids) == 1:
+            scores += self.field_scores(PHRASE_FIELD, term_ids, [PHRASE_BOOST])
+            return
+
+        offsets = self.arrays[f"{PHRASE_FIELD}.offsets"]
+        docs = self.arrays[f"{PHRASE_FIELD}.docs"]
+        position_offsets = self.arrays[f"{PHRASE_FIELD}.position_offsets"]
+        positions = self.arrays[f"{PHRASE_FIELD}.positions"]
+        candidates = None
+        for term_id in term_ids:
+            term_docs = docs[offsets[term_id]:offsets[term_id + 1]]
+            candidates = term_docs if candidates is None else np.intersect1d(candidates, term_docs, assume_unique=True)
+            if not len(candidates):
+                return
+
+        idf = self.idf(PHRASE_FIELD, np.array([self.document_frequency(PHRASE_FIELD, term_id) for term_id in term_ids])).sum()
+        for doc_number in candidates:
+            starts = None
+            for offset, term_id in enumerate(term_ids):
+                start, end = offsets[term_id], offsets[term_id + 1]
+                posting = start + np.searchsorted(docs[start:end], doc_number)
+                term_positions = positions[position_offsets[posting]:position_offsets[posting + 1]] - offset
+                starts = term_positions if starts is None else np.intersect1d(starts, term_positions, assume_unique=True)
+                if not len(starts):
+                    break
+            frequency = len(starts)
+            if frequency:
+                scores[doc_number] += PHRASE_BOOST * idf * frequency / (frequency + self.norms[PHRASE_FIELD][doc_number])
+
+    def search(self, query, size=5, source=None):
+        tokens = analyze(query)
+        if not tokens or not self.documents:
+            return []
+
+        # multi_match best_fields: the best boosted field score per document
+        terms = [expansion for token in tokens for expansion in self.expand(token)]
+        if not terms:
+            return []
+        term_ids, weights = zip(*terms)
+        scores = np.zeros(self.documents)
+        for field, boost in FIELD_BOOSTS.items():
+            np.maximum(scores, boost * self.field_scores(field, term_ids, weights), out=scores)
+
+        matched = scores > 0
+        if source:
+            source_id = self.source_ids.get(source)
+            if source_id is None:
+                return []
+            matched &= self.arrays["doc_sources"] == source_id
+        if not matched.any():
+            return []
+
+        # The phrase clause only adds to documents the must clause matched
+        phrase = np.zeros(self.documents)
+        self.phrase_scores(tokens, phrase)
+        scores = np.where(matched, scores + phrase, 0)
+
+        candidates = np.flatnonzero(matched)
+        if len(candidates) > size:
+            candidates = candidates[np.argpartition(-scores[candidates], size - 1)[:size]]
+        ranked = candidates[np.lexsort((candidates, -scores[candidates]))]
+        return [self.document(doc_number) for doc_number in ranked]
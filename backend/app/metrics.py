@@ -0,0 +1,233 @@
+import time
+import bisect
+import threading
+
+# Prometheus metrics kept in this process and rendered in the text exposition
+# format by /metrics. Each uvicorn worker keeps its own values, so with
+# several workers every scrape sees one of them.
+
+# Upper bounds in seconds, from sub-millisecond searches to slow LLM calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, key, extra, value in self.samples():
+            lines.append(f"{name}{format_labels(self.labelnames, key, extra)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        # Read at scrape time, for values other modules already keep
+        self.functions = {}
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def samples(self):
+        samples = super().samples()
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                samples.append((self.name, key, (), function()))
+            except Exception as e:
+                print(f"Error reading gauge {self.name}: {e}")
+        return samples
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", key, (("le", format_value(bound)),), cumulative))
+            samples.append((f"{self.name}_sum", key, (), total))
+            samples.append((f"{self.name}_count", key, (), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP requests by route and status code", ["method", "path", "status"]))
+http_request_seconds = registry.register(Histogram(
+    "http_request_duration_seconds", "Time until the last byte of the response was sent", ["method", "path"]))
+http_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being handled", ["path"]))
+stage_seconds = registry.register(Histogram(
+    "rag_stage_duration_seconds", "Time spent in each stage of answering a question", ["stage"]))
+stage_in_flight = registry.register(Gauge(
+    "rag_stage_in_flight", "Answers currently in each stage", ["stage"]))
+answers = registry.register(Counter(
+    "rag_answers_total", "Answers recorded by where they came from", ["source"]))
+tokens = registry.register(Counter(
+    "rag_tokens_total", "OpenAI tokens spent", ["model", "kind"]))
+openai_cost = registry.register(Counter(
+    "rag_openai_cost_dollars_total", "OpenAI spend in US dollars", ["model"]))
+context_tokens = registry.register(Counter(
+    "rag_context_tokens_total", "Retrieved context tokens sent to the LLM, and saved by context packing", ["model", "kind"]))
+llm_errors = registry.register(Counter(
+    "rag_llm_errors_total", "Failed OpenAI calls", ["model"]))
+search_errors = registry.register(Counter(
+    "rag_search_errors_total", "Failed searches", ["backend"]))
+db_errors = registry.register(Counter(
+    "rag_db_errors_total", "Failed database operations", ["operation"]))
+db_write_seconds = registry.register(Histogram(
+    "rag_db_write_duration_seconds", "Time to write one batch of the write-behind writer"))
+queue_depth = registry.register(Gauge(
+    "rag_queue_depth", "Items waiting in a background queue", ["queue"]))
+db_connections_in_use = registry.register(Gauge(
+    "rag_db_connections_in_use", "Database connections checked out of the pool"))
+
+
+class StageTimer:
+    # with StageTimer("retrieval") as timer: ... records the stage in the
+    # histogram and the in-flight gauge; timer.elapsed is the duration in
+    # seconds, for storing alongside the conversation
+    def __init__(self, stage):
+        self.stage = stage
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        stage_in_flight.inc(stage=self.stage)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.elapsed = time.perf_counter() - self.start_time
+        stage_in_flight.dec(stage=self.stage)
+        stage_seconds.observe(self.elapsed, stage=self.stage)
+        return False
+
+
+class MetricsMiddleware:
+    # Plain ASGI middleware rather than @app.middleware("http"), so streamed
+    # responses are timed until their last chunk instead of their headers
+    def __init__(self, app, paths=None):
+        self.app = app
+        # Known paths are labelled as is, anything else as "other", so
+        # scanners cannot create unbounded label values
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        path = scope["path"]
+        if self.paths is not None and path not in self.paths():
+            path = "other"
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        http_in_flight.inc(path=path)
+        start_time = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.dec(path=path)
+            http_request_seconds.observe(time.perf_counter() - start_time, method=method, path=path)
+            http_requests.inc(method=method, path=path, status=status["code"])
@@ -0,0 +1,253 @@
+import argparse
+from datetime import timezone
+from db import db_pool, DB_DISABLED
+from partitions import create_partition, ensure_partitions
+
+# Schema changes are applied in order, each once, and recorded in
+# schema_migrations. They never drop data: databases created by earlier
+# versions of prep.py are adopted by migration 1 and upgraded from there.
+# Append new migrations to MIGRATIONS, never edit applied ones.
+MIGRATION_LOCK_ID = 72212
+
+ROLLUP_TABLES = ("rollup_minute", "rollup_hour")
+
+CONVERSATION_COLUMNS = (
+    "id", "question", "answer", "model_used", "response_time",
+    "retrieval_time", "prompt_time", "evaluation_time", "persistence_time",
+    "relevance", "relevance_explanation", "prompt_tokens", "completion_tokens", "total_tokens",
+    "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens", "openai_cost", "timestamp",
+)
+
+
+def create_base_tables(cur):
+    # The schema init_db used to recreate on every prep.py run
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversations (
+            id TEXT PRIMARY KEY,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS feedback (
+            id SERIAL PRIMARY KEY,
+            conversation_id TEXT REFERENCES conversations(id),
+            feedback INTEGER NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    """)
+
+def add_stage_timings(cur):
+    for column in ("retrieval_time", "prompt_time", "evaluation_time", "persistence_time"):
+        cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} FLOAT")
+
+def add_indexes_and_rollups(cur):
+    # Time-range scans for dashboards and rollups, and feedback lookups
+    cur.execute("CREATE INDEX IF NOT EXISTS conversations_timestamp_idx ON conversations (timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS feedback_timestamp_idx ON feedback (timestamp)")
+    cur.execute("CREATE INDEX IF NOT EXISTS feedback_conversation_id_idx ON feedback (conversation_id)")
+    # Pre-aggregated per-minute and per-hour statistics for the Grafana
+    # dashboards, maintained by rollup.py. model_used 'all' rows cover every model.
+    for table in ROLLUP_TABLES:
+        cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+                model_used TEXT NOT NULL,
+                requests INTEGER NOT NULL DEFAULT 0,
+                cached_requests INTEGER NOT NULL DEFAULT 0,
+                answer_time_p50 FLOAT,
+                answer_time_p95 FLOAT,
+                answer_time_p99 FLOAT,
+                response_time_p50 FLOAT,
+                response_time_p95 FLOAT,
+                retrieval_time_avg FLOAT,
+                evaluation_time_avg FLOAT,
+                persistence_time_avg FLOAT,
+                prompt_tokens BIGINT NOT NULL DEFAULT 0,
+                completion_tokens BIGINT NOT NULL DEFAULT 0,
+                total_tokens BIGINT NOT NULL DEFAULT 0,
+                eval_total_tokens BIGINT NOT NULL DEFAULT 0,
+                openai_cost FLOAT NOT NULL DEFAULT 0,
+                relevant INTEGER NOT NULL DEFAULT 0,
+                partly_relevant INTEGER NOT NULL DEFAULT 0,
+                non_relevant INTEGER NOT NULL DEFAULT 0,
+                pending INTEGER NOT NULL DEFAULT 0,
+                not_evaluated INTEGER NOT NULL DEFAULT 0,
+                unknown INTEGER NOT NULL DEFAULT 0,
+                thumbs_up INTEGER NOT NULL DEFAULT 0,
+                thumbs_down INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (bucket, model_used)
+            )
+        """)
+
+def partition_conversations(cur):
+    # Moves conversations into a table partitioned by month. The primary key
+    # of a partitioned table has to include the partition key, so it becomes
+    # (id, timestamp), and feedback loses its foreign key; write_batch
+    # already skips feedback for unknown conversations.
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = 'conversations'::regclass")
+    if cur.fetchone()[0] == "p":
+        return
+    cur.execute("ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_conversation_id_fkey")
+    cur.execute("ALTER TABLE conversations RENAME TO conversations_unpartitioned")
+    cur.execute("ALTER INDEX IF EXISTS conversations_pkey RENAME TO conversations_unpartitioned_pkey")
+    cur.execute("ALTER INDEX IF EXISTS conversations_timestamp_idx RENAME TO conversations_unpartitioned_timestamp_idx")
+    cur.execute("""
+        CREATE TABLE conversations (
+            id TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            model_used TEXT NOT NULL,
+            response_time FLOAT NOT NULL,
+            retrieval_time FLOAT,
+            prompt_time FLOAT,
+            evaluation_time FLOAT,
+            persistence_time FLOAT,
+            relevance TEXT NOT NULL,
+            relevance_explanation TEXT NOT NULL,
+            prompt_tokens INTEGER NOT NULL,
+            completion_tokens INTEGER NOT NULL,
+            total_tokens INTEGER NOT NULL,
+            eval_prompt_tokens INTEGER NOT NULL,
+            eval_completion_tokens INTEGER NOT NULL,
+            eval_total_tokens INTEGER NOT NULL,
+            openai_cost FLOAT NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)
+    """)
+    cur.execute("CREATE INDEX conversations_timestamp_idx ON conversations (timestamp)")
+    cur.execute("CREATE TABLE conversations_default PARTITION OF conversations DEFAULT")
+
+    cur.execute("SELECT DISTINCT date_trunc('month', timestamp AT TIME ZONE 'UTC') FROM conversations_unpartitioned")
+    for (month,) in cur.fetchall():
+        create_partition(cur, month.replace(tzinfo=timezone.utc))
+    ensure_partitions(cur)
+    columns = ", ".join(CONVERSATION_COLUMNS)
+    cur.execute(f"INSERT INTO conversations ({columns}) SELECT {columns} FROM conversations_unpartitioned")
+    print(f"Moved {cur.rowcount} conversations into monthly partitions")
+    cur.execute("DROP TABLE conversations_unpartitioned")
+
+def create_archive_log(cur):
+    # Partitions whose text or rows partitions.py archived to files
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_archives (
+            partition TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            path TEXT NOT NULL,
+            rows INTEGER NOT NULL,
+            archived_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (partition, kind)
+        )
+    """)
+
+def add_context_tokens(cur):
+    # Context tokens sent per answer and how many context packing saved
+    for column in ("context_tokens", "context_tokens_saved"):
+        cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} INTEGER")
+
+
+MIGRATIONS = [
+    (1, "conversations and feedback tables", create_base_tables),
+    (2, "stage timing columns", add_stage_timings),
+    (3, "indexes and rollup tables", add_indexes_and_rollups),
+    (4, "monthly partitions for conversations", partition_conversations),
+    (5, "conversation archive log", create_archive_log),
+    (6, "context token columns", add_context_tokens),
+]
+
+
+def migrate():
+    # Brings the schema up to date, one transaction per migration. Several
+    # processes starting at once wait for each other on an advisory lock.
+    if DB_DISABLED:
+        print("DB_DISABLED is set, skipping database migrations")
+        return
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+            try:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_migrations (
+                        version INTEGER PRIMARY KEY,
+                        description TEXT NOT NULL,
+                        applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+                    )
+                """)
+                conn.commit()
+                cur.execute("SELECT version FROM schema_migrations")
+                applied = {version for (version,) in cur.fetchall()}
+                pending = [migration for migration in MIGRATIONS if migration[0] not in applied]
+                for version, description, migration in pending:
+                    print(f"Applying migration {version}: {description}")
+                    migration(cur)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                        (version, description),
+                    )
+                    conn.commit()
+                print(f"Database schema is at version {MIGRATIONS[-1][0]} ({len(pending)} migrations applied)")
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                conn.commit()
+    finally:
+        db_pool.putconn(conn)
+
+def reset():
+    # Development only: drops every table and migrates from scratch
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            print("Dropping tables if they exist...")
+            for table in ("feedback", "conversations", "schema_migrations", "conversation_archives") + ROLLUP_TABLES:
+                cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE")
+        conn.commit()
+    finally:
+        db_pool.putconn(conn)
+    migrate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Apply pending database migrations")
+    parser.add_argument("--reset", action="store_true", help="drop every table first, losing all conversations")
+    parser.add_argument("--status", action="store_true", help="only list applied and pending migrations")
+    args = parser.parse_args()
+
+    if args.status:
+        conn = db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('schema_migrations')")
+                applied = {}
+                if cur.fetchone()[0] is not None:
+                    cur.execute("SELECT version, applied_at FROM schema_migrations")
+                    applied = dict(cur.fetchall())
+        finally:
+            db_pool.putconn(conn)
+        for version, description, _ in MIGRATIONS:
+            print(f"{version:>3} {description:<40} {applied.get(version, 'pending')}")
+        return
+    if args.reset:
+        reset()
+    else:
+        migrate()
+
+
+if __name__ == "__main__":
+    main()
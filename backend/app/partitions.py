@@ -0,0 +1,301 @@
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from psycopg2 import sql
+from fastapi.concurrency import run_in_threadpool
+from db import db_pool, DB_DISABLED
+from metrics import db_errors
+from paths import DATA_DIRECTORY
+
+# conversations is partitioned by month of timestamp (in UTC). Partitions are
+# created ahead of time, rows outside every partition land in
+# conversations_default and are moved out when their partition is created.
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "2"))
+# Seconds between partition maintenance runs in the app, 0 disables the job
+PARTITION_MAINTENANCE_INTERVAL = float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", "3600"))
+# Months of conversations kept, counting whole months before the current
+# one; 0 keeps everything. Older partitions are dropped, or only detached
+# with RETENTION_ACTION=detach so they can be exported or re-attached.
+CONVERSATION_RETENTION_MONTHS = int(os.getenv("CONVERSATION_RETENTION_MONTHS", "0"))
+RETENTION_ACTION = os.getenv("RETENTION_ACTION", "drop")
+# When set, partitions are written there as gzipped JSON lines before they
+# are dropped, and ARCHIVE_TEXT_AFTER_MONTHS > 0 moves the question, answer
+# and relevance explanation of older partitions there, keeping the rest of
+# each row for the dashboards
+ARCHIVE_DIRECTORY = os.getenv("ARCHIVE_DIRECTORY", "")
+ARCHIVE_TEXT_AFTER_MONTHS = int(os.getenv("ARCHIVE_TEXT_AFTER_MONTHS", "0"))
+ARCHIVE_BATCH_SIZE = 1000
+MAINTENANCE_LOCK_ID = 72211
+
+TEXT_COLUMNS = ("question", "answer", "relevance_explanation")
+PARTITION_PATTERN = re.compile(r"^conversations_p(\d{4})(\d{2})$")
+
+
+def month_start(moment):
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+def add_months(start, months):
+    index = start.year * 12 + start.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=timezone.utc)
+
+def partition_name(start):
+    return f"conversations_p{start.year:04d}{start.month:02d}"
+
+def bound(moment):
+    # Partition bounds have to be literals
+    return sql.Literal(moment.isoformat())
+
+
+def list_partitions(cur):
+    # (name, month start) of the monthly partitions, oldest first
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'conversations'::regclass
+    """)
+    partitions = []
+    for (name,) in cur.fetchall():
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            partitions.append((name, datetime(int(match[1]), int(match[2]), 1, tzinfo=timezone.utc)))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+def create_partition(cur, start):
+    # Returns False if the partition already exists
+    name = partition_name(start)
+    cur.execute("SELECT to_regclass(%s)", (name,))
+    if cur.fetchone()[0] is not None:
+        return False
+    end = add_months(start, 1)
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE conversations INCLUDING DEFAULTS)").format(sql.Identifier(name)))
+    # Attaching checks the default partition holds no rows of this range, so
+    # any that landed there first are moved over
+    cur.execute(
+        sql.SQL("""
+            WITH moved AS (
+                DELETE FROM conversations_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+            )
+            INSERT INTO {} SELECT * FROM moved
+        """).format(sql.Identifier(name)),
+        (start, end),
+    )
+    cur.execute(sql.SQL("ALTER TABLE conversations ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+        sql.Identifier(name), bound(start), bound(end)))
+    print(f"Created partition {name}")
+    return True
+
+def ensure_partitions(cur, now=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    # The current month and months_ahead after it
+    start = month_start(now or datetime.now(timezone.utc))
+    return sum(create_partition(cur, add_months(start, offset)) for offset in range(months_ahead + 1))
+
+
+def archive_path(name, suffix, directory=ARCHIVE_DIRECTORY):
+    return os.path.join(directory, f"{name}.{suffix}.jsonl.gz")
+
+def export_partition(conn, name, columns, path):
+    # Streams the rows through a server-side cursor into a gzipped JSON
+    # lines file, written under a temporary name and renamed when complete
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    rows = 0
+    with conn.cursor(name=f"export_{name}") as cur, gzip.open(tmp_path, "wt", encoding="utf-8") as file:
+        cur.itersize = ARCHIVE_BATCH_SIZE
+        cur.execute(sql.SQL("SELECT {} FROM {}").format(
+            sql.SQL(", ").join(map(sql.Identifier, columns)), sql.Identifier(name)))
+        for row in cur:
+            file.write(json.dumps(dict(zip(columns, row)), default=str) + "\n")
+            rows += 1
+    os.replace(tmp_path, path)
+    return rows
+
+def partition_columns(cur):
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = 'conversations' ORDER BY ordinal_position
+    """)
+    return [column for (column,) in cur.fetchall()]
+
+def archive_text(conn, name, directory=ARCHIVE_DIRECTORY):
+    path = archive_path(name, "text", directory)
+    rows = export_partition(conn, name, ("id", "timestamp") + TEXT_COLUMNS, path)
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL("UPDATE {} SET question = '', answer = '', relevance_explanation = ''").format(sql.Identifier(name)))
+        cur.execute(
+            "INSERT INTO conversation_archives (partition, kind, path, rows, archived_at) VALUES (%s, 'text', %s, %s, now())",
+            (name, path, rows),
+        )
+    conn.commit()
+    print(f"Archived text of {rows} conversations in {name} to {path}")
+
+def retire_partition(conn, name, action=RETENTION_ACTION, directory=ARCHIVE_DIRECTORY):
+    with conn.cursor() as cur:
+        if action == "drop":
+            # Feedback goes with its conversations, whenever it was given
+            cur.execute(sql.SQL("DELETE FROM feedback WHERE conversation_id IN (SELECT id FROM {})").format(
+                sql.Identifier(name)))
+        cur.execute(sql.SQL("ALTER TABLE conversations DETACH PARTITION {}").format(sql.Identifier(name)))
+        if action == "detach":
+            conn.commit()
+            print(f"Detached partition {name}")
+            return
+        if directory:
+            path = archive_path(name, "rows", directory)
+            rows = export_partition(conn, name, partition_columns(cur), path)
+            cur.execute(
+                "INSERT INTO conversation_archives (partition, kind, path, rows, archived_at) VALUES (%s, 'rows', %s, %s, now())",
+                (name, path, rows),
+            )
+            print(f"Archived {rows} conversations in {name} to {path}")
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+    conn.commit()
+    print(f"Dropped partition {name}")
+
+
+def run_maintenance(
+    now=None,
+    months_ahead=PARTITION_MONTHS_AHEAD,
+    retention_months=CONVERSATION_RETENTION_MONTHS,
+    archive_text_after_months=ARCHIVE_TEXT_AFTER_MONTHS,
+    action=RETENTION_ACTION,
+    directory=ARCHIVE_DIRECTORY,
+):
+    # Creates upcoming partitions, archives text and retires old partitions.
+    # Returns None when another process holds the maintenance lock, else
+    # counts of what was done.
+    if action not in ("drop", "detach"):
+        raise ValueError(f"Unknown RETENTION_ACTION {action!r}, expected drop or detach")
+    current = month_start(now or datetime.now(timezone.utc))
+    done = {"created": 0, "text_archived": 0, "retired": 0}
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (MAINTENANCE_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return None
+        try:
+            with conn.cursor() as cur:
+                done["created"] = ensure_partitions(cur, current, months_ahead)
+                conn.commit()
+                partitions = list_partitions(cur)
+                cur.execute("SELECT partition FROM conversation_archives WHERE kind = 'text'")
+                text_archived = {name for (name,) in cur.fetchall()}
+            conn.commit()
+
+            # One transaction per partition, so a failure keeps earlier work
+            retention_cutoff = add_months(current, -retention_months) if retention_months > 0 else None
+            if directory and archive_text_after_months > 0:
+                cutoff = add_months(current, -archive_text_after_months)
+                for name, start in partitions:
+                    retiring = retention_cutoff is not None and start < retention_cutoff
+                    if start < cutoff and name not in text_archived and not retiring:
+                        archive_text(conn, name, directory)
+                        done["text_archived"] += 1
+            if retention_cutoff is not None:
+                for name, start in partitions:
+                    if start < retention_cutoff:
+                        retire_partition(conn, name, action, directory)
+                        done["retired"] += 1
+        finally:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MAINTENANCE_LOCK_ID,))
+            conn.commit()
+        return done
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+
+class PartitionMaintenanceJob:
+    # Runs run_maintenance every interval seconds on the threadpool
+
+    def __init__(self, interval=PARTITION_MAINTENANCE_INTERVAL):
+        self.interval = interval
+        self.task = None
+        self.stats = {"runs": 0, "skipped": 0, "failed": 0, "created": 0, "text_archived": 0, "retired": 0}
+
+    async def start(self):
+        if DB_DISABLED or self.interval <= 0:
+            return
+        self.task = asyncio.create_task(self._run())
+        print(f"Started partition maintenance (every {self.interval}s)")
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    def snapshot(self):
+        return {"interval": self.interval, **self.stats}
+
+    async def _run(self):
+        while True:
+            try:
+                done = await run_in_threadpool(run_maintenance)
+                if done is None:
+                    self.stats["skipped"] += 1
+                else:
+                    self.stats["runs"] += 1
+                    for key, count in done.items():
+                        self.stats[key] += count
+            except Exception as e:
+                print(f"Error in partition maintenance: {e}")
+                self.stats["failed"] += 1
+                db_errors.inc(operation="partition_maintenance")
+            await asyncio.sleep(self.interval)
+
+
+partition_job = PartitionMaintenanceJob()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create upcoming conversation partitions and apply retention")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument("--retention-months", type=int, default=CONVERSATION_RETENTION_MONTHS, help="0 keeps everything")
+    parser.add_argument("--action", choices=["drop", "detach"], default=RETENTION_ACTION)
+    parser.add_argument("--archive-directory", default=ARCHIVE_DIRECTORY or None,
+                        help=f"e.g. {os.path.join(DATA_DIRECTORY, 'archive')}")
+    parser.add_argument("--archive-text-after-months", type=int, default=ARCHIVE_TEXT_AFTER_MONTHS, help="0 keeps the text")
+    parser.add_argument("--list", action="store_true", help="only list partitions and their row counts")
+    args = parser.parse_args()
+
+    if args.list:
+        conn = db_pool.getconn()
+        try:
+            with conn.cursor() as cur:
+                for name, _ in list_partitions(cur) + [("conversations_default", None)]:
+                    cur.execute(sql.SQL("SELECT COUNT(*), pg_total_relation_size(%s) FROM {}").format(sql.Identifier(name)), (name,))
+                    rows, size = cur.fetchone()
+                    print(f"{name:>24} {rows:>10} rows {size / 1024 / 1024:>10.1f} MB")
+        finally:
+            db_pool.putconn(conn)
+        return
+
+    start_time = time.perf_counter()
+    done = run_maintenance(
+        months_ahead=args.months_ahead,
+        retention_months=args.retention_months,
+        archive_text_after_months=args.archive_text_after_months,
+        action=args.action,
+        directory=args.archive_directory or "",
+    )
+    if done is None:
+        print("Another process is running partition maintenance, try again later")
+        raise SystemExit(1)
+    print(f"Partition maintenance done in {time.perf_counter() - start_time:.2f}s: {done}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+import os
+
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# /backend/app/data inside the container, the repository's data/ in a checkout
+DATA_DIRECTORY = next(
+    (
+        path
+        for path in (os.path.join(APP_DIRECTORY, "data"), os.path.join(os.path.dirname(os.path.dirname(APP_DIRECTORY)), "data"))
+        if os.path.isdir(path)
+    ),
+    os.path.join(APP_DIRECTORY, "data"),
+)
@@ -1,16 +1,52 @@
 import os
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError
+import re
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from elasticsearch import Elasticsearch, ApiError, TransportError
 from dotenv import load_dotenv
-from ingest import ingest_documents
-from db import init_db
+from ingest import (
+    INGEST_WORKERS,
+    CHUNKER,
+    CHUNKERS,
+    iter_ingest,
+    chunk_key,
+    collect_chunk_keys,
+    load_manifest,
+    save_manifest,
+    build_manifest,
+    plan_incremental,
+)
+from migrations import migrate
+from faq import invalidate_faq_answers
+from embeddings import VECTOR_FIELD, EMBEDDING_DIRECTORY, create_embedder, load_embedder, embed_documents, embedding_text
+from inprocess import INPROCESS_INDEX_PATH, build_index
+from search import RETRIEVER_BACKEND, RETRIEVERS
 
 load_dotenv()
 
 ELASTIC_URL = os.getenv("ELASTIC_URL", "http://localhost:9200")
 INDEX_NAME = os.getenv("INDEX_NAME", "movement-wiki")
 
-def setup_elasticsearch():
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+BULK_WORKERS = int(os.getenv("BULK_WORKERS", "1"))
+BULK_MAX_RETRIES = int(os.getenv("BULK_MAX_RETRIES", "3"))
+BULK_RETRY_BACKOFF = float(os.getenv("BULK_RETRY_BACKOFF", "1.0"))
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Number of previous index versions kept around for rollback
+INDEX_RETENTION = int(os.getenv("INDEX_RETENTION", "2"))
+
+# Content hashes of the last indexed corpus, used by --incremental
+INGEST_MANIFEST = os.getenv("INGEST_MANIFEST")
+
+# Store a dense vector per chunk for RETRIEVAL_MODE=knn/hybrid
+INDEX_EMBEDDINGS = os.getenv("INDEX_EMBEDDINGS", "0") == "1"
+
+def versioned_index_name():
+    return f"{INDEX_NAME}-v{time.strftime('%Y%m%d%H%M%S', time.gmtime())}"
+
+def setup_elasticsearch(embedder=None, index_name=None):
     print("Setting up Elasticsearch...")
     es_client = Elasticsearch(ELASTIC_URL)
 
@@ -26,50 +62,283 @@ def setup_elasticsearch():
                 "text": {"type": "text"},
                 "title": {"type": "text"},
                 "url": {"type": "keyword"},
-                "source": {"type": "keyword"}
+                "source": {"type": "keyword"},
+                "token_count": {"type": "integer"}
             }
         }
     }
+    if embedder is not None:
+        index_settings["mappings"]["properties"][VECTOR_FIELD] = {
+            "type": "dense_vector",
+            "dims": embedder.dims,
+            "index": True,
+            "similarity": "cosine"
+        }
+        # Queries must embed with the model these vectors came from
+        index_settings["mappings"]["_meta"] = {"embedding_model": embedder.spec}
 
-    # Delete existing index if it exists
-    try:
-        es_client.indices.delete(index=INDEX_NAME, ignore_unavailable=True)
-        print(f"Deleted index: {INDEX_NAME}")
-    except NotFoundError:
-        print(f"Index {INDEX_NAME} not found, nothing to delete")
+    # Build into a fresh versioned index; INDEX_NAME keeps serving the
+    # previous version through the alias until swap_alias() runs
+    index_name = index_name or versioned_index_name()
+    es_client.indices.create(index=index_name, settings=index_settings['settings'], mappings=index_settings['mappings'])
+    print(f"Created index: {index_name}")
+
+    return es_client, index_name
+
+def list_index_versions(es_client):
+    pattern = re.compile(rf"^{re.escape(INDEX_NAME)}-v\d{{14}}$")
+    indices = es_client.indices.get(index=f"{INDEX_NAME}-v*")
+    return sorted(name for name in indices if pattern.match(name))
+
+def get_embedding_spec(es_client, index_name):
+    mapping = es_client.indices.get_mapping(index=index_name)[index_name]["mappings"]
+    return mapping.get("_meta", {}).get("embedding_model")
+
+def get_alias_indices(es_client):
+    if not es_client.indices.exists_alias(name=INDEX_NAME):
+        return []
+    return list(es_client.indices.get_alias(name=INDEX_NAME).keys())
+
+def verify_index(es_client, index_name, report):
+    count = es_client.count(index=index_name)["count"]
+    print(f"Index {index_name} holds {count} documents, expected {report['created']}")
+    if report["failed"]:
+        raise RuntimeError(f"{report['failed']} documents failed to index into {index_name}")
+    if count != report["created"]:
+        raise RuntimeError(f"Index {index_name} holds {count} documents, expected {report['created']}")
+
+def swap_alias(es_client, index_name):
+    actions = [
+        {"remove": {"index": old_index, "alias": INDEX_NAME}}
+        for old_index in get_alias_indices(es_client)
+        if old_index != index_name
+    ]
+    if es_client.indices.exists(index=INDEX_NAME) and not es_client.indices.exists_alias(name=INDEX_NAME):
+        # A concrete index from before versioned builds still holds the name
+        actions.append({"remove_index": {"index": INDEX_NAME}})
+    actions.append({"add": {"index": index_name, "alias": INDEX_NAME}})
 
-    # Create new index
-    es_client.indices.create(index=INDEX_NAME, settings=index_settings['settings'], mappings=index_settings['mappings'])
-    print(f"Created index: {INDEX_NAME}")
+    # All actions are applied atomically, so searches never see a missing alias
+    es_client.indices.update_aliases(actions=actions)
+    print(f"Alias {INDEX_NAME} now points to {index_name}")
+    invalidate_faq_answers()
 
-    return es_client
+def prune_index_versions(es_client, retention=INDEX_RETENTION):
+    live = set(get_alias_indices(es_client))
+    older = [name for name in list_index_versions(es_client) if name not in live]
+    # Versions are timestamped, so the newest ones sort last
+    stale = older[:-retention] if retention > 0 else older
+    for name in stale:
+        es_client.indices.delete(index=name)
+        print(f"Deleted old index version: {name}")
+        embedding_path = os.path.join(EMBEDDING_DIRECTORY, f"embeddings-{name}.npz")
+        if os.path.exists(embedding_path):
+            os.remove(embedding_path)
 
-def index_documents(es_client, documents):
-    print("Indexing documents...")
+def rollback_index(es_client):
+    live = get_alias_indices(es_client)
+    if not live:
+        raise RuntimeError(f"Alias {INDEX_NAME} does not exist, nothing to roll back")
+    previous = [name for name in list_index_versions(es_client) if name < min(live)]
+    if not previous:
+        raise RuntimeError(f"No index version older than {min(live)} to roll back to")
+    swap_alias(es_client, previous[-1])
+    return previous[-1]
+
+def batched(documents, batch_size):
+    batch = []
     for doc in documents:
-        es_client.index(index=INDEX_NAME, document=doc)
-    print(f"Indexed {len(documents)} documents")
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Bulk-index one batch, retrying rejected items; returns (indexed, created, failures)
+def send_batch(es_client, batch, index_name=INDEX_NAME, max_retries=BULK_MAX_RETRIES):
+    indexed = 0
+    created = 0
+    failures = []
+    pending = batch
+    for attempt in range(max_retries + 1):
+        operations = []
+        for doc in pending:
+            operations.append({"index": {"_index": index_name, "_id": chunk_key(doc)}})
+            operations.append(doc)
+
+        try:
+            response = es_client.bulk(operations=operations)
+        except (ApiError, TransportError) as e:
+            if attempt == max_retries:
+                failures.extend((doc, str(e)) for doc in pending)
+                break
+            print(f"Bulk request failed ({e}), retrying {len(pending)} documents...")
+            time.sleep(BULK_RETRY_BACKOFF * 2 ** attempt)
+            continue
+
+        retry = []
+        for doc, item in zip(pending, response["items"]):
+            result = item["index"]
+            status = result.get("status", 500)
+            if status < 300:
+                indexed += 1
+                if result.get("result") == "created":
+                    created += 1
+            elif status in RETRYABLE_STATUSES and attempt < max_retries:
+                retry.append(doc)
+            else:
+                failures.append((doc, result.get("error", f"status {status}")))
+
+        if not retry:
+            break
+        pending = retry
+        time.sleep(BULK_RETRY_BACKOFF * 2 ** attempt)
+
+    return indexed, created, failures
+
+def _get_refresh_interval(es_client, index_name):
+    # Keyed by the concrete index, which differs from index_name for an alias
+    settings = es_client.indices.get_settings(index=index_name)
+    return next(iter(settings.values()))["settings"]["index"].get("refresh_interval")
+
+def _set_refresh_interval(es_client, index_name, value):
+    es_client.indices.put_settings(index=index_name, settings={"index": {"refresh_interval": value}})
+
+def index_documents(
+    es_client,
+    documents,
+    index_name=INDEX_NAME,
+    batch_size=BULK_BATCH_SIZE,
+    workers=BULK_WORKERS,
+    max_retries=BULK_MAX_RETRIES,
+):
+    print(f"Indexing documents (batch size {batch_size}, {workers} worker(s))...")
+    indexed = 0
+    created = 0
+    failures = []
+    start_time = time.time()
+
+    # Refreshing while loading only produces segments nobody is searching yet
+    refresh_interval = _get_refresh_interval(es_client, index_name)
+    _set_refresh_interval(es_client, index_name, "-1")
+    try:
+        if workers <= 1:
+            for batch in batched(documents, batch_size):
+                batch_indexed, batch_created, batch_failures = send_batch(es_client, batch, index_name, max_retries)
+                indexed += batch_indexed
+                created += batch_created
+                failures.extend(batch_failures)
+        else:
+            # Keep a bounded number of batches in flight so a streamed
+            # document source is never fully materialized
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                in_flight = set()
+                for batch in batched(documents, batch_size):
+                    if len(in_flight) >= workers * 2:
+                        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            batch_indexed, batch_created, batch_failures = future.result()
+                            indexed += batch_indexed
+                            created += batch_created
+                            failures.extend(batch_failures)
+                    in_flight.add(executor.submit(send_batch, es_client, batch, index_name, max_retries))
+                for future in in_flight:
+                    batch_indexed, batch_created, batch_failures = future.result()
+                    indexed += batch_indexed
+                    created += batch_created
+                    failures.extend(batch_failures)
+    finally:
+        _set_refresh_interval(es_client, index_name, refresh_interval)
 
     # Refresh the index to make the documents available for search
-    es_client.indices.refresh(index=INDEX_NAME)
+    es_client.indices.refresh(index=index_name)
     print("Index refreshed")
 
-def main():
-    print("Starting the indexing process...")
+    elapsed = time.time() - start_time
+    report = {
+        "indexed": indexed,
+        "created": created,
+        "failed": len(failures),
+        "elapsed": elapsed,
+        "docs_per_sec": indexed / elapsed if elapsed > 0 else 0.0,
+    }
+    print(
+        f"Indexed {report['indexed']} documents in {elapsed:.2f}s "
+        f"({report['docs_per_sec']:.1f} docs/sec), {report['failed']} failed"
+    )
+    for doc, error in failures[:10]:
+        print(f"  Failed {doc['chunk_id']}: {error}")
+    if len(failures) > 10:
+        print(f"  ... and {len(failures) - 10} more failures")
 
-    # Correct path to the data directory
-    data_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "data")
-    print(f"Data directory path: {data_directory}")
-    print(f"Contents of data directory: {os.listdir(data_directory)}")
-    
-    documents = ingest_documents(data_directory)
-    print(f"Total documents ingested and processed: {len(documents)}")
-    
-    es_client = setup_elasticsearch()
-    index_documents(es_client, documents)
+    return report
+
+def delete_documents(es_client, keys, index_name=INDEX_NAME, batch_size=BULK_BATCH_SIZE):
+    deleted = 0
+    failures = []
+    for batch in batched(keys, batch_size):
+        response = es_client.bulk(operations=[{"delete": {"_index": index_name, "_id": key}} for key in batch])
+        for key, item in zip(batch, response["items"]):
+            result = item["delete"]
+            status = result.get("status", 500)
+            if status < 300 or status == 404:
+                deleted += 1
+            else:
+                failures.append((key, result.get("error", f"status {status}")))
+    print(f"Deleted {deleted} documents, {len(failures)} failed")
+    return deleted, failures
+
+def incremental_update(es_client, data_directory, manifest_path, args):
+    manifest = load_manifest(manifest_path)
+    live = get_alias_indices(es_client)
+    if manifest is None or live != [manifest["index"]] or manifest.get("chunker", "words") != args.chunker:
+        print("No manifest matching the live index and chunker, falling back to a full rebuild")
+        return False
+
+    # Changed chunks are embedded with the live index's model, whatever
+    # --embeddings says, so all vectors in the index stay comparable
+    embedder = None
+    spec = get_embedding_spec(es_client, live[0])
+    if spec:
+        try:
+            embedder = load_embedder(spec)
+        except (OSError, ImportError) as e:
+            print(f"Cannot load embedding model {spec} ({e}), falling back to a full rebuild")
+            return False
 
+    upserts, deletes, new_manifest = plan_incremental(
+        data_directory, manifest, workers=args.ingest_workers, chunker=args.chunker
+    )
+    print(f"Incremental update: {len(upserts)} chunks to upsert, {len(deletes)} to delete")
+    if embedder is not None:
+        upserts = list(embed_documents(upserts, embedder))
+
+    if upserts:
+        report = index_documents(
+            es_client,
+            upserts,
+            index_name=INDEX_NAME,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            max_retries=args.max_retries,
+        )
+        if report["failed"]:
+            raise RuntimeError(f"{report['failed']} documents failed to index, manifest not updated")
+    if deletes:
+        _, failures = delete_documents(es_client, deletes, batch_size=args.batch_size)
+        if failures:
+            raise RuntimeError(f"{len(failures)} documents failed to delete, manifest not updated")
+        es_client.indices.refresh(index=INDEX_NAME)
+
+    save_manifest(manifest_path, new_manifest)
+    if upserts or deletes:
+        invalidate_faq_answers()
+    return True
+
+def initialize_database(data_directory):
     print("Initializing database...")
-    init_db()
+    migrate()
 
     csv_path = os.path.join(data_directory, 'ground-truth-retrieval.csv')
     if os.path.exists(csv_path):
@@ -80,5 +349,85 @@ def main():
 
     print("Indexing process completed successfully!")
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the search index and initialize the database")
+    parser.add_argument("--batch-size", type=int, default=BULK_BATCH_SIZE, help="documents per bulk request")
+    parser.add_argument("--workers", type=int, default=BULK_WORKERS, help="bulk requests sent in parallel")
+    parser.add_argument("--max-retries", type=int, default=BULK_MAX_RETRIES, help="retries for rejected documents")
+    parser.add_argument("--retention", type=int, default=INDEX_RETENTION, help="previous index versions to keep")
+    parser.add_argument("--rollback", action="store_true", help="point the alias back to the previous index version and exit")
+    parser.add_argument("--ingest-workers", type=int, default=INGEST_WORKERS, help="processes used to clean and chunk documents")
+    parser.add_argument("--chunker", choices=CHUNKERS, default=CHUNKER, help="words: 500-word windows; tokens: sentence-aware token budget")
+    parser.add_argument("--incremental", action="store_true", help="only index files that changed since the last run")
+    parser.add_argument("--embeddings", action=argparse.BooleanOptionalAction, default=INDEX_EMBEDDINGS,
+                        help="store a dense vector per chunk for knn/hybrid retrieval")
+    parser.add_argument("--backend", choices=list(RETRIEVERS), default=RETRIEVER_BACKEND,
+                        help="inprocess writes a local index file (INPROCESS_INDEX_PATH) instead of using Elasticsearch")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.rollback:
+        es_client = Elasticsearch(ELASTIC_URL)
+        index_name = rollback_index(es_client)
+        print(f"Rolled back {INDEX_NAME} to {index_name}")
+        return
+
+    print("Starting the indexing process...")
+
+    # Correct path to the data directory
+    data_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "data")
+    print(f"Data directory path: {data_directory}")
+    print(f"Contents of data directory: {os.listdir(data_directory)}")
+    manifest_path = INGEST_MANIFEST or os.path.join(data_directory, "ingest-manifest.json")
+
+    if args.backend == "inprocess":
+        # The whole corpus builds in seconds, so there is no incremental mode
+        build_index(iter_ingest(data_directory, workers=args.ingest_workers, chunker=args.chunker), INPROCESS_INDEX_PATH)
+        invalidate_faq_answers()
+        initialize_database(data_directory)
+        return
+
+    if args.incremental:
+        es_client = Elasticsearch(ELASTIC_URL)
+        if incremental_update(es_client, data_directory, manifest_path, args):
+            print("Incremental indexing completed successfully!")
+            return
+
+    index_name = versioned_index_name()
+    embedder = None
+    if args.embeddings:
+        # A first pass over the corpus fits the LSA model (if that is the
+        # embedder in use) before the index and its vector mapping exist
+        texts = [embedding_text(doc) for doc in iter_ingest(data_directory, workers=args.ingest_workers, chunker=args.chunker)]
+        embedder = create_embedder(texts, index_name)
+
+    # Chunks stream straight from ingestion into the bulk indexer
+    es_client, index_name = setup_elasticsearch(embedder, index_name)
+    keys_by_source = {}
+    documents = collect_chunk_keys(iter_ingest(data_directory, workers=args.ingest_workers, chunker=args.chunker), keys_by_source)
+    if embedder is not None:
+        documents = embed_documents(documents, embedder)
+    try:
+        report = index_documents(
+            es_client,
+            documents,
+            index_name=index_name,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            max_retries=args.max_retries,
+        )
+        verify_index(es_client, index_name, report)
+    except Exception:
+        print(f"Indexing into {index_name} failed, {INDEX_NAME} left untouched")
+        es_client.indices.delete(index=index_name, ignore_unavailable=True)
+        raise
+
+    swap_alias(es_client, index_name)
+    prune_index_versions(es_client, args.retention)
+    save_manifest(manifest_path, build_manifest(data_directory, keys_by_source, index_name, args.chunker))
+    initialize_database(data_directory)
+
 if __name__ == "__main__":
     main()
@@ -1,73 +1,77 @@
 import os
-import time
+import copy
 import json
-from openai import OpenAI
-from elasticsearch import Elasticsearch
+import asyncio
+from openai import OpenAI, AsyncOpenAI
+from openai.types import CompletionUsage
 from dotenv import load_dotenv
+from tokens import count_tokens
+from cache import response_cache, make_key, as_cache_hit
+from search import retriever, RETRIEVER_BACKEND
+from metrics import StageTimer, llm_errors, search_errors
+from context import CONTEXT_PACKING, MAX_CONTEXT_TOKENS, context_budget, format_hits, pack_context
 
 load_dotenv()
 
-ELASTIC_URL = os.getenv("ELASTIC_URL", "http://localhost:9200")
-print(ELASTIC_URL)
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 # print(OPENAI_API_KEY)
-INDEX_NAME = os.getenv("INDEX_NAME", "movement-wiki")
+# LLM calls /questions/batch runs at once, shared by all batches
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+# Model that judges relevance, also what evaluations are charged at
+EVAL_MODEL = os.getenv("EVAL_MODEL", "gpt-4o-mini")
 
-es_client = Elasticsearch(ELASTIC_URL)
 client = OpenAI(api_key=OPENAI_API_KEY)
 
-def test_es_connection():
-    try:
-        if es_client.ping():
-            print("Connected to Elasticsearch")
-        else:
-            print("Could not connect to Elasticsearch")
-    except Exception as e:
-        print(f"Error connecting to Elasticsearch: {str(e)}")
+# Used by the FastAPI request path so LLM calls never block the event loop;
+# the sync client above remains for scripts and notebooks
+async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
 
-# Call this function at the start of your script
-test_es_connection()
+async def close_async_clients():
+    await retriever.close()
+    await async_client.close()
 
+# Retrieval goes through the backend selected by RETRIEVER_BACKEND
 def elastic_search(query, size=5, source=None):
-    search_query = {
-        "size": size,
-        "query": {
-            "bool": {
-                "must": [
-                    {
-                        "multi_match": {
-                            "query": query,
-                            "fields": ["title", "text^3"],
-                            "type": "best_fields",
-                            "fuzziness": "AUTO"
-                        }
-                    }
-                ],
-                "should": [
-                    {
-                        "match_phrase": {
-                            "text": {
-                                "query": query,
-                                "boost": 2
-                            }
-                        }
-                    }
-                ]
-            }
-        }
-    }
-    if source:
-        search_query["query"]["bool"]["filter"] = {
-            "term": {
-                "source": source
-            }
-        }
+    try:
+        return retriever.search(query, size, source)
+    except Exception:
+        search_errors.inc(backend=RETRIEVER_BACKEND)
+        raise
 
-    response = es_client.search(index=INDEX_NAME, body=search_query)
-    return [hit['_source'] for hit in response['hits']['hits']]
+async def elastic_search_async(query, size=5, source=None):
+    try:
+        return await retriever.search_async(query, size, source)
+    except Exception:
+        search_errors.inc(backend=RETRIEVER_BACKEND)
+        raise
 
-def build_prompt(query, search_results):
-    prompt_template = """
+async def elastic_msearch_async(queries, size=5, source=None):
+    try:
+        results = await retriever.msearch_async(queries, size, source)
+    except Exception:
+        search_errors.inc(len(queries), backend=RETRIEVER_BACKEND)
+        raise
+    failed = sum(isinstance(result, Exception) for result in results)
+    if failed:
+        search_errors.inc(failed, backend=RETRIEVER_BACKEND)
+    return results
+
+def fit_token_budget(search_results, max_tokens=MAX_CONTEXT_TOKENS):
+    if max_tokens <= 0:
+        return search_results
+
+    # token_count is stored at ingest time; older indices may lack it
+    selected = []
+    used = 0
+    for doc in search_results:
+        tokens = doc.get('token_count') or count_tokens(doc['text'])
+        if selected and used + tokens > max_tokens:
+            continue
+        selected.append(doc)
+        used += tokens
+    return selected
+
+PROMPT_TEMPLATE = """
 You are an AI-powered Assistant for Movement Labs, specializing in the Move language and the Movement Network ecosystem. 
 Answer the QUESTION based strictly on the CONTEXT from the knowledge base. If the CONTEXT does not provide enough details, request more information or clarify the question. 
 
@@ -84,16 +88,19 @@ CONTEXT:
 {context}
 """.strip()
 
-    context = "\n\n".join([
-        f"Document ID: {doc['doc_id']}\n"
-        f"Chunk ID: {doc['chunk_id']}\n"
-        f"Title: {doc['title']}\n"
-        f"URL: {doc['url']}\n"
-        f"Content: {doc['text']}"
-        for doc in search_results
-    ])
+def build_prompt(query, search_results):
+    context = format_hits(search_results)
+    return PROMPT_TEMPLATE.format(question=query, context=context).strip(), context
 
-    return prompt_template.format(question=query, context=context).strip(), context
+def prepare_prompt(query, search_results, selected_model):
+    # The prompt stage: returns the prompt, its context, the hits the
+    # context draws on and the context token report for build_answer
+    if CONTEXT_PACKING:
+        context, search_results, packing = pack_context(search_results, context_budget(selected_model))
+        return PROMPT_TEMPLATE.format(question=query, context=context).strip(), context, search_results, packing
+    search_results = fit_token_budget(search_results, context_budget(selected_model))
+    prompt, context = build_prompt(query, search_results)
+    return prompt, context, search_results, {"context_tokens": count_tokens(context), "context_tokens_saved": 0}
 
 def llm(prompt, model='gpt-4o-mini', max_tokens=500):
     try:
@@ -105,10 +112,49 @@ def llm(prompt, model='gpt-4o-mini', max_tokens=500):
         return response.choices[0].message.content, response.usage
     except Exception as e:
         print(f"An error occurred: {e}")
+        llm_errors.inc(model=model)
+        return None, None
+
+async def llm_async(prompt, model='gpt-4o-mini', max_tokens=500):
+    try:
+        response = await async_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content, response.usage
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        llm_errors.inc(model=model)
         return None, None
 
-def evaluate_relevance(question, answer):
-    evaluation_prompt_template = """
+async def llm_stream_async(prompt, model='gpt-4o-mini', max_tokens=500):
+    # Yields text deltas as they arrive, then the usage reported on the last
+    # chunk (None if the provider does not send it)
+    try:
+        stream = await async_client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+    except Exception:
+        llm_errors.inc(model=model)
+        raise
+    usage = None
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+    except Exception:
+        llm_errors.inc(model=model)
+        raise
+    yield usage
+
+EVALUATION_PROMPT_TEMPLATE = """
     You are an expert evaluator for a RAG system.
     Your task is to analyze the relevance of the generated answer to the given question.
     Based on the relevance of the generated answer, you will classify it
@@ -128,14 +174,32 @@ def evaluate_relevance(question, answer):
     }}
     """.strip()
 
-    prompt = evaluation_prompt_template.format(question=question, answer=answer)
-    evaluation, usage = llm(prompt, 'gpt-4o-mini')
+# Placeholder evaluation for answers whose relevance is judged later by the
+# background evaluation queue
+PENDING_EVALUATION = {"Relevance": "PENDING", "Explanation": "Evaluation pending"}
+NO_USAGE = CompletionUsage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
+
+# Stands in for a relevance verdict when the evaluator's reply was unusable
+FAILED_EVALUATION = {"Relevance": "EVAL_FAILED", "Explanation": "Failed to parse evaluation"}
+
+def parse_evaluation(evaluation):
+    # None unless the reply is a JSON object, so a garbled reply is never
+    # recorded as a verdict
     try:
-        json_eval = json.loads(evaluation)
-        return json_eval, usage
-    except json.JSONDecodeError:
-        result = {"Relevance": "UNKNOWN", "Explanation": "Failed to parse evaluation"}
-        return result, usage
+        parsed = json.loads(evaluation)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+def evaluate_relevance(question, answer, model=EVAL_MODEL):
+    prompt = EVALUATION_PROMPT_TEMPLATE.format(question=question, answer=answer)
+    evaluation, usage = llm(prompt, model)
+    return parse_evaluation(evaluation), usage
+
+async def evaluate_relevance_async(question, answer, model=EVAL_MODEL):
+    prompt = EVALUATION_PROMPT_TEMPLATE.format(question=question, answer=answer)
+    evaluation, usage = await llm_async(prompt, model)
+    return parse_evaluation(evaluation), usage
 
 def calculate_openai_cost(selected_model, tokens):
     openai_cost = 0
@@ -148,19 +212,14 @@ def calculate_openai_cost(selected_model, tokens):
     return openai_cost
 
 
-def get_answer(query, selected_model, size=3, source=None):
-    search_results = elastic_search(query, size, source)
-    prompt, context = build_prompt(query, search_results)
-    start_time = time.time()
-    answer, usage = llm(prompt, model=selected_model)
-    end_time = time.time()
-    response_time = end_time - start_time
-    
- 
-    evaluation, eval_usage = evaluate_relevance(query, answer)
-    
+def build_answer(
+    query, selected_model, search_results, prompt, context, answer, usage, response_time, evaluation, eval_usage,
+    retrieval_time=0.0, prompt_time=0.0, evaluation_time=None, packing=None,
+):
+    # response_time is the generation stage: the answer LLM call only
     openai_cost_rag = calculate_openai_cost(selected_model, usage)
-    openai_cost_eval = calculate_openai_cost(selected_model, eval_usage)
+    openai_cost_eval = calculate_openai_cost(EVAL_MODEL, eval_usage)
+    evaluation = evaluation or FAILED_EVALUATION
 
     openai_cost = openai_cost_rag + openai_cost_eval
 
@@ -171,6 +230,12 @@ def get_answer(query, selected_model, size=3, source=None):
         'answer': answer,
         'search_results': search_results,
         'response_time': response_time,
+        'retrieval_time': retrieval_time,
+        'prompt_time': prompt_time,
+        'evaluation_time': evaluation_time,
+        # Retrieved context sent to the LLM, and what packing kept out of it
+        'context_tokens': packing['context_tokens'] if packing else None,
+        'context_tokens_saved': packing['context_tokens_saved'] if packing else None,
         "relevance": evaluation.get("Relevance", "UNKNOWN"),
         "relevance_explanation": evaluation.get(
             "Explanation", "Failed to parse evaluation"
@@ -183,4 +248,236 @@ def get_answer(query, selected_model, size=3, source=None):
         'eval_completion_tokens': eval_usage.completion_tokens,
         'eval_total_tokens': eval_usage.total_tokens,
         'openai_cost': openai_cost
-    }
\ No newline at end of file
+    }
+
+
+def get_answer(query, selected_model, size=3, source=None):
+    cached = response_cache.get(query, selected_model, source, size)
+    if cached is not None:
+        return cached
+
+    with StageTimer("retrieval") as retrieval:
+        search_results = elastic_search(query, size, source)
+    with StageTimer("prompt") as prompt_build:
+        prompt, context, search_results, packing = prepare_prompt(query, search_results, selected_model)
+    with StageTimer("generation") as generation:
+        answer, usage = llm(prompt, model=selected_model)
+
+    with StageTimer("evaluation") as evaluating:
+        evaluation, eval_usage = evaluate_relevance(query, answer)
+
+    result = build_answer(
+        query, selected_model, search_results, prompt, context,
+        answer, usage, generation.elapsed, evaluation, eval_usage,
+        retrieval.elapsed, prompt_build.elapsed, evaluating.elapsed, packing,
+    )
+    response_cache.put(query, selected_model, source, size, result)
+    return result
+
+
+async def get_answer_async(query, selected_model, size=3, source=None, evaluate=True, use_cache=True):
+    cached = await response_cache.get_async(query, selected_model, source, size) if use_cache else None
+    if cached is not None:
+        return cached
+
+    with StageTimer("retrieval") as retrieval:
+        search_results = await elastic_search_async(query, size, source)
+    with StageTimer("prompt") as prompt_build:
+        prompt, context, search_results, packing = prepare_prompt(query, search_results, selected_model)
+    with StageTimer("generation") as generation:
+        answer, usage = await llm_async(prompt, model=selected_model)
+
+    evaluation_time = None
+    if evaluate:
+        with StageTimer("evaluation") as evaluating:
+            evaluation, eval_usage = await evaluate_relevance_async(query, answer)
+        evaluation_time = evaluating.elapsed
+    else:
+        evaluation, eval_usage = PENDING_EVALUATION, NO_USAGE
+
+    result = build_answer(
+        query, selected_model, search_results, prompt, context,
+        answer, usage, generation.elapsed, evaluation, eval_usage,
+        retrieval.elapsed, prompt_build.elapsed, evaluation_time, packing,
+    )
+    if use_cache:
+        response_cache.put(query, selected_model, source, size, result)
+    return result
+
+
+async def get_answer_stream(query, selected_model, size=3, source=None):
+    # Streaming counterpart of get_answer_async: yields ("search_results", hits)
+    # as soon as retrieval is done, ("token", text) per answer delta and
+    # finally ("done", result) with the same fields get_answer_async returns.
+    # Relevance is left PENDING for the background evaluation queue.
+    cached = await response_cache.get_async(query, selected_model, source, size)
+    if cached is not None:
+        yield "search_results", cached["search_results"]
+        yield "token", cached["answer"]
+        yield "done", cached
+        return
+
+    with StageTimer("retrieval") as retrieval:
+        search_results = await elastic_search_async(query, size, source)
+    with StageTimer("prompt") as prompt_build:
+        prompt, context, search_results, packing = prepare_prompt(query, search_results, selected_model)
+    yield "search_results", search_results
+
+    parts = []
+    usage = None
+    with StageTimer("generation") as generation:
+        async for delta in llm_stream_async(prompt, model=selected_model):
+            if isinstance(delta, str):
+                parts.append(delta)
+                yield "token", delta
+            else:
+                usage = delta
+
+    answer = "".join(parts)
+    if usage is None:
+        prompt_tokens = count_tokens(prompt)
+        completion_tokens = count_tokens(answer)
+        usage = CompletionUsage(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=prompt_tokens + completion_tokens,
+        )
+
+    result = build_answer(
+        query, selected_model, search_results, prompt, context,
+        answer, usage, generation.elapsed, PENDING_EVALUATION, NO_USAGE,
+        retrieval.elapsed, prompt_build.elapsed, packing=packing,
+    )
+    response_cache.put(query, selected_model, source, size, result)
+    yield "done", result
+
+
+# Identical questions that arrive while one is already being answered wait
+# for that answer instead of running the pipeline again. Keyed like the
+# response cache; entries only live while the answer is in flight.
+inflight_answers = {}
+coalescing_stats = {"leaders": 0, "coalesced": 0}
+batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+# Strong references to detached batch work until it finishes
+background_tasks = set()
+
+def shared_answer(query, result):
+    # The leader paid for the answer, followers are billed like cache hits
+    shared = as_cache_hit(query, result)
+    shared["coalesced"] = True
+    return shared
+
+async def get_answer_shared(query, selected_model, size=3, source=None):
+    key = make_key(query, selected_model, source, size)
+    future = inflight_answers.get(key)
+    if future is not None:
+        coalescing_stats["coalesced"] += 1
+        # shield: a follower's client going away must not cancel the leader
+        return shared_answer(query, await asyncio.shield(future))
+
+    future = asyncio.ensure_future(get_answer_async(query, selected_model, size, source, evaluate=False))
+    inflight_answers[key] = future
+    future.add_done_callback(lambda _: inflight_answers.pop(key, None))
+    coalescing_stats["leaders"] += 1
+    # The caller fills in its own relevance fields, while followers still
+    # copy the shared result, so the leader gets a copy too
+    return copy.deepcopy(await asyncio.shield(future))
+
+async def generate_answer(query, selected_model, search_results, size, source, retrieval_time):
+    with StageTimer("prompt") as prompt_build:
+        prompt, context, search_results, packing = prepare_prompt(query, search_results, selected_model)
+    async with batch_semaphore:
+        with StageTimer("generation") as generation:
+            answer, usage = await llm_async(prompt, model=selected_model)
+    if usage is None:
+        raise RuntimeError("LLM call failed")
+
+    result = build_answer(
+        query, selected_model, search_results, prompt, context,
+        answer, usage, generation.elapsed, PENDING_EVALUATION, NO_USAGE,
+        retrieval_time, prompt_build.elapsed, packing=packing,
+    )
+    response_cache.put(query, selected_model, source, size, result)
+    return result
+
+async def get_answers_batch(queries, selected_model, size=3, source=None):
+    # Answers many questions at once: cached and in-flight questions are
+    # reused, the rest are retrieved with a single msearch and generated
+    # under batch_semaphore. Returns one result dict or exception per query,
+    # in input order.
+    loop = asyncio.get_running_loop()
+    # (query, future, cached result or "shared") per input, in order
+    waiting = []
+    leaders = {}
+    # Looked up before any future is registered, so nothing awaits between
+    # registering a leader and handing it to run_leaders
+    cached_results = [await response_cache.get_async(query, selected_model, source, size) for query in queries]
+    for query, cached in zip(queries, cached_results):
+        key = make_key(query, selected_model, source, size)
+        if cached is not None:
+            waiting.append((query, None, cached))
+            continue
+        future = inflight_answers.get(key)
+        if future is None:
+            future = loop.create_future()
+            inflight_answers[key] = future
+            leaders[key] = (query, future)
+            coalescing_stats["leaders"] += 1
+            waiting.append((query, future, None))
+        else:
+            coalescing_stats["coalesced"] += 1
+            waiting.append((query, future, "shared"))
+
+    async def lead(key, query, future, search_results, retrieval_time):
+        try:
+            if isinstance(search_results, Exception):
+                raise search_results
+            future.set_result(await generate_answer(query, selected_model, search_results, size, source, retrieval_time))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            inflight_answers.pop(key, None)
+
+    async def run_leaders():
+        try:
+            # One msearch for every leader, so each is charged its full duration
+            with StageTimer("retrieval") as retrieval:
+                try:
+                    hits = await elastic_msearch_async([query for query, _ in leaders.values()], size, source)
+                    if len(hits) != len(leaders):
+                        raise RuntimeError(f"Search returned {len(hits)} results for {len(leaders)} questions")
+                except Exception as e:
+                    hits = [e] * len(leaders)
+            await asyncio.gather(*(
+                lead(key, query, future, search_results, retrieval.elapsed)
+                for (key, (query, future)), search_results in zip(leaders.items(), hits)
+            ))
+        finally:
+            # Cancelled or failed before every leader answered: nobody may be
+            # left waiting on a future that will never resolve
+            for key, (query, future) in leaders.items():
+                if not future.done():
+                    future.set_exception(RuntimeError("Batch answer was abandoned"))
+                if inflight_answers.get(key) is future:
+                    del inflight_answers[key]
+
+    if leaders:
+        # Detached from this request, like get_answer_shared, so a client
+        # that disconnects does not strand other requests waiting on it
+        task = asyncio.ensure_future(run_leaders())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    results = []
+    for query, future, cached in waiting:
+        if future is None:
+            results.append(cached)
+            continue
+        try:
+            result = await asyncio.shield(future)
+        except Exception as e:
+            results.append(e)
+            continue
+        # Repeats within the batch or of another request's question
+        results.append(shared_answer(query, result) if cached == "shared" else copy.deepcopy(result))
+    return results
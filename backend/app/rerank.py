@@ -0,0 +1,296 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+from embeddings import embedding_text
+from metrics import StageTimer
+
+# Over-fetches RERANK_CANDIDATES hits per question and reorders them before
+# the prompt is built
+RERANK = os.getenv("RERANK", "0") == "1"
+# sentence-transformers CrossEncoder name or local path (e.g.
+# cross-encoder/ms-marco-MiniLM-L-6-v2), run on the CPU. When unset, or the
+# package is not installed, a lexical scorer is used instead.
+RERANK_MODEL = os.getenv("RERANK_MODEL", "")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "30"))
+# Milliseconds reranking may add to a search, after which the retriever's
+# own order is used; 0 waits for the scores however long they take
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "200"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+# Scoring calls running at once; scores that miss the budget still finish
+# in the background, so this caps the CPU they can take. Waiting for a free
+# slot counts against the budget.
+RERANK_MAX_CONCURRENCY = int(os.getenv("RERANK_MAX_CONCURRENCY", "2"))
+# (question, chunk) scores kept, 0 disables the cache
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "10000"))
+
+
+class CrossEncoderScorer:
+    def __init__(self, model_name):
+        from sentence_transformers import CrossEncoder
+        self.model_name = model_name
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    @property
+    def spec(self):
+        return f"cross-encoder:{self.model_name}"
+
+    def score(self, groups):
+        # Every (question, chunk) pair of the call in one predict
+        pairs = [(question, embedding_text(doc)) for question, docs in groups for doc in docs]
+        scores = np.asarray(self.model.predict(pairs, batch_size=RERANK_BATCH_SIZE, show_progress_bar=False))
+        return np.split(scores, np.cumsum([len(docs) for _, docs in groups])[:-1])
+
+
+class LexicalScorer:
+    # Cosine similarity of sublinear TF-IDF vectors over word unigrams and
+    # bigrams, so chunks that repeat the question's phrases rise. IDF comes
+    # from each question's candidates: terms every candidate shares carry
+    # little weight. All texts of a call are hashed in one transform.
+    spec = "lexical"
+
+    def __init__(self):
+        self.vectorizer = HashingVectorizer(
+            ngram_range=(1, 2), n_features=2 ** 20, alternate_sign=False, norm=None, stop_words="english")
+
+    def score(self, groups):
+        texts = []
+        for question, docs in groups:
+            texts.append(question)
+            texts.extend(embedding_text(doc) for doc in docs)
+        matrix = self.vectorizer.transform(texts).tocsr()
+        matrix.data = 1 + np.log(matrix.data)
+
+        scores = []
+        position = 0
+        for question, docs in groups:
+            rows = matrix[position:position + len(docs) + 1]
+            position += len(docs) + 1
+            # Only the columns this question and its candidates use
+            rows = rows[:, np.unique(rows.indices)]
+            present = rows[1:].copy()
+            present.data[:] = 1
+            document_frequency = np.asarray(present.sum(axis=0)).ravel()
+            idf = np.log((1 + len(docs)) / (1 + document_frequency)) + 1
+            weighted = normalize(rows.multiply(idf).tocsr())
+            scores.append((weighted[1:] @ weighted[0].T).toarray().ravel())
+        return scores
+
+
+def create_scorer(model_name=RERANK_MODEL):
+    if model_name:
+        try:
+            return CrossEncoderScorer(model_name)
+        except ImportError:
+            print("sentence-transformers is not installed, reranking with the lexical scorer")
+        except Exception as e:
+            print(f"Could not load rerank model {model_name}, reranking with the lexical scorer: {e}")
+    return LexicalScorer()
+
+
+def score_key(question, doc):
+    # The chunk's text is part of the key, so chunks rebuilt with different
+    # text under the same chunk_id are scored again
+    combined = f"{question}\x00{doc['chunk_id']}\x00{doc['text']}"
+    return hashlib.md5(combined.encode()).hexdigest()
+
+
+class Reranker:
+    # Orders each question's hits by scorer relevance. Cached pair scores
+    # are reused and the rest are scored in one scorer call; if that does not
+    # finish within budget_ms, or fails, the hits keep the retriever's order.
+
+    def __init__(self, model_name=RERANK_MODEL, budget_ms=RERANK_BUDGET_MS, cache_size=RERANK_CACHE_SIZE):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.cache_size = cache_size
+        self.scorer = None
+        self.scores = OrderedDict()
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(RERANK_MAX_CONCURRENCY)
+        self.stats = {
+            "questions": 0,
+            "reranked": 0,
+            "over_budget": 0,
+            "errors": 0,
+            "cache_hits": 0,
+            "scored_pairs": 0,
+        }
+
+    def get_scorer(self):
+        # Loaded on first use, or by check at startup
+        if self.scorer is None:
+            with self.load_lock:
+                if self.scorer is None:
+                    self.scorer = create_scorer(self.model_name)
+        return self.scorer
+
+    def check(self):
+        print(f"Reranking with the {self.get_scorer().spec} scorer")
+
+    def snapshot(self):
+        with self.lock:
+            entries = len(self.scores)
+            stats = dict(self.stats)
+        spec = self.scorer.spec if self.scorer is not None else None
+        return {"scorer": spec, "budget_ms": self.budget_ms, "cache_entries": entries, **stats}
+
+    def score(self, questions, hit_lists):
+        # One array of scores per question, aligned with its hits
+        keys = [[score_key(question, doc) for doc in hits] for question, hits in zip(questions, hit_lists)]
+        with self.lock:
+            scores = []
+            for question_keys in keys:
+                found = [self.scores.get(key) for key in question_keys]
+                for key, score in zip(question_keys, found):
+                    if score is not None:
+                        self.scores.move_to_end(key)
+                scores.append(found)
+
+        missing = [
+            (question, [doc for doc, score in zip(hits, found) if score is None])
+            for question, hits, found in zip(questions, hit_lists, scores)
+        ]
+        missing = [(question, docs) for question, docs in missing if docs]
+        computed = iter(self.get_scorer().score(missing) if missing else [])
+
+        new_scores = {}
+        for question_keys, found in zip(keys, scores):
+            if all(score is not None for score in found):
+                continue
+            values = iter(next(computed))
+            for position, key in enumerate(question_keys):
+                if found[position] is None:
+                    found[position] = new_scores[key] = float(next(values))
+
+        with self.lock:
+            self.stats["cache_hits"] += sum(len(question_keys) for question_keys in keys) - len(new_scores)
+            self.stats["scored_pairs"] += len(new_scores)
+            if self.cache_size > 0:
+                self.scores.update(new_scores)
+                while len(self.scores) > self.cache_size:
+                    self.scores.popitem(last=False)
+        return scores
+
+    def score_in_slot(self, questions, hit_lists, deadline=None):
+        # Waits for a free slot until deadline (a time.monotonic() value);
+        # None if none came free in time
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        if not self.slots.acquire(timeout=timeout):
+            return None
+        try:
+            return self.score(questions, hit_lists)
+        finally:
+            self.slots.release()
+
+    def deadline(self):
+        return time.monotonic() + self.budget_ms / 1000 if self.budget_ms > 0 else None
+
+    def count(self, name, value):
+        with self.lock:
+            self.stats[name] += value
+
+    def apply(self, hit_lists, scores, size):
+        self.count("reranked", len(hit_lists))
+        return [
+            [hits[position] for position in np.argsort(-np.asarray(question_scores), kind="stable")[:size]]
+            for hits, question_scores in zip(hit_lists, scores)
+        ]
+
+    def rerank(self, questions, hit_lists, size):
+        # The best size hits per question
+        self.count("questions", len(questions))
+        fallback = [hits[:size] for hits in hit_lists]
+        deadline = self.deadline()
+        try:
+            with StageTimer("rerank"):
+                scores = self.score_in_slot(questions, hit_lists, deadline)
+        except Exception as e:
+            print(f"Error reranking: {e}")
+            self.count("errors", len(questions))
+            return fallback
+        # Without a thread to abandon, late scores are only kept for next time
+        if scores is None or (deadline is not None and time.monotonic() > deadline):
+            self.count("over_budget", len(questions))
+            return fallback
+        return self.apply(hit_lists, scores, size)
+
+    async def rerank_async(self, questions, hit_lists, size):
+        # Scoring is CPU work and runs on a thread. Past the budget the
+        # request goes on with the retriever's order while the thread
+        # finishes and caches its scores.
+        if not questions:
+            return []
+        self.count("questions", len(questions))
+        fallback = [hits[:size] for hits in hit_lists]
+        deadline = self.deadline()
+        timeout = self.budget_ms / 1000 if deadline is not None else None
+        try:
+            with StageTimer("rerank"):
+                scores = await asyncio.wait_for(
+                    asyncio.to_thread(self.score_in_slot, questions, hit_lists, deadline), timeout)
+        except asyncio.TimeoutError:
+            scores = None
+        except Exception as e:
+            print(f"Error reranking: {e}")
+            self.count("errors", len(questions))
+            return fallback
+        if scores is None:
+            self.count("over_budget", len(questions))
+            return fallback
+        return self.apply(hit_lists, scores, size)
+
+
+class RerankingRetriever:
+    # Wraps a retriever: searches return the size best of candidates hits
+    # by the reranker. Everything else is the wrapped retriever's.
+
+    def __init__(self, retriever, reranker, candidates=RERANK_CANDIDATES):
+        self.retriever = retriever
+        self.reranker = reranker
+        self.candidates = candidates
+
+    @property
+    def mode(self):
+        return self.retriever.mode
+
+    @mode.setter
+    def mode(self, mode):
+        self.retriever.mode = mode
+
+    def __getattr__(self, name):
+        return getattr(self.retriever, name)
+
+    def check(self):
+        self.retriever.check()
+        try:
+            self.reranker.check()
+        except Exception as e:
+            print(f"Error loading the reranker: {str(e)}")
+
+    def search(self, query, size=5, source=None):
+        hits = self.retriever.search(query, max(size, self.candidates), source)
+        return self.reranker.rerank([query], [hits], size)[0]
+
+    async def search_async(self, query, size=5, source=None):
+        hits = await self.retriever.search_async(query, max(size, self.candidates), source)
+        return (await self.reranker.rerank_async([query], [hits], size))[0]
+
+    async def msearch_async(self, queries, size=5, source=None):
+        # The candidates of every successful search are scored together
+        results = await self.retriever.msearch_async(queries, max(size, self.candidates), source)
+        found = [position for position, hits in enumerate(results) if not isinstance(hits, Exception)]
+        reranked = await self.reranker.rerank_async(
+            [queries[position] for position in found], [results[position] for position in found], size)
+        for position, hits in zip(found, reranked):
+            results[position] = hits
+        return results
+
+
+reranker = Reranker()
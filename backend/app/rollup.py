@@ -0,0 +1,210 @@
+import os
+import time
+import asyncio
+import argparse
+from fastapi.concurrency import run_in_threadpool
+from db import db_pool, DB_DISABLED
+from migrations import ROLLUP_TABLES
+from metrics import db_errors
+
+# Seconds between rollup refreshes while the app runs, 0 disables the job
+ROLLUP_INTERVAL = float(os.getenv("ROLLUP_INTERVAL", "60"))
+# Every refresh recomputes the buckets of this many recent minutes, so
+# relevance updates and feedback that arrive late are picked up
+ROLLUP_LOOKBACK_MINUTES = int(os.getenv("ROLLUP_LOOKBACK_MINUTES", "15"))
+# Only one process refreshes at a time when several workers run the job
+ROLLUP_LOCK_ID = 72210
+ROLLUP_UNITS = dict(zip(("minute", "hour"), ROLLUP_TABLES))
+
+# Buckets are recomputed from the raw rows rather than incremented, which
+# keeps refreshes idempotent and lets percentiles be exact per bucket.
+# GROUPING SETS adds a model_used = 'all' row per bucket for the dashboards.
+CONVERSATION_ROLLUP_SQL = """
+    WITH rows AS (
+        SELECT
+            date_trunc(%(unit)s, timestamp) AS bucket,
+            model_used,
+            total_tokens > 0 AS generated,
+            COALESCE(retrieval_time, 0) + COALESCE(prompt_time, 0) + response_time AS answer_time,
+            response_time, retrieval_time, evaluation_time, persistence_time,
+            prompt_tokens, completion_tokens, total_tokens, eval_total_tokens, openai_cost, relevance
+        FROM conversations
+        WHERE timestamp >= %(since)s
+    )
+    INSERT INTO {table} (
+        bucket, model_used, requests, cached_requests,
+        answer_time_p50, answer_time_p95, answer_time_p99, response_time_p50, response_time_p95,
+        retrieval_time_avg, evaluation_time_avg, persistence_time_avg,
+        prompt_tokens, completion_tokens, total_tokens, eval_total_tokens, openai_cost,
+        relevant, partly_relevant, non_relevant, pending, not_evaluated, unknown
+    )
+    SELECT
+        bucket,
+        COALESCE(model_used, 'all'),
+        COUNT(*),
+        -- Cache hits, shared and precomputed answers spend no tokens and
+        -- are left out of the latency percentiles
+        COUNT(*) FILTER (WHERE NOT generated),
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY answer_time) FILTER (WHERE generated),
+        percentile_cont(0.95) WITHIN GROUP (ORDER BY answer_time) FILTER (WHERE generated),
+        percentile_cont(0.99) WITHIN GROUP (ORDER BY answer_time) FILTER (WHERE generated),
+        percentile_cont(0.5) WITHIN GROUP (ORDER BY response_time) FILTER (WHERE generated),
+        percentile_cont(0.95) WITHIN GROUP (ORDER BY response_time) FILTER (WHERE generated),
+        AVG(retrieval_time) FILTER (WHERE generated),
+        AVG(evaluation_time),
+        AVG(persistence_time),
+        SUM(prompt_tokens),
+        SUM(completion_tokens),
+        SUM(total_tokens),
+        SUM(eval_total_tokens),
+        SUM(openai_cost),
+        COUNT(*) FILTER (WHERE relevance = 'RELEVANT'),
+        COUNT(*) FILTER (WHERE relevance = 'PARTLY_RELEVANT'),
+        COUNT(*) FILTER (WHERE relevance = 'NON_RELEVANT'),
+        COUNT(*) FILTER (WHERE relevance = 'PENDING'),
+        COUNT(*) FILTER (WHERE relevance = 'NOT_EVALUATED'),
+        COUNT(*) FILTER (WHERE relevance NOT IN ('RELEVANT', 'PARTLY_RELEVANT', 'NON_RELEVANT', 'PENDING', 'NOT_EVALUATED'))
+    FROM rows
+    GROUP BY GROUPING SETS ((bucket, model_used), (bucket))
+    ON CONFLICT (bucket, model_used) DO UPDATE SET
+        requests = EXCLUDED.requests,
+        cached_requests = EXCLUDED.cached_requests,
+        answer_time_p50 = EXCLUDED.answer_time_p50,
+        answer_time_p95 = EXCLUDED.answer_time_p95,
+        answer_time_p99 = EXCLUDED.answer_time_p99,
+        response_time_p50 = EXCLUDED.response_time_p50,
+        response_time_p95 = EXCLUDED.response_time_p95,
+        retrieval_time_avg = EXCLUDED.retrieval_time_avg,
+        evaluation_time_avg = EXCLUDED.evaluation_time_avg,
+        persistence_time_avg = EXCLUDED.persistence_time_avg,
+        prompt_tokens = EXCLUDED.prompt_tokens,
+        completion_tokens = EXCLUDED.completion_tokens,
+        total_tokens = EXCLUDED.total_tokens,
+        eval_total_tokens = EXCLUDED.eval_total_tokens,
+        openai_cost = EXCLUDED.openai_cost,
+        relevant = EXCLUDED.relevant,
+        partly_relevant = EXCLUDED.partly_relevant,
+        non_relevant = EXCLUDED.non_relevant,
+        pending = EXCLUDED.pending,
+        not_evaluated = EXCLUDED.not_evaluated,
+        unknown = EXCLUDED.unknown
+"""
+
+# Feedback is counted in the bucket it was given in, under the model of the
+# conversation it rates
+FEEDBACK_ROLLUP_SQL = """
+    WITH rows AS (
+        SELECT date_trunc(%(unit)s, f.timestamp) AS bucket, c.model_used, f.feedback
+        FROM feedback f
+        JOIN conversations c ON c.id = f.conversation_id
+        WHERE f.timestamp >= %(since)s
+    )
+    INSERT INTO {table} (bucket, model_used, thumbs_up, thumbs_down)
+    SELECT
+        bucket,
+        COALESCE(model_used, 'all'),
+        COUNT(*) FILTER (WHERE feedback > 0),
+        COUNT(*) FILTER (WHERE feedback < 0)
+    FROM rows
+    GROUP BY GROUPING SETS ((bucket, model_used), (bucket))
+    ON CONFLICT (bucket, model_used) DO UPDATE SET
+        thumbs_up = EXCLUDED.thumbs_up,
+        thumbs_down = EXCLUDED.thumbs_down
+"""
+
+
+def refresh_rollups(lookback_minutes=ROLLUP_LOOKBACK_MINUTES, since=None):
+    # Recomputes every minute and hour bucket from since (default: the start
+    # of the bucket lookback_minutes ago) onwards. Returns False when another
+    # process holds the refresh lock.
+    conn = db_pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (ROLLUP_LOCK_ID,))
+            if not cur.fetchone()[0]:
+                conn.rollback()
+                return False
+            if since is None:
+                cur.execute("SELECT now() - make_interval(mins => %s)", (lookback_minutes,))
+                since = cur.fetchone()[0]
+            for unit, table in ROLLUP_UNITS.items():
+                # Whole buckets only, a partial recompute would undercount
+                cur.execute("SELECT date_trunc(%s, %s::timestamptz)", (unit, since))
+                bucket_start = cur.fetchone()[0]
+                params = {"unit": unit, "since": bucket_start}
+                cur.execute(CONVERSATION_ROLLUP_SQL.format(table=table), params)
+                cur.execute(FEEDBACK_ROLLUP_SQL.format(table=table), params)
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db_pool.putconn(conn)
+
+
+class RollupJob:
+    # Refreshes the rollup tables every interval seconds on the threadpool
+
+    def __init__(self, interval=ROLLUP_INTERVAL, lookback_minutes=ROLLUP_LOOKBACK_MINUTES):
+        self.interval = interval
+        self.lookback_minutes = lookback_minutes
+        self.task = None
+        self.stats = {
+            "refreshes": 0,
+            "skipped": 0,
+            "failed": 0,
+            "last_refresh_seconds": 0.0,
+        }
+
+    async def start(self):
+        if DB_DISABLED or self.interval <= 0:
+            return
+        self.task = asyncio.create_task(self._run())
+        print(f"Started rollup job (every {self.interval}s, {self.lookback_minutes} minute lookback)")
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+
+    def snapshot(self):
+        return {"interval": self.interval, **self.stats}
+
+    async def _run(self):
+        while True:
+            start_time = time.perf_counter()
+            try:
+                if await run_in_threadpool(refresh_rollups, self.lookback_minutes):
+                    self.stats["refreshes"] += 1
+                    self.stats["last_refresh_seconds"] = time.perf_counter() - start_time
+                else:
+                    self.stats["skipped"] += 1
+            except Exception as e:
+                print(f"Error refreshing rollups: {e}")
+                self.stats["failed"] += 1
+                db_errors.inc(operation="rollup")
+            await asyncio.sleep(self.interval)
+
+
+rollup_job = RollupJob()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refresh the per-minute and per-hour rollup tables")
+    parser.add_argument("--lookback-minutes", type=int, default=ROLLUP_LOOKBACK_MINUTES)
+    parser.add_argument("--all", action="store_true", help="rebuild every bucket from the full history")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    since = "-infinity" if args.all else None
+    if not refresh_rollups(args.lookback_minutes, since):
+        print("Another process is refreshing the rollups, try again later")
+        raise SystemExit(1)
+    print(f"Rollups refreshed in {time.perf_counter() - start_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
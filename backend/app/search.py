@@ -0,0 +1,349 @@
+import os
+import time
+import asyncio
+import threading
+from elasticsearch import Elasticsearch, AsyncElasticsearch
+from dotenv import load_dotenv
+from embeddings import VECTOR_FIELD, load_embedder
+from inprocess import INPROCESS_INDEX_PATH, InProcessIndex
+from rerank import RERANK, RerankingRetriever, reranker
+
+load_dotenv()
+
+ELASTIC_URL = os.getenv("ELASTIC_URL", "http://localhost:9200")
+INDEX_NAME = os.getenv("INDEX_NAME", "movement-wiki")
+# "elasticsearch", or "inprocess" to search a file built by prep.py
+# --backend inprocess without running Elasticsearch
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "elasticsearch")
+# Connections the async Elasticsearch client keeps open for concurrent requests
+ES_MAX_CONNECTIONS = int(os.getenv("ES_MAX_CONNECTIONS", "100"))
+# "bm25", "knn" or "hybrid"; knn and hybrid need an index built with
+# prep.py --embeddings and fall back to bm25 otherwise
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "bm25")
+# Reciprocal rank fusion constant and the candidates each list contributes
+RRF_K = int(os.getenv("RRF_K", "60"))
+RRF_WINDOW = int(os.getenv("RRF_WINDOW", "20"))
+KNN_NUM_CANDIDATES = int(os.getenv("KNN_NUM_CANDIDATES", "100"))
+# How often the live index is checked for a different embedding model
+EMBEDDER_REFRESH_INTERVAL = float(os.getenv("EMBEDDER_REFRESH_INTERVAL", "60"))
+
+# A retriever provides search(query, size, source) -> list of documents,
+# the async search_async and msearch_async (one result list or exception per
+# query), get_query_embedder, index_version, check and close.
+
+
+def build_search_query(query, size=5, source=None):
+    search_query = {
+        "size": size,
+        "query": {
+            "bool": {
+                "must": [
+                    {
+                        "multi_match": {
+                            "query": query,
+                            "fields": ["title", "text^3"],
+                            "type": "best_fields",
+                            "fuzziness": "AUTO"
+                        }
+                    }
+                ],
+                "should": [
+                    {
+                        "match_phrase": {
+                            "text": {
+                                "query": query,
+                                "boost": 2
+                            }
+                        }
+                    }
+                ]
+            }
+        },
+        "_source": {"excludes": [VECTOR_FIELD]}
+    }
+    if source:
+        search_query["query"]["bool"]["filter"] = {
+            "term": {
+                "source": source
+            }
+        }
+
+    return search_query
+
+def build_knn_query(query_vector, size=5, source=None):
+    # Top-level knn search, supported since Elasticsearch 8.4
+    knn = {
+        "field": VECTOR_FIELD,
+        "query_vector": [float(value) for value in query_vector],
+        "k": size,
+        "num_candidates": max(KNN_NUM_CANDIDATES, size)
+    }
+    if source:
+        knn["filter"] = {"term": {"source": source}}
+    return {"size": size, "knn": knn, "_source": {"excludes": [VECTOR_FIELD]}}
+
+def reciprocal_rank_fusion(hit_lists, size, k=RRF_K):
+    # Scores are 1 / (k + rank) summed over the lists a chunk appears in, so
+    # BM25 and cosine scores never have to be put on the same scale
+    scores = {}
+    sources = {}
+    for hits in hit_lists:
+        for rank, hit in enumerate(hits, start=1):
+            scores[hit['_id']] = scores.get(hit['_id'], 0.0) + 1.0 / (k + rank)
+            sources.setdefault(hit['_id'], hit['_source'])
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    return [sources[hit_id] for hit_id in ranked[:size]]
+
+def combine_responses(responses, size):
+    # responses holds one msearch item per body from build_searches; a failed
+    # vector search (e.g. a mapping without the field) leaves the BM25 list
+    hit_lists = [item['hits']['hits'] for item in responses if 'error' not in item]
+    if not hit_lists:
+        raise RuntimeError(f"Search failed: {responses[0]['error']}")
+    if len(responses) == 1:
+        return [hit['_source'] for hit in hit_lists[0]][:size]
+    return reciprocal_rank_fusion(hit_lists, size)
+
+def msearch_body(searches_per_query):
+    body = []
+    for searches in searches_per_query:
+        for search in searches:
+            body.append({})
+            body.append(search)
+    return body
+
+def split_responses(items, searches_per_query):
+    grouped = []
+    position = 0
+    for searches in searches_per_query:
+        grouped.append(items[position:position + len(searches)])
+        position += len(searches)
+    return grouped
+
+def embed_queries(embedder, queries):
+    # None for queries the model has no signal for (e.g. only unknown words)
+    return [vector if vector.any() else None for vector in embedder.encode(queries)]
+
+
+class ElasticsearchRetriever:
+    # Clients are created on first use, so importing rag does not need a
+    # running Elasticsearch
+
+    def __init__(self, url=ELASTIC_URL, index_name=INDEX_NAME, mode=RETRIEVAL_MODE):
+        self.url = url
+        self.index_name = index_name
+        self.mode = mode
+        self._es_client = None
+        self._async_es_client = None
+        self.lock = threading.Lock()
+        # Query embedder matching the model recorded in the live index mapping
+        self.embedder_state = {"spec": None, "embedder": None, "checked_at": float("-inf")}
+
+    @property
+    def es_client(self):
+        if self._es_client is None:
+            with self.lock:
+                if self._es_client is None:
+                    self._es_client = Elasticsearch(self.url)
+        return self._es_client
+
+    @property
+    def async_es_client(self):
+        # Used by the FastAPI request path so searches never block the event loop
+        if self._async_es_client is None:
+            self._async_es_client = AsyncElasticsearch(self.url, node_class="httpxasync", connections_per_node=ES_MAX_CONNECTIONS)
+        return self._async_es_client
+
+    def check(self):
+        try:
+            if self.es_client.ping():
+                print("Connected to Elasticsearch")
+            else:
+                print("Could not connect to Elasticsearch")
+        except Exception as e:
+            print(f"Error connecting to Elasticsearch: {str(e)}")
+
+    def index_version(self):
+        # The concrete indices behind the alias
+        try:
+            return ",".join(sorted(self.es_client.indices.get_alias(name=self.index_name)))
+        except Exception:
+            return self.index_name
+
+    def select_embedder(self, mappings):
+        # Every index behind the alias has to agree on the model
+        specs = {mapping["mappings"].get("_meta", {}).get("embedding_model") for mapping in mappings.values()}
+        spec = specs.pop() if len(specs) == 1 else None
+        state = self.embedder_state
+        if spec != state["spec"]:
+            embedder = None
+            if spec:
+                try:
+                    embedder = load_embedder(spec)
+                    print(f"Loaded query embedder {spec}")
+                except Exception as e:
+                    print(f"Could not load embedding model {spec}: {str(e)}")
+            state.update(spec=spec, embedder=embedder)
+        state["checked_at"] = time.monotonic()
+        return state["embedder"]
+
+    def embedder_is_fresh(self):
+        return time.monotonic() - self.embedder_state["checked_at"] < EMBEDDER_REFRESH_INTERVAL
+
+    def get_query_embedder(self):
+        if self.embedder_is_fresh():
+            return self.embedder_state["embedder"]
+        try:
+            return self.select_embedder(self.es_client.indices.get_mapping(index=self.index_name))
+        except Exception as e:
+            print(f"Could not read the index mapping: {str(e)}")
+            self.embedder_state["checked_at"] = time.monotonic()
+            return self.embedder_state["embedder"]
+
+    async def get_query_embedder_async(self):
+        if self.embedder_is_fresh():
+            return self.embedder_state["embedder"]
+        try:
+            mappings = await self.async_es_client.indices.get_mapping(index=self.index_name)
+            return await asyncio.to_thread(self.select_embedder, mappings)
+        except Exception as e:
+            print(f"Could not read the index mapping: {str(e)}")
+            self.embedder_state["checked_at"] = time.monotonic()
+            return self.embedder_state["embedder"]
+
+    def build_searches(self, query, size=5, source=None, query_vector=None):
+        # The request bodies one question needs under the retrieval mode
+        if query_vector is None or self.mode == "bm25":
+            return [build_search_query(query, size, source)]
+        if self.mode == "knn":
+            return [build_knn_query(query_vector, size, source)]
+        window = max(RRF_WINDOW, size)
+        return [build_search_query(query, window, source), build_knn_query(query_vector, window, source)]
+
+    def search(self, query, size=5, source=None):
+        query_vector = None
+        if self.mode != "bm25":
+            embedder = self.get_query_embedder()
+            if embedder is not None:
+                query_vector = embed_queries(embedder, [query])[0]
+        searches = self.build_searches(query, size, source, query_vector)
+        if len(searches) == 1:
+            response = self.es_client.search(index=self.index_name, body=searches[0])
+            return [hit['_source'] for hit in response['hits']['hits']]
+        response = self.es_client.msearch(index=self.index_name, searches=msearch_body([searches]))
+        return combine_responses(response['responses'], size)
+
+    async def embed_queries_async(self, queries):
+        if self.mode == "bm25":
+            return [None] * len(queries)
+        embedder = await self.get_query_embedder_async()
+        if embedder is None:
+            return [None] * len(queries)
+        # Encoding is CPU work, kept off the event loop
+        return await asyncio.to_thread(embed_queries, embedder, queries)
+
+    async def search_async(self, query, size=5, source=None):
+        query_vector = (await self.embed_queries_async([query]))[0]
+        searches = self.build_searches(query, size, source, query_vector)
+        if len(searches) == 1:
+            response = await self.async_es_client.search(index=self.index_name, body=searches[0])
+            return [hit['_source'] for hit in response['hits']['hits']]
+        response = await self.async_es_client.msearch(index=self.index_name, searches=msearch_body([searches]))
+        return combine_responses(response['responses'], size)
+
+    async def msearch_async(self, queries, size=5, source=None):
+        # One round trip for many questions; a failed search comes back as an
+        # exception in its slot instead of failing the others
+        query_vectors = await self.embed_queries_async(queries)
+        searches_per_query = [
+            self.build_searches(query, size, source, query_vector)
+            for query, query_vector in zip(queries, query_vectors)
+        ]
+        response = await self.async_es_client.msearch(index=self.index_name, searches=msearch_body(searches_per_query))
+        results = []
+        for items in split_responses(response['responses'], searches_per_query):
+            try:
+                results.append(combine_responses(items, size))
+            except RuntimeError as e:
+                results.append(e)
+        return results
+
+    async def close(self):
+        # A later event loop gets a new client
+        if self._async_es_client is not None:
+            await self._async_es_client.close()
+            self._async_es_client = None
+
+
+class InProcessRetriever:
+    # BM25 over the file prep.py --backend inprocess writes, searched in the
+    # app's own process. The file is re-opened whenever its mtime changes, so
+    # a rebuild is picked up without a restart. Lexical retrieval only.
+
+    def __init__(self, path=INPROCESS_INDEX_PATH):
+        self.path = path
+        self.mode = "bm25"
+        self.mtime = None
+        self.index = None
+        self.lock = threading.Lock()
+
+    def get_index(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.mtime:
+            with self.lock:
+                if mtime != self.mtime:
+                    self.index = InProcessIndex(self.path)
+                    self.mtime = mtime
+                    print(f"Loaded in-process index {self.index.name} ({self.index.documents} documents) from {self.path}")
+        return self.index
+
+    def check(self):
+        try:
+            self.get_index()
+        except Exception as e:
+            print(f"Error opening in-process index {self.path}: {str(e)}")
+
+    def index_version(self):
+        try:
+            return self.get_index().name
+        except Exception:
+            return self.path
+
+    def get_query_embedder(self):
+        return None
+
+    def search(self, query, size=5, source=None):
+        return self.get_index().search(query, size, source)
+
+    async def search_async(self, query, size=5, source=None):
+        # Sub-millisecond and CPU-bound, so it runs inline on the event loop
+        return self.search(query, size, source)
+
+    async def msearch_async(self, queries, size=5, source=None):
+        results = []
+        for query in queries:
+            try:
+                results.append(self.search(query, size, source))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def close(self):
+        pass
+
+
+RETRIEVERS = {
+    "elasticsearch": ElasticsearchRetriever,
+    "inprocess": InProcessRetriever,
+}
+
+def create_retriever(backend=RETRIEVER_BACKEND):
+    if backend not in RETRIEVERS:
+        raise ValueError(f"Unknown RETRIEVER_BACKEND {backend!r}, expected one of {', '.join(RETRIEVERS)}")
+    if backend != "elasticsearch" and RETRIEVAL_MODE != "bm25":
+        print(f"RETRIEVAL_MODE={RETRIEVAL_MODE} needs Elasticsearch, the {backend} backend uses bm25")
+    return RETRIEVERS[backend]()
+
+retriever = create_retriever()
+if RERANK:
+    retriever = RerankingRetriever(retriever, reranker)
@@ -0,0 +1,33 @@
+from context import pack_context
+from tokens import count_tokens
+
+# One unbroken word worth far more tokens than the budget leaves for it
+LONG_WORD = "https://example.com/" + "x7q" * 60
+
+
+def make_hit(doc_id, text, title="Movement docs", url="https://docs.movementlabs.xyz"):
+    return {"doc_id": doc_id, "source": "docs", "title": title, "url": url, "text": text, "chunk_id": f"{doc_id}-0"}
+
+
+def header_tokens(title="Movement docs", url="https://docs.movementlabs.xyz"):
+    return count_tokens(f"[1] {title} ({url})")
+
+
+def test_budget_fitting_header_but_not_first_word_drops_document():
+    hits = [make_hit("a", f"{LONG_WORD} bridges tokens to Movement.")]
+    budget = header_tokens() + 1 + 3
+    context, used_hits, packing = pack_context(hits, max_tokens=budget)
+    assert context == ""
+    assert used_hits == []
+    assert packing["context_tokens"] == 0
+
+
+def test_budget_fitting_header_and_some_words_truncates_document():
+    hits = [make_hit("a", "Movement bridges tokens between networks in a few steps.")]
+    budget = header_tokens() + 1 + 3
+    context, used_hits, packing = pack_context(hits, max_tokens=budget)
+    header, _, body = context.partition("\n")
+    assert header == "[1] Movement docs (https://docs.movementlabs.xyz)"
+    assert body and "Movement bridges tokens between networks".startswith(body)
+    assert used_hits == hits
+    assert packing["context_tokens"] <= budget
@@ -0,0 +1,28 @@
+import os
+import json
+import pytest
+from ingest import load_documents, clean_html_content
+from bench_ingest import DATA_DIRECTORY
+
+# clean_html_content output for every sample page in data/json, stored from
+# the regex cascade it replaced (bench_ingest.legacy_clean_html_content)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "testdata", "clean_html_baseline.json")
+
+
+def load_baseline():
+    with open(BASELINE_PATH, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+DOCUMENTS = load_documents(DATA_DIRECTORY)
+BASELINE = load_baseline()
+
+
+def test_baseline_covers_sample_pages():
+    assert [doc['source'] for doc in DOCUMENTS] == [expected['source'] for expected in BASELINE]
+
+
+@pytest.mark.parametrize("position", range(len(BASELINE)))
+def test_clean_html_content_matches_baseline(position):
+    doc, expected = DOCUMENTS[position], BASELINE[position]
+    assert clean_html_content(doc['html']) == expected['html']
+    assert clean_html_content(doc['title']) == expected['title']
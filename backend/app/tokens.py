@@ -0,0 +1,36 @@
+import os
+import re
+
+# tiktoken is optional; without it (or without its cached encoding files)
+# token counts fall back to a word-based approximation
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+TOKEN_ENCODING = os.getenv("TOKEN_ENCODING", "o200k_base")
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        _encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+            except Exception as e:
+                print(f"Could not load tiktoken encoding {TOKEN_ENCODING}, using approximate token counts: {e}")
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # One token per word or punctuation mark, plus one per 8 characters of
+    # long words, which BPE splits into several pieces
+    return sum(1 + len(token) // 8 for token in TOKEN_PATTERN.findall(text))
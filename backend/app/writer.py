@@ -0,0 +1,249 @@
+import os
+import time
+import queue
+import threading
+from datetime import datetime
+from fastapi.concurrency import run_in_threadpool
+from db import write_batch, conversation_row, tz
+from metrics import stage_seconds, db_errors, db_write_seconds
+
+WRITER_BATCH_SIZE = int(os.getenv("WRITER_BATCH_SIZE", "500"))
+# Longest a row sits in memory before it is flushed, in seconds
+WRITER_FLUSH_INTERVAL = float(os.getenv("WRITER_FLUSH_INTERVAL", "0.5"))
+WRITER_QUEUE_SIZE = int(os.getenv("WRITER_QUEUE_SIZE", "10000"))
+# How long a request waits for room in a full queue before failing
+WRITER_PUT_TIMEOUT = float(os.getenv("WRITER_PUT_TIMEOUT", "5"))
+WRITER_MAX_RETRIES = int(os.getenv("WRITER_MAX_RETRIES", "3"))
+WRITER_RETRY_BACKOFF = float(os.getenv("WRITER_RETRY_BACKOFF", "0.5"))
+
+
+def row_conversation_id(kind, row):
+    # Conversation and feedback rows are tuples led by the id
+    return row["conversation_id"] if kind == "evaluation" else row[0]
+
+
+class WriteBehindWriter:
+    # Buffers conversation inserts, relevance updates and feedback in a
+    # bounded queue and writes them from a background thread in multi-row
+    # batches, so requests never wait on a commit. A batch is flushed when it
+    # reaches batch_size rows or flush_interval seconds after its first row.
+    # The queue is FIFO and every batch writes conversations before the
+    # updates and feedback that refer to them.
+
+    def __init__(
+        self,
+        batch_size=WRITER_BATCH_SIZE,
+        flush_interval=WRITER_FLUSH_INTERVAL,
+        maxsize=WRITER_QUEUE_SIZE,
+        put_timeout=WRITER_PUT_TIMEOUT,
+        max_retries=WRITER_MAX_RETRIES,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # Conversation ids queued or being written, so feedback on an answer
+        # that is not in the database yet can be told from an unknown id
+        self.pending = {}
+        self.stats = {
+            "enqueued": 0,
+            "written": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "dropped": 0,
+            "feedback_dropped": 0,
+            "retried": 0,
+            "backpressure_waits": 0,
+            "last_flush_seconds": 0.0,
+            "max_flush_seconds": 0.0,
+        }
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.thread.start()
+        print(f"Started write-behind writer (batch size {self.batch_size}, flush interval {self.flush_interval}s)")
+
+    def stop(self, timeout=30):
+        # Flushes everything still queued before returning
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f"Write-behind writer not drained after {timeout}s, {self.queue.qsize()} rows pending")
+        self.thread = None
+
+    def put(self, kind, row):
+        # Blocking put for threads; raises queue.Full after put_timeout
+        try:
+            self.queue.put_nowait((kind, row))
+        except queue.Full:
+            with self.lock:
+                self.stats["backpressure_waits"] += 1
+            self.queue.put((kind, row), timeout=self.put_timeout)
+        with self.lock:
+            self.stats["enqueued"] += 1
+
+    async def put_async(self, kind, row):
+        # Never blocks the event loop: the common case is a non-blocking put,
+        # and only a full queue falls back to waiting on the threadpool
+        try:
+            self.queue.put_nowait((kind, row))
+        except queue.Full:
+            with self.lock:
+                self.stats["backpressure_waits"] += 1
+            await run_in_threadpool(self.queue.put, (kind, row), True, self.put_timeout)
+        with self.lock:
+            self.stats["enqueued"] += 1
+
+    async def save_conversation(self, conversation_id, question, answer_data, timestamp=None):
+        # The clock starts before the put, so waiting for room in a full
+        # queue counts towards the row's persistence_time
+        enqueued_at = time.monotonic()
+        row = conversation_row(conversation_id, question, answer_data, timestamp or datetime.now(tz))
+        self._track(conversation_id, 1)
+        try:
+            await self.put_async("conversation", (row, enqueued_at))
+        except BaseException:
+            self._track(conversation_id, -1)
+            raise
+
+    def _track(self, conversation_id, change):
+        with self.lock:
+            count = self.pending.get(conversation_id, 0) + change
+            if count > 0:
+                self.pending[conversation_id] = count
+            else:
+                self.pending.pop(conversation_id, None)
+
+    def is_pending(self, conversation_id):
+        with self.lock:
+            return conversation_id in self.pending
+
+    async def save_feedback(self, conversation_id, feedback):
+        await self.put_async("feedback", (conversation_id, feedback, datetime.now(tz)))
+
+    async def save_evaluations(self, evaluations):
+        for evaluation in evaluations:
+            await self.put_async("evaluation", evaluation)
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def snapshot(self):
+        with self.lock:
+            return {"depth": self.depth(), **self.stats}
+
+    def _next_batch(self):
+        try:
+            batch = [self.queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self.stopping.is_set():
+                # While stopping, take whatever is queued without waiting
+                remaining = 0
+            try:
+                batch.append(self.queue.get(timeout=remaining) if remaining else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        # Returns how many rows were written
+        rows = {"conversation": [], "evaluation": [], "feedback": []}
+        for kind, row in batch:
+            rows[kind].append(row)
+        skipped = write_batch(rows["conversation"], rows["evaluation"], rows["feedback"])
+        if skipped:
+            # Feedback whose conversation never made it to the database
+            print(f"Dropped feedback for unknown conversations: {', '.join(skipped)}")
+            with self.lock:
+                self.stats["feedback_dropped"] += len(skipped)
+        return len(batch) - len(skipped)
+
+    def _bisect(self, batch):
+        # Writes what it can of a batch that keeps failing by halving it until
+        # the failing rows are on their own; those are dropped. Halves keep
+        # queue order, so conversations still go before rows that refer to
+        # them. Returns how many rows were written.
+        middle = len(batch) // 2
+        written = 0
+        for half in (batch[:middle], batch[middle:]):
+            try:
+                written += self._write(half)
+            except Exception as e:
+                db_errors.inc(operation="write_batch")
+                if len(half) > 1:
+                    written += self._bisect(half)
+                else:
+                    kind, row = half[0]
+                    print(f"Dropping {kind} row for conversation {row_conversation_id(kind, row)}: {e}")
+        return written
+
+    def _flush(self, batch):
+        flush_start = time.monotonic()
+        prepared = []
+        for kind, row in batch:
+            if kind == "conversation":
+                # persistence_time: from the request handing the row over to
+                # its batch being written
+                row, enqueued_at = row
+                persistence_time = flush_start - enqueued_at
+                stage_seconds.observe(persistence_time, stage="persistence")
+                row = (*row, persistence_time)
+            prepared.append((kind, row))
+
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            try:
+                written = self._write(prepared)
+                break
+            except Exception as e:
+                print(f"Error writing batch of {len(batch)} rows (attempt {attempt + 1}): {e}")
+                db_errors.inc(operation="write_batch")
+                if attempt == self.max_retries:
+                    if len(prepared) > 1:
+                        written = self._bisect(prepared)
+                    else:
+                        written = 0
+                        kind, row = prepared[0]
+                        print(f"Dropping {kind} row for conversation {row_conversation_id(kind, row)}: {e}")
+                    with self.lock:
+                        self.stats["failed_batches"] += 1
+                        self.stats["written"] += written
+                        self.stats["dropped"] += len(prepared) - written
+                    return
+                with self.lock:
+                    self.stats["retried"] += 1
+                time.sleep(WRITER_RETRY_BACKOFF * 2 ** attempt)
+
+        elapsed = time.perf_counter() - start_time
+        db_write_seconds.observe(elapsed)
+        with self.lock:
+            self.stats["written"] += written
+            self.stats["batches"] += 1
+            self.stats["last_flush_seconds"] = elapsed
+            self.stats["max_flush_seconds"] = max(self.stats["max_flush_seconds"], elapsed)
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            batch = self._next_batch()
+            if batch:
+                try:
+                    self._flush(batch)
+                finally:
+                    # Written or dropped, the conversations are no longer pending
+                    for kind, row in batch:
+                        if kind == "conversation":
+                            self._track(row[0][0], -1)
+
+
+db_writer = WriteBehindWriter()
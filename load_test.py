@@ -0,0 +1,345 @@
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+import pandas as pd
+import httpx
+
+# Adjust these as necessary
+GROUND_TRUTH_PATH = "./data/ground-truth-retrieval.csv"
+BASE_URL = "http://localhost:5000"
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend", "app")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def parse_mix(value):
+    # "question=8,faq=1,feedback=1" -> {"question": 8.0, ...}
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"unknown endpoint {name!r}, expected one of {', '.join(ENDPOINTS)}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class LoadState:
+    # Shared by all requests of one run: questions to ask, conversation ids
+    # for /feedback, and per-endpoint latencies and errors
+
+    def __init__(self, questions, stream):
+        self.questions = questions
+        self.stream = stream
+        self.conversation_ids = []
+        self.latencies = {}
+        self.errors = {}
+        self.first_tokens = []
+
+
+async def ask_streaming(client, data, start_time, state):
+    # Reads the SSE stream from /question/stream, noting the first token
+    first_token = None
+    async with client.stream("POST", "/question/stream", json=data) as response:
+        response.raise_for_status()
+        event = None
+        async for line in response.aiter_lines():
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+                if event == "token" and first_token is None:
+                    first_token = time.perf_counter() - start_time
+                elif event == "error":
+                    raise httpx.HTTPError("stream ended with an error event")
+            elif line.startswith("data: ") and event == "done":
+                state.conversation_ids.append(json.loads(line[len("data: "):])["conversation_id"])
+    if first_token is not None:
+        state.first_tokens.append(first_token)
+
+
+async def ask(client, state, start_time):
+    data = {"question": random.choice(state.questions), "selected_model": "gpt-4o-mini"}
+    if state.stream:
+        await ask_streaming(client, data, start_time, state)
+        return
+    response = await client.post("/question", json=data)
+    response.raise_for_status()
+    state.conversation_ids.append(response.json()["conversation_id"])
+
+
+async def get_faq(client, state, start_time):
+    # The frontend loads every question; other clients page through them
+    params = random.choice([{}, {"offset": random.randrange(0, 1900, 20), "limit": 20}])
+    response = await client.get("/faq", params=params)
+    response.raise_for_status()
+
+
+async def send_feedback(client, state, start_time):
+    # Feedback refers to conversations created earlier in the run; before the
+    # first answer it goes to an unknown id, which the writer skips
+    conversation_id = random.choice(state.conversation_ids) if state.conversation_ids else str(uuid.uuid4())
+    data = {"conversation_id": conversation_id, "feedback": random.choice([1, -1])}
+    response = await client.post("/feedback", json=data)
+    response.raise_for_status()
+
+
+ENDPOINTS = {
+    "question": ask,
+    "faq": get_faq,
+    "feedback": send_feedback,
+}
+
+
+async def send(client, state, endpoint, start_time):
+    try:
+        await ENDPOINTS[endpoint](client, state, start_time)
+        state.latencies.setdefault(endpoint, []).append(time.perf_counter() - start_time)
+    except (httpx.HTTPError, KeyError, ValueError) as e:
+        state.errors.setdefault(endpoint, []).append(str(e) or type(e).__name__)
+
+
+def pick_endpoint(mix):
+    return random.choices(list(mix), weights=list(mix.values()))[0]
+
+
+async def closed_loop(client, state, mix, requests, concurrency):
+    # concurrency clients, each sending its next request as soon as the
+    # previous one is answered
+    remaining = [requests]
+
+    async def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await send(client, state, pick_endpoint(mix), time.perf_counter())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def open_loop(client, state, mix, requests, rate):
+    # Poisson arrivals at rate requests/second, independent of how fast the
+    # server answers. Latency is measured from the scheduled arrival, so a
+    # stalled server shows up in the tail instead of slowing the test down.
+    tasks = []
+    next_arrival = time.perf_counter()
+    for _ in range(requests):
+        next_arrival += random.expovariate(rate)
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(client, state, pick_endpoint(mix), next_arrival)))
+    await asyncio.gather(*tasks)
+
+
+def endpoint_summary(latencies, errors, elapsed):
+    total = len(latencies) + len(errors)
+    return {
+        "requests": total,
+        "succeeded": len(latencies),
+        "failed": len(errors),
+        "error_rate": len(errors) / total if total else 0.0,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "sample_errors": errors[:5],
+    }
+
+
+async def run_load_test(base_url, questions, requests, concurrency, timeout, stream=False, mix=None, rate=None):
+    mix = mix or {"question": 1.0}
+    state = LoadState(questions, stream)
+    # An open loop can have many more requests in flight than a closed one
+    limits = httpx.Limits(max_connections=concurrency if rate is None else None)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        start_time = time.perf_counter()
+        if rate is None:
+            await closed_loop(client, state, mix, requests, concurrency)
+        else:
+            await open_loop(client, state, mix, requests, rate)
+        elapsed = time.perf_counter() - start_time
+
+    all_latencies = [latency for latencies in state.latencies.values() for latency in latencies]
+    all_errors = [error for errors in state.errors.values() for error in errors]
+    result = {
+        "requests": requests,
+        "concurrency": concurrency if rate is None else None,
+        "rate": rate,
+        "elapsed": elapsed,
+        **endpoint_summary(all_latencies, all_errors, elapsed),
+        "endpoints": {
+            endpoint: endpoint_summary(state.latencies.get(endpoint, []), state.errors.get(endpoint, []), elapsed)
+            for endpoint in mix
+        },
+    }
+    if stream:
+        result["first_token_p50"] = percentile(state.first_tokens, 50)
+        result["first_token_p95"] = percentile(state.first_tokens, 95)
+    return result
+
+
+def wait_until_ready(base_url, process, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            if httpx.get(f"{base_url}/faq", params={"limit": 1}, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Server at {base_url} did not become ready within {timeout:.0f}s")
+
+
+def start_process(args, env, log_path):
+    log = open(log_path, 'w')
+    process = subprocess.Popen(args, cwd=APP_DIRECTORY, env=env, stdout=log, stderr=subprocess.STDOUT)
+    process.log = log
+    return process
+
+
+def stop_process(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    process.log.close()
+
+
+def start_fake_llm(args):
+    env = {
+        **os.environ,
+        "FAKE_LLM_PORT": str(args.fake_llm_port),
+        "FAKE_LLM_LATENCY": str(args.fake_llm_latency),
+        "FAKE_LLM_LATENCY_JITTER": str(args.fake_llm_jitter),
+        "FAKE_LLM_COMPLETION_TOKENS": str(args.fake_llm_tokens),
+        "FAKE_LLM_ERROR_RATE": str(args.fake_llm_error_rate),
+    }
+    process = start_process([sys.executable, "fake_llm.py"], env, "/tmp/load-test-fake-llm.log")
+    base_url = f"http://localhost:{args.fake_llm_port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(base_url, timeout=1)
+            return process
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    stop_process(process)
+    raise RuntimeError("The fake LLM did not start, see /tmp/load-test-fake-llm.log")
+
+
+def start_server(args, workers):
+    env = dict(os.environ)
+    if args.spawn_fake_llm:
+        env["OPENAI_BASE_URL"] = f"http://localhost:{args.fake_llm_port}/v1"
+        env.setdefault("OPENAI_API_KEY", "fake")
+    port = httpx.URL(args.base_url).port or 5000
+    log_path = f"/tmp/load-test-server-{workers}.log"
+    print(f"Starting the backend with {workers} workers (log: {log_path})")
+    process = start_process(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port), "--workers", str(workers)],
+        env, log_path,
+    )
+    try:
+        wait_until_ready(args.base_url, process)
+    except Exception:
+        stop_process(process)
+        raise
+    return process
+
+
+def run_scenarios(args, questions, workers=None):
+    results = []
+    loads = [("rate", rate) for rate in args.rate] if args.rate else [("concurrency", c) for c in args.concurrency]
+    for kind, value in loads:
+        result = asyncio.run(run_load_test(
+            args.base_url, questions, args.requests,
+            value if kind == "concurrency" else None,
+            args.timeout, args.stream, args.mix,
+            value if kind == "rate" else None,
+        ))
+        if workers is not None:
+            result["workers"] = workers
+        print(json.dumps(result, indent=2))
+        results.append(result)
+    return results
+
+
+def print_summary(results):
+    print(f"\n{'workers':>7} {'load':>10} {'endpoint':>9} {'ok':>6} {'err%':>6} {'req/s':>8} {'p50':>7} {'p95':>7} {'p99':>7}")
+    for result in results:
+        load = f"{result['rate']}/s" if result["rate"] is not None else f"c={result['concurrency']}"
+        for endpoint, summary in result["endpoints"].items():
+            print(
+                f"{str(result.get('workers', '-')):>7} {load:>10} {endpoint:>9} {summary['succeeded']:>6} "
+                f"{summary['error_rate'] * 100:>6.1f} {summary['throughput']:>8.1f} "
+                f"{summary['p50']:>7.3f} {summary['p95']:>7.3f} {summary['p99']:>7.3f}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for /question, /faq and /feedback")
+    parser.add_argument("--base-url", default=BASE_URL)
+    parser.add_argument("--requests", type=int, default=200, help="total number of requests per run")
+    parser.add_argument("--concurrency", type=lambda value: [int(c) for c in value.split(",")], default=[1, 10, 50],
+                        help="comma-separated numbers of in-flight requests (closed loop)")
+    parser.add_argument("--rate", type=lambda value: [float(r) for r in value.split(",")], default=None,
+                        help="comma-separated arrival rates in requests/second (open loop, replaces --concurrency)")
+    parser.add_argument("--mix", type=parse_mix, default={"question": 1.0},
+                        help="endpoint weights, e.g. question=8,faq=1,feedback=1")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--stream", action="store_true", help="use /question/stream and report time to first token")
+    parser.add_argument("--workers", type=lambda value: [int(w) for w in value.split(",")], default=None,
+                        help="start the backend with each of these uvicorn worker counts in turn")
+    parser.add_argument("--spawn-fake-llm", action="store_true", help="start fake_llm.py and point spawned backends at it")
+    parser.add_argument("--fake-llm-port", type=int, default=8001)
+    parser.add_argument("--fake-llm-latency", type=float, default=0.5, help="seconds per LLM call")
+    parser.add_argument("--fake-llm-jitter", type=float, default=0.0, help="relative latency variation, e.g. 0.2")
+    parser.add_argument("--fake-llm-tokens", type=int, default=150, help="completion tokens per answer")
+    parser.add_argument("--fake-llm-error-rate", type=float, default=0.0, help="share of LLM calls that fail")
+    parser.add_argument("--output", help="write all results as JSON to this file")
+    args = parser.parse_args()
+
+    try:
+        questions = pd.read_csv(GROUND_TRUTH_PATH)["question"].tolist()
+    except FileNotFoundError:
+        print(f"Error: Ground truth file not found at {GROUND_TRUTH_PATH}")
+        sys.exit(1)
+
+    fake_llm = start_fake_llm(args) if args.spawn_fake_llm else None
+    results = []
+    try:
+        if args.workers is None:
+            results = run_scenarios(args, questions)
+        else:
+            for workers in args.workers:
+                server = start_server(args, workers)
+                try:
+                    results.extend(run_scenarios(args, questions, workers))
+                finally:
+                    stop_process(server)
+    finally:
+        if fake_llm is not None:
+            stop_process(fake_llm)
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()